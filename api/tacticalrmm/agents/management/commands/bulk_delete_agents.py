@@ -1,11 +1,10 @@
-import asyncio
-
 from django.core.management.base import BaseCommand
 from django.utils import timezone as djangotime
-from packaging import version as pyver
 
 from agents.models import Agent
 from tacticalrmm.constants import AGENT_DEFER
+from tacticalrmm.helpers import version_to_int
+from tacticalrmm.nats_utils import nats_manager
 from tacticalrmm.utils import reload_nats
 
 
@@ -40,15 +39,15 @@ class Command(BaseCommand):
             )
             return
 
-        q = Agent.objects.defer(*AGENT_DEFER)
+        q = Agent.objects.defer(*AGENT_DEFER).select_related("site__client")
 
         agents = []
         if days:
             overdue = djangotime.now() - djangotime.timedelta(days=days)
-            agents = [i for i in q if i.last_seen < overdue]
+            agents = q.filter(last_seen__lt=overdue)
 
         if agentver:
-            agents = [i for i in q if pyver.parse(i.version) <= pyver.parse(agentver)]
+            agents = q.filter(version_number__lte=version_to_int(agentver))
 
         if not agents:
             self.stdout.write(self.style.ERROR("No agents matched"))
@@ -60,7 +59,7 @@ class Command(BaseCommand):
             if delete:
                 s = "Deleting " + s
                 self.stdout.write(self.style.SUCCESS(s))
-                asyncio.run(agent.nats_cmd({"func": "uninstall"}, wait=False))
+                nats_manager.run(agent.nats_cmd({"func": "uninstall"}, wait=False))
                 try:
                     agent.delete()
                 except Exception as e:
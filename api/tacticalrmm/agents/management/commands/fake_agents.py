@@ -71,6 +71,14 @@ class Command(BaseCommand):
         chars = string.ascii_letters
         return "".join(random.choice(chars) for _ in range(length))
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=AGENTS_TO_GENERATE,
+            help="Number of agents to generate, see bench_scale for large fleets",
+        )
+
     def handle(self, *args, **kwargs) -> None:
 
         user = User.objects.first()
@@ -288,7 +296,7 @@ class Command(BaseCommand):
         show_tmp_dir_script.script_body = show_temp_dir_py
         show_tmp_dir_script.save()
 
-        for count_agents in range(AGENTS_TO_GENERATE):
+        for count_agents in range(kwargs["count"]):
 
             client = random.choice(clients)
 
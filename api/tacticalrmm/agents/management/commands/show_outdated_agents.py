@@ -3,6 +3,7 @@ from django.core.management.base import BaseCommand
 
 from agents.models import Agent
 from tacticalrmm.constants import AGENT_STATUS_ONLINE, ONLINE_AGENTS
+from tacticalrmm.helpers import version_to_int
 
 
 class Command(BaseCommand):
@@ -10,7 +11,9 @@ class Command(BaseCommand):
 
     def handle(self, *args, **kwargs):
         only = ONLINE_AGENTS + ("hostname",)
-        q = Agent.objects.exclude(version=settings.LATEST_AGENT_VER).only(*only)
+        q = Agent.objects.filter(
+            version_number__lt=version_to_int(settings.LATEST_AGENT_VER)
+        ).only(*only)
         agents = [i for i in q if i.status == AGENT_STATUS_ONLINE]
         for agent in agents:
             self.stdout.write(
@@ -0,0 +1,51 @@
+# Generated by Django 4.0.4 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+# nats-api updates agents_agent.version with plain sql so the sortable form is
+# maintained by the database, same encoding as tacticalrmm.helpers.version_to_int
+VERSION_NUMBER_TRIGGER = r"""
+CREATE OR REPLACE FUNCTION agents_agent_version_number() RETURNS trigger AS $$
+DECLARE
+    parts text[];
+BEGIN
+    parts := regexp_match(NEW.version, '^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?');
+    IF parts IS NULL THEN
+        NEW.version_number := 0;
+    ELSE
+        NEW.version_number := parts[1]::bigint * 1000000
+            + least(coalesce(parts[2]::bigint, 0), 999) * 1000
+            + least(coalesce(parts[3]::bigint, 0), 999);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER agents_agent_version_number
+BEFORE INSERT OR UPDATE OF version ON agents_agent
+FOR EACH ROW EXECUTE FUNCTION agents_agent_version_number();
+
+UPDATE agents_agent SET version = version;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0054_agent_checks_failing_agent_checks_info_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agent",
+            name="version_number",
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunSQL(
+            VERSION_NUMBER_TRIGGER,
+            reverse_sql="""
+            DROP TRIGGER IF EXISTS agents_agent_version_number ON agents_agent;
+            DROP FUNCTION IF EXISTS agents_agent_version_number();
+            """,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0055_agent_version_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='next_patch_window',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='agent',
+            name='patch_window_stale',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+    ]
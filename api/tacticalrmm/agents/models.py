@@ -1,11 +1,20 @@
 import asyncio
+import random
 import re
-from collections import Counter
 from distutils.version import LooseVersion
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Union, cast
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Union,
+    cast,
+)
 
 import msgpack
-import nats
 import validators
 from asgiref.sync import sync_to_async
 from django.conf import settings
@@ -14,16 +23,20 @@ from django.core.cache import cache
 from django.db import models
 from django.utils import timezone as djangotime
 from nats.errors import TimeoutError
-from packaging import version as pyver
 
 from core.models import TZ_CHOICES
 from core.utils import get_core_settings, send_command_with_mesh
 from logs.models import BaseAuditModel, DebugLog
 from tacticalrmm.constants import (
+    AGENT_DEFER,
     AGENT_STATUS_OFFLINE,
     AGENT_STATUS_ONLINE,
     AGENT_STATUS_OVERDUE,
+    CHECK_SUMMARY_FIELDS,
+    LIVE_AGENTS_CACHE_KEY,
     ONLINE_AGENTS,
+    PATCH_WINDOW_AGENT_FIELDS,
+    TASK_SYNC_AGENT_FIELDS,
     AgentHistoryType,
     AgentMonType,
     AgentPlat,
@@ -32,8 +45,11 @@ from tacticalrmm.constants import (
     CheckType,
     CustomFieldType,
     DebugLogType,
+    TaskStatus,
 )
+from tacticalrmm.helpers import version_to_int
 from tacticalrmm.models import PermissionQuerySet
+from tacticalrmm.nats_utils import NatsUnavailable, bulk_nats_command, nats_manager
 
 if TYPE_CHECKING:
     from alerts.models import Alert, AlertTemplate
@@ -41,7 +57,7 @@ if TYPE_CHECKING:
     from autotasks.models import AutomatedTask
     from checks.models import Check
     from clients.models import Client
-    from winupdate.models import WinUpdatePolicy
+    from winupdate.models import WinUpdate, WinUpdatePolicy
 
 # type helpers
 Disk = Union[Dict[str, Any], str]
@@ -56,6 +72,8 @@ class Agent(BaseAuditModel):
     objects = PermissionQuerySet.as_manager()
 
     version = models.CharField(default="0.1.0", max_length=255)
+    # version as major * 1_000_000 + minor * 1_000 + patch so it can be compared in the db
+    version_number = models.BigIntegerField(default=0, db_index=True)
     operating_system = models.CharField(null=True, blank=True, max_length=255)
     plat = models.CharField(
         max_length=255, choices=AgentPlat.choices, default=AgentPlat.WINDOWS
@@ -86,6 +104,9 @@ class Agent(BaseAuditModel):
     choco_installed = models.BooleanField(default=False)
     wmi_detail = models.JSONField(null=True, blank=True)
     patches_last_installed = models.DateTimeField(null=True, blank=True)
+    # start of the next hour updates get installed in, see winupdate.utils
+    next_patch_window = models.DateTimeField(null=True, blank=True, db_index=True)
+    patch_window_stale = models.BooleanField(default=True, db_index=True)
     time_zone = models.CharField(
         max_length=255, choices=TZ_CHOICES, null=True, blank=True
     )
@@ -111,9 +132,97 @@ class Agent(BaseAuditModel):
         on_delete=models.SET_NULL,
     )
 
+    # non-database properties, filled in by automation.utils.prime_policy_cache()
+    _policy_checks: "Optional[List[Check]]" = None
+    _policy_tasks: "Optional[List[AutomatedTask]]" = None
+
+    # cached check summary, updated when a check or task result changes state
+    checks_total = models.PositiveIntegerField(default=0)
+    checks_passing = models.PositiveIntegerField(default=0)
+    checks_failing = models.PositiveIntegerField(default=0)
+    checks_warning = models.PositiveIntegerField(default=0)
+    checks_info = models.PositiveIntegerField(default=0)
+    # what this agent contributes to its site and client failing_checks
+    failing_error = models.BooleanField(default=False)
+    failing_warning = models.BooleanField(default=False)
+
     def __str__(self) -> str:
         return self.hostname
 
+    def save(self, *args, **kwargs) -> None:
+        # nats-api writes the version directly, a trigger keeps version_number in sync for those
+        update_fields = kwargs.get("update_fields")
+        if "version" not in self.get_deferred_fields() and (
+            update_fields is None or "version" in update_fields
+        ):
+            self.version_number = version_to_int(self.version)
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "version_number"}
+
+        # recomputed by the next check_agent_update_schedule_task run
+        if update_fields is None or any(
+            field in update_fields for field in PATCH_WINDOW_AGENT_FIELDS
+        ):
+            self.patch_window_stale = True
+            if update_fields is not None:
+                kwargs["update_fields"] = {
+                    *kwargs["update_fields"],
+                    "patch_window_stale",
+                }
+
+        created = self.pk is None
+        old = None
+        if not created and (
+            update_fields is None
+            or any(field in update_fields for field in ("site", "maintenance_mode"))
+        ):
+            old = (
+                Agent.objects.filter(pk=self.pk)
+                .values(
+                    "site_id", "maintenance_mode", "failing_error", "failing_warning"
+                )
+                .first()
+            )
+
+        # the stored flags are what the site and client counters are based on, a full
+        # save from an instance loaded earlier mustn't overwrite them
+        if old and update_fields is None:
+            self.failing_error = old["failing_error"]
+            self.failing_warning = old["failing_warning"]
+
+        super().save(*args, **kwargs)
+
+        if old and old["site_id"] != self.site_id:
+            error, warning = int(old["failing_error"]), int(old["failing_warning"])
+            self.apply_site_failing_delta(old["site_id"], -error, -warning)
+            self.apply_site_failing_delta(self.site_id, error, warning)
+
+        if old and old["maintenance_mode"] != self.maintenance_mode:
+            self.update_check_summary()
+
+        # the set of policy tasks for this agent may have changed
+        if (
+            created
+            or update_fields is None
+            or any(field in update_fields for field in TASK_SYNC_AGENT_FIELDS)
+        ):
+            from autotasks.models import TaskSyncQueue
+
+            TaskSyncQueue.add([self.pk])
+
+    def delete(self, *args, **kwargs):
+        old = (
+            Agent.objects.filter(pk=self.pk)
+            .values_list("site_id", "failing_error", "failing_warning")
+            .first()
+        )
+        ret = super().delete(*args, **kwargs)
+
+        if old:
+            self.apply_site_failing_delta(old[0], -int(old[1]), -int(old[2]))
+
+        return ret
+
     @property
     def client(self) -> "Client":
         return self.site.client
@@ -368,9 +477,10 @@ class Agent(BaseAuditModel):
         if min_version:
             return [
                 i
-                for i in cls.objects.only(*ONLINE_AGENTS)
-                if pyver.parse(i.version) >= pyver.parse(min_version)
-                and i.status == AGENT_STATUS_ONLINE
+                for i in cls.objects.only(*ONLINE_AGENTS).filter(
+                    version_number__gte=version_to_int(min_version)
+                )
+                if i.status == AGENT_STATUS_ONLINE
             ]
 
         return [
@@ -379,6 +489,45 @@ class Agent(BaseAuditModel):
             if i.status == AGENT_STATUS_ONLINE
         ]
 
+    @classmethod
+    def live_agent_ids(cls) -> List[str]:
+        # agents that checked in within their offline window, only needs to be roughly current
+        agent_ids = cache.get(LIVE_AGENTS_CACHE_KEY)
+        if agent_ids is None:
+            agent_ids = list(
+                cls.objects.filter(
+                    last_seen__gte=djangotime.now()
+                    - djangotime.timedelta(minutes=1) * models.F("offline_time")
+                ).values_list("agent_id", flat=True)
+            )
+            cache.set(LIVE_AGENTS_CACHE_KEY, agent_ids, 60)
+
+        return agent_ids
+
+    def find_live_agent(self, batch_size: int = 10) -> "Optional[Agent]":
+        # pings a random handful of live agents at once and takes the first one that answers
+        agent_ids = [i for i in Agent.live_agent_ids() if i != self.agent_id]
+        random.shuffle(agent_ids)
+
+        for i in range(0, len(agent_ids), batch_size):
+            batch = agent_ids[i : i + batch_size]
+            replies = bulk_nats_command(
+                [(agent_id, {"func": "ping"}) for agent_id in batch],
+                wait=True,
+                timeout=1,
+            )
+            for agent_id in batch:
+                if replies.get(agent_id) != "pong":
+                    continue
+
+                agent = (
+                    Agent.objects.defer(*AGENT_DEFER).filter(agent_id=agent_id).first()
+                )
+                if agent:
+                    return agent
+
+        return None
+
     def is_supported_script(self, platforms: List[str]) -> bool:
         return self.plat.lower() in platforms if platforms else True
 
@@ -429,50 +578,172 @@ class Agent(BaseAuditModel):
         return checks
 
     def get_agent_policies(self) -> "Dict[str, Optional[Policy]]":
+        from automation.models import Policy
+        from automation.utils import resolve_policy_ids
         from checks.models import Check
 
-        site_policy = getattr(self.site, f"{self.monitoring_type}_policy", None)
-        client_policy = getattr(self.client, f"{self.monitoring_type}_policy", None)
-        default_policy = getattr(
-            get_core_settings(), f"{self.monitoring_type}_policy", None
-        )
+        policy_ids = resolve_policy_ids(self)
 
-        # prefetch excluded objects on polices only if policy is not Non
-        models.prefetch_related_objects(
-            [
-                policy
-                for policy in [self.policy, site_policy, client_policy, default_policy]
-                if policy
-            ],
-            "excluded_agents",
-            "excluded_sites",
-            "excluded_clients",
-            models.Prefetch(
-                "policychecks", queryset=Check.objects.select_related("script")
-            ),
-            "autotasks",
+        policies = (
+            Policy.objects.select_related("alert_template")
+            .prefetch_related(
+                models.Prefetch(
+                    "policychecks", queryset=Check.objects.select_related("script")
+                ),
+                "autotasks",
+            )
+            .in_bulk([pk for pk in policy_ids.values() if pk])
+            if any(policy_ids.values())
+            else {}
         )
 
-        return {
-            "agent_policy": self.policy
-            if self.policy and not self.policy.is_agent_excluded(self)
-            else None,
-            "site_policy": site_policy
-            if (site_policy and not site_policy.is_agent_excluded(self))
-            and not self.block_policy_inheritance
-            else None,
-            "client_policy": client_policy
-            if (client_policy and not client_policy.is_agent_excluded(self))
-            and not self.block_policy_inheritance
-            and not self.site.block_policy_inheritance
-            else None,
-            "default_policy": default_policy
-            if (default_policy and not default_policy.is_agent_excluded(self))
-            and not self.block_policy_inheritance
-            and not self.site.block_policy_inheritance
-            and not self.client.block_policy_inheritance
-            else None,
+        return {key: policies.get(pk) for key, pk in policy_ids.items()}
+
+    def get_failing_data(
+        self, checks: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, bool]:
+        from autotasks.models import TaskResult
+
+        data = {"error": False, "warning": False}
+        if self.maintenance_mode:
+            return data
+
+        if (
+            self.overdue_email_alert
+            or self.overdue_text_alert
+            or self.overdue_dashboard_alert
+        ) and self.status == AGENT_STATUS_OVERDUE:
+            data["error"] = True
+
+        if checks is None:
+            checks = self.checks
+
+        if checks["failing"]:
+            data["error"] = True
+        if checks["warning"]:
+            data["warning"] = True
+
+        if data["error"] and data["warning"]:
+            return data
+
+        for task in self.get_tasks_with_policies():
+            if (
+                not isinstance(task.task_result, TaskResult)
+                or task.task_result.status != TaskStatus.FAILING
+            ):
+                continue
+
+            if task.alert_severity == AlertSeverity.ERROR:
+                data["error"] = True
+            elif task.alert_severity == AlertSeverity.WARNING:
+                data["warning"] = True
+
+        return data
+
+    def set_check_summary(
+        self, checks: Dict[str, Any], failing_data: Dict[str, bool]
+    ) -> List[str]:
+        # returns the fields that changed
+        values = {
+            "checks_total": checks["total"],
+            "checks_passing": checks["passing"],
+            "checks_failing": checks["failing"],
+            "checks_warning": checks["warning"],
+            "checks_info": checks["info"],
+            "failing_error": failing_data["error"],
+            "failing_warning": failing_data["warning"],
         }
+        changed = [
+            field for field, value in values.items() if getattr(self, field) != value
+        ]
+        for field in changed:
+            setattr(self, field, values[field])
+
+        return changed
+
+    def update_check_summary(self) -> None:
+        for _ in range(3):
+            old_error, old_warning = self.failing_error, self.failing_warning
+
+            checks = self.checks
+            changed = self.set_check_summary(checks, self.get_failing_data(checks))
+            if not changed:
+                return
+
+            # bypass save() so this doesn't generate audit entries or bump modified_time.
+            # only written if the stored flags are still the ones the delta is based on,
+            # so two results for the same agent can't both apply the same change
+            updated = Agent.objects.filter(
+                pk=self.pk, failing_error=old_error, failing_warning=old_warning
+            ).update(**{field: getattr(self, field) for field in changed})
+            if updated == 1:
+                break
+
+            try:
+                self.refresh_from_db(fields=CHECK_SUMMARY_FIELDS)
+            except Agent.DoesNotExist:
+                return
+        else:
+            # the sweep will fix it
+            return
+
+        self.apply_site_failing_delta(
+            self.site_id,
+            int(self.failing_error) - int(old_error),
+            int(self.failing_warning) - int(old_warning),
+        )
+
+    @staticmethod
+    def apply_site_failing_delta(site_id: int, error: int, warning: int) -> None:
+        from clients.models import Client, Site
+
+        if not error and not warning:
+            return
+
+        Site.objects.filter(pk=site_id).apply_failing_delta(error, warning)
+        Client.objects.filter(sites=site_id).apply_failing_delta(error, warning)
+
+    @classmethod
+    def set_maintenance_mode(
+        cls, agents: "models.QuerySet[Agent]", enabled: bool
+    ) -> int:
+        # update() skips save(), so the agents that changed have their summaries and the
+        # site/client counters brought in line here. returns the number of agents matched
+        from automation.utils import prime_policy_cache
+        from checks.models import Check, CheckResult
+
+        changed = list(
+            agents.exclude(maintenance_mode=enabled).values_list("pk", flat=True)
+        )
+        count = agents.update(maintenance_mode=enabled)
+
+        changed_agents = list(
+            cls.objects.defer(*AGENT_DEFER)
+            .select_related(
+                "site__server_policy",
+                "site__workstation_policy",
+                "site__client__server_policy",
+                "site__client__workstation_policy",
+                "policy",
+            )
+            .prefetch_related(
+                models.Prefetch(
+                    "agentchecks", queryset=Check.objects.select_related("script")
+                ),
+                models.Prefetch(
+                    "checkresults",
+                    queryset=CheckResult.objects.select_related("assigned_check"),
+                ),
+                "taskresults__task",
+                "autotasks",
+            )
+            .filter(pk__in=changed)
+        )
+        prime_policy_cache(changed_agents)
+        for agent in changed_agents:
+            agent.update_check_summary()
+
+        return count
 
     def check_run_interval(self) -> int:
         interval = self.check_interval
@@ -520,30 +791,28 @@ class Agent(BaseAuditModel):
             nats_ping = {"func": "ping"}
 
             # try on self first
-            r = asyncio.run(self.nats_cmd(nats_ping, timeout=1))
-
-            if r == "pong":
-                running_agent = self
-            else:
-                for agent in Agent.online_agents():
-                    r = asyncio.run(agent.nats_cmd(nats_ping, timeout=1))
-                    if r == "pong":
-                        running_agent = agent
-                        break
+            r = nats_manager.run(self.nats_cmd(nats_ping, timeout=1))
 
-                if running_agent.pk == self.pk:
+            if r != "pong":
+                live_agent = self.find_live_agent()
+                if not live_agent:
                     return "Unable to find an online agent"
 
+                running_agent = live_agent
+
         if wait:
-            return asyncio.run(running_agent.nats_cmd(data, timeout=timeout, wait=True))
+            return nats_manager.run(
+                running_agent.nats_cmd(data, timeout=timeout, wait=True)
+            )
         else:
-            asyncio.run(running_agent.nats_cmd(data, wait=False))
+            nats_manager.run(running_agent.nats_cmd(data, wait=False))
 
         return "ok"
 
     # auto approves updates
-    def approve_updates(self) -> None:
-        patch_policy = self.get_patch_policy()
+    def approve_updates(self, patch_policy: "Optional[WinUpdatePolicy]" = None) -> None:
+        if patch_policy is None:
+            patch_policy = self.get_patch_policy()
 
         severity_list = list()
         if patch_policy.critical == "approve":
@@ -567,62 +836,9 @@ class Agent(BaseAuditModel):
 
     # returns agent policy merged with a client or site specific policy
     def get_patch_policy(self) -> "WinUpdatePolicy":
-        from winupdate.models import WinUpdatePolicy
-
-        # check if site has a patch policy and if so use it
-        patch_policy = None
-
-        agent_policy = self.winupdatepolicy.first()
-
-        if not agent_policy:
-            agent_policy = WinUpdatePolicy.objects.create(agent=self)
-
-        policies = self.get_agent_policies()
-
-        processed_policies: List[int] = list()
-        for _, policy in policies.items():
-            if (
-                policy
-                and policy.active
-                and policy.pk not in processed_policies
-                and policy.winupdatepolicy.exists()
-            ):
-                patch_policy = policy.winupdatepolicy.first()
-
-        # if policy still doesn't exist return the agent patch policy
-        if not patch_policy:
-            return agent_policy
-
-        # patch policy exists. check if any agent settings are set to override patch policy
-        if agent_policy.critical != "inherit":
-            patch_policy.critical = agent_policy.critical
-
-        if agent_policy.important != "inherit":
-            patch_policy.important = agent_policy.important
-
-        if agent_policy.moderate != "inherit":
-            patch_policy.moderate = agent_policy.moderate
-
-        if agent_policy.low != "inherit":
-            patch_policy.low = agent_policy.low
-
-        if agent_policy.other != "inherit":
-            patch_policy.other = agent_policy.other
-
-        if agent_policy.run_time_frequency != "inherit":
-            patch_policy.run_time_frequency = agent_policy.run_time_frequency
-            patch_policy.run_time_hour = agent_policy.run_time_hour
-            patch_policy.run_time_days = agent_policy.run_time_days
-
-        if agent_policy.reboot_after_install != "inherit":
-            patch_policy.reboot_after_install = agent_policy.reboot_after_install
+        from winupdate.utils import get_patch_policies
 
-        if not agent_policy.reprocess_failed_inherit:
-            patch_policy.reprocess_failed = agent_policy.reprocess_failed
-            patch_policy.reprocess_failed_times = agent_policy.reprocess_failed_times
-            patch_policy.email_if_fail = agent_policy.email_if_fail
-
-        return patch_policy
+        return get_patch_policies([self])[self.pk]
 
     def get_approved_update_guids(self) -> list[str]:
         return list(
@@ -697,51 +913,21 @@ class Agent(BaseAuditModel):
         )
 
     def get_checks_from_policies(self) -> "List[Check]":
-        from automation.models import Policy
-
-        # check if agent is blocking inheritance
-        if self.block_policy_inheritance or self.agentchecks.exists():
-            cache_key = f"agent_{self.agent_id}_checks"
-
-        elif self.policy:
-            cache_key = f"site_{self.monitoring_type}_{self.site_id}_policy_{self.policy_id}_checks"
+        from automation.utils import get_policy_checks_for_agents
 
-        else:
-            cache_key = f"site_{self.monitoring_type}_{self.site_id}_checks"
-
-        cached_checks = cache.get(cache_key)
-        if isinstance(cached_checks, list):
-            return cached_checks
-        else:
-            # clear agent checks that have overridden_by_policy set
-            self.agentchecks.update(overridden_by_policy=False)  # type: ignore
+        # set when a batch of agents was resolved with prime_policy_cache()
+        if self._policy_checks is not None:
+            return self._policy_checks
 
-            # get agent checks based on policies
-            checks = Policy.get_policy_checks(self)
-            cache.set(cache_key, checks, 600)
-            return checks
+        return get_policy_checks_for_agents([self])[self.pk]
 
     def get_tasks_from_policies(self) -> "List[AutomatedTask]":
-        from automation.models import Policy
-
-        # check if agent is blocking inheritance
-        if self.block_policy_inheritance:
-            cache_key = f"agent_{self.agent_id}_tasks"
+        from automation.utils import get_policy_tasks_for_agents
 
-        elif self.policy:
-            cache_key = f"site_{self.monitoring_type}_{self.site_id}_policy_{self.policy_id}_tasks"
+        if self._policy_tasks is not None:
+            return self._policy_tasks
 
-        else:
-            cache_key = f"site_{self.monitoring_type}_{self.site_id}_tasks"
-
-        cached_tasks = cache.get(cache_key)
-        if isinstance(cached_tasks, list):
-            return cached_tasks
-        else:
-            # get agent tasks based on policies
-            tasks = Policy.get_policy_tasks(self)
-            cache.set(f"site_{self.site_id}_tasks", tasks, 600)
-            return tasks
+        return get_policy_tasks_for_agents([self])[self.pk]
 
     def _do_nats_debug(self, agent: "Agent", message: str) -> None:
         DebugLog.error(agent=agent, log_type=DebugLogType.AGENT_ISSUES, message=message)
@@ -749,41 +935,27 @@ class Agent(BaseAuditModel):
     async def nats_cmd(
         self, data: Dict[Any, Any], timeout: int = 30, wait: bool = True
     ) -> Any:
-        options = {
-            "servers": f"tls://{settings.ALLOWED_HOSTS[0]}:4222",
-            "user": "tacticalrmm",
-            "password": settings.SECRET_KEY,
-            "connect_timeout": 3,
-            "max_reconnect_attempts": 2,
-        }
-
         try:
-            nc = await nats.connect(**options)
-        except:
+            if not wait:
+                await nats_manager.publish(self.agent_id, msgpack.dumps(data))
+                return None
+
+            msg = await nats_manager.request(
+                self.agent_id, msgpack.dumps(data), timeout=timeout
+            )
+        except NatsUnavailable:
             return "natsdown"
+        except TimeoutError:
+            return "timeout"
 
-        if wait:
-            try:
-                msg = await nc.request(
-                    self.agent_id, msgpack.dumps(data), timeout=timeout
-                )
-            except TimeoutError:
-                ret = "timeout"
-            else:
-                try:
-                    ret = msgpack.loads(msg.data)
-                except Exception as e:
-                    ret = str(e)
-                    await sync_to_async(self._do_nats_debug, thread_sensitive=False)(
-                        agent=self, message=ret
-                    )
-
-            await nc.close()
+        try:
+            return msgpack.loads(msg)
+        except Exception as e:
+            ret = str(e)
+            await sync_to_async(self._do_nats_debug, thread_sensitive=False)(
+                agent=self, message=ret
+            )
             return ret
-        else:
-            await nc.publish(self.agent_id, msgpack.dumps(data))
-            await nc.flush()
-            await nc.close()
 
     def recover(self, mode: str, mesh_uri: str, wait: bool = True) -> tuple[str, bool]:
         """
@@ -805,13 +977,13 @@ class Agent(BaseAuditModel):
         elif mode == "mesh":
             data = {"func": "recover", "payload": {"mode": mode}}
             if wait:
-                r = asyncio.run(self.nats_cmd(data, timeout=20))
+                r = nats_manager.run(self.nats_cmd(data, timeout=20))
                 if r == "ok":
                     return ("ok", False)
                 else:
                     return (str(r), True)
             else:
-                asyncio.run(self.nats_cmd(data, timeout=20, wait=False))
+                nats_manager.run(self.nats_cmd(data, timeout=20, wait=False))
 
             return ("ok", False)
 
@@ -824,32 +996,40 @@ class Agent(BaseAuditModel):
 
         return AgentAuditSerializer(agent).data
 
-    def delete_superseded_updates(self) -> None:
+    def delete_superseded_updates(
+        self, updates: "Optional[Iterable[WinUpdate]]" = None
+    ) -> None:
+        # updates can be passed in when the caller already has them loaded
+        if updates is None:
+            updates = self.winupdates.only("pk", "kb", "title").order_by("pk")
+
         try:
             pks = []  # list of pks to delete
-            kbs = list(self.winupdates.values_list("kb", flat=True))
-            d = Counter(kbs)
-            dupes = [k for k, v in d.items() if v > 1]
+            by_kb: Dict[str, List[WinUpdate]] = {}
+            for u in sorted(updates, key=lambda u: u.pk):
+                by_kb.setdefault(u.kb, []).append(u)
+
+            for dupes in by_kb.values():
+                if len(dupes) < 2:
+                    continue
 
-            for dupe in dupes:
-                titles = self.winupdates.filter(kb=dupe).values_list("title", flat=True)
                 # extract the version from the title and sort from oldest to newest
                 # skip if no version info is available therefore nothing to parse
                 try:
                     vers = [
-                        re.search(r"\(Version(.*?)\)", i).group(1).strip()
-                        for i in titles
+                        re.search(r"\(Version(.*?)\)", u.title).group(1).strip()
+                        for u in dupes
                     ]
                     sorted_vers = sorted(vers, key=LooseVersion)
                 except:
                     continue
                 # append all but the latest version to our list of pks to delete
                 for ver in sorted_vers[:-1]:
-                    q = self.winupdates.filter(kb=dupe).filter(title__contains=ver)
-                    pks.append(q.first().pk)
+                    pks.append(next(u.pk for u in dupes if ver in u.title))
 
             pks = list(set(pks))
-            self.winupdates.filter(pk__in=pks).delete()
+            if pks:
+                self.winupdates.filter(pk__in=pks).delete()
         except:
             pass
 
@@ -1,3 +1,5 @@
+from typing import Any, Dict
+
 import pytz
 from rest_framework import serializers
 
@@ -76,16 +78,25 @@ class AgentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Agent
         exclude = ["id"]
+        read_only_fields = [
+            "checks_total",
+            "checks_passing",
+            "checks_failing",
+            "checks_warning",
+            "checks_info",
+            "failing_error",
+            "failing_warning",
+        ]
 
 
 class AgentTableSerializer(serializers.ModelSerializer):
     status = serializers.ReadOnlyField()
-    checks = serializers.ReadOnlyField()
+    checks = serializers.SerializerMethodField()
     client_name = serializers.ReadOnlyField(source="client.name")
     site_name = serializers.ReadOnlyField(source="site.name")
     logged_username = serializers.SerializerMethodField()
     italic = serializers.SerializerMethodField()
-    policy = serializers.ReadOnlyField(source="policy.id")
+    policy = serializers.ReadOnlyField(source="policy_id")
     alert_template = serializers.SerializerMethodField()
     last_seen = serializers.ReadOnlyField()
     pending_actions_count = serializers.ReadOnlyField()
@@ -103,6 +114,17 @@ class AgentTableSerializer(serializers.ModelSerializer):
                 "always_alert": obj.alert_template.agent_always_alert,
             }
 
+    def get_checks(self, obj) -> Dict[str, Any]:
+        # read from the stored summary instead of resolving policy checks per row
+        return {
+            "total": obj.checks_total,
+            "passing": obj.checks_passing,
+            "failing": obj.checks_failing,
+            "warning": obj.checks_warning,
+            "info": obj.checks_info,
+            "has_failing_checks": obj.checks_failing > 0 or obj.checks_warning > 0,
+        }
+
     def get_logged_username(self, obj) -> str:
         if obj.logged_in_username == "None" and obj.status == AGENT_STATUS_ONLINE:
             return obj.last_logged_in_user
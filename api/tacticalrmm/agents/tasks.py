@@ -1,33 +1,35 @@
-import asyncio
 import datetime as dt
 import random
 from time import sleep
 from typing import Optional
 
 from django.conf import settings
+from django.db.models import Exists, F, OuterRef, Q
 from django.utils import timezone as djangotime
-from packaging import version as pyver
 
 from agents.models import Agent
 from agents.utils import get_agent_url
-from core.utils import get_core_settings
+from core.utils import get_core_settings, schedule_dash_counts
 from logs.models import DebugLog, PendingAction
 from scripts.models import Script
 from tacticalrmm.celery import app
 from tacticalrmm.constants import (
-    AGENT_STATUS_OVERDUE,
+    AGENT_DEFER,
+    AlertType,
     CheckStatus,
     DebugLogType,
     PAAction,
     PAStatus,
 )
+from tacticalrmm.helpers import version_to_int
+from tacticalrmm.nats_utils import bulk_nats_command, nats_manager
 
 
 def agent_update(agent_id: str, force: bool = False) -> str:
 
     agent = Agent.objects.get(agent_id=agent_id)
 
-    if pyver.parse(agent.version) <= pyver.parse("1.3.0"):
+    if agent.version_number <= version_to_int("1.3.0"):
         return "not supported"
 
     # skip if we can't determine the arch
@@ -69,26 +71,64 @@ def agent_update(agent_id: str, force: bool = False) -> str:
             "inno": inno,
         },
     }
-    asyncio.run(agent.nats_cmd(nats_data, wait=False))
+    nats_manager.run(agent.nats_cmd(nats_data, wait=False))
     return "created"
 
 
+def bulk_agent_update(agent_ids: list[str], force: bool = False) -> dict[str, str]:
+    # same as agent_update for a whole wave of agents, the download url only
+    # depends on arch and platform so it's only looked up once for each
+    version = settings.LATEST_AGENT_VER
+    urls: dict[tuple[str, str], str] = {}
+    actions: list[PendingAction] = []
+    messages = []
+    for agent in Agent.objects.defer(*AGENT_DEFER).filter(
+        agent_id__in=agent_ids, version_number__gt=version_to_int("1.3.0")
+    ):
+        if agent.arch is None:
+            DebugLog.warning(
+                agent=agent,
+                log_type=DebugLogType.AGENT_ISSUES,
+                message=f"Unable to determine arch on {agent.hostname}({agent.agent_id}). Skipping agent update.",
+            )
+            continue
+
+        if (agent.arch, agent.plat) not in urls:
+            urls[(agent.arch, agent.plat)] = get_agent_url(agent.arch, agent.plat)
+
+        details = {
+            "url": urls[(agent.arch, agent.plat)],
+            "version": version,
+            "inno": agent.win_inno_exe,
+        }
+        if not force:
+            actions.append(
+                PendingAction(
+                    agent=agent, action_type=PAAction.AGENT_UPDATE, details=details
+                )
+            )
+
+        messages.append((agent.agent_id, {"func": "agentupdate", "payload": details}))
+
+    if actions:
+        PendingAction.objects.filter(
+            agent_id__in=[action.agent_id for action in actions],
+            action_type=PAAction.AGENT_UPDATE,
+            status=PAStatus.PENDING,
+        ).delete()
+        PendingAction.objects.bulk_create(actions)
+
+    return bulk_nats_command(messages, rate=settings.AGENT_UPDATE_RATE)
+
+
 @app.task
 def force_code_sign(agent_ids: list[str]) -> None:
-    chunks = (agent_ids[i : i + 70] for i in range(0, len(agent_ids), 70))
-    for chunk in chunks:
-        for agent_id in chunk:
-            agent_update(agent_id=agent_id, force=True)
-        sleep(2)
+    bulk_agent_update(agent_ids, force=True)
 
 
 @app.task
 def send_agent_update_task(agent_ids: list[str]) -> None:
-    chunks = (agent_ids[i : i + 70] for i in range(0, len(agent_ids), 70))
-    for chunk in chunks:
-        for agent_id in chunk:
-            agent_update(agent_id)
-        sleep(2)
+    bulk_agent_update(agent_ids)
 
 
 @app.task
@@ -97,18 +137,13 @@ def auto_self_agent_update_task() -> None:
     if not core.agent_auto_update:
         return
 
-    q = Agent.objects.only("agent_id", "version")
-    agent_ids: list[str] = [
-        i.agent_id
-        for i in q
-        if pyver.parse(i.version) < pyver.parse(settings.LATEST_AGENT_VER)
-    ]
+    agent_ids: list[str] = list(
+        Agent.objects.filter(
+            version_number__lt=version_to_int(settings.LATEST_AGENT_VER)
+        ).values_list("agent_id", flat=True)
+    )
 
-    chunks = (agent_ids[i : i + 70] for i in range(0, len(agent_ids), 70))
-    for chunk in chunks:
-        for agent_id in chunk:
-            agent_update(agent_id)
-        sleep(2)
+    bulk_agent_update(agent_ids)
 
 
 @app.task
@@ -204,20 +239,59 @@ def agent_recovery_sms_task(pk: int) -> str:
 def agent_outages_task() -> None:
     from alerts.models import Alert
 
-    agents = Agent.objects.only(
-        "pk",
-        "agent_id",
-        "last_seen",
-        "offline_time",
-        "overdue_time",
-        "overdue_email_alert",
-        "overdue_text_alert",
-        "overdue_dashboard_alert",
+    now = djangotime.now()
+    open_alerts = Alert.objects.filter(
+        agent=OuterRef("pk"), alert_type=AlertType.AVAILABILITY, resolved=False
+    )
+
+    # same predicate as Agent.status == overdue, evaluated by the database
+    agents = (
+        Agent.objects.defer(*AGENT_DEFER)
+        .select_related("site__client", "alert_template")
+        .filter(
+            last_seen__lt=now - (djangotime.timedelta(minutes=1) * F("offline_time"))
+        )
+        .filter(
+            last_seen__lt=now - (djangotime.timedelta(minutes=1) * F("overdue_time"))
+        )
+        .annotate(
+            has_open_alert=Exists(open_alerts),
+            action_pending=Exists(open_alerts.filter(action_run__isnull=True)),
+        )
+        # agents already alerted on only need another pass for periodic notifications
+        # or a failure action that hasn't run yet
+        .filter(
+            Q(has_open_alert=False)
+            | Q(alert_template__agent_periodic_alert_days__gt=0)
+            | Q(
+                action_pending=True,
+                alert_template__action__isnull=False,
+                alert_template__agent_script_actions=True,
+            )
+        )
     )
 
+    new_agents = []
     for agent in agents:
-        if agent.status == AGENT_STATUS_OVERDUE:
+        if agent.has_open_alert:
             Alert.handle_alert_failure(agent)
+        else:
+            new_agents.append(agent)
+
+    for alert in Alert.create_availability_alerts(new_agents):
+        Alert.handle_alert_failure(alert.agent, alert=alert)
+
+    if new_agents:
+        schedule_dash_counts()
+
+    # newly overdue agents may now count as failing for their site and client
+    for agent in new_agents:
+        if not agent.failing_error and (
+            agent.overdue_email_alert
+            or agent.overdue_text_alert
+            or agent.overdue_dashboard_alert
+        ):
+            agent.update_check_summary()
 
 
 @app.task
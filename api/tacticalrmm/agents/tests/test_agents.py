@@ -8,6 +8,7 @@ import pytz
 from django.conf import settings
 from django.utils import timezone as djangotime
 from model_bakery import baker
+from model_bakery.recipe import seq
 from packaging import version as pyver
 
 from agents.models import Agent, AgentCustomField, AgentHistory, Note
@@ -22,13 +23,19 @@ from logs.models import PendingAction
 from tacticalrmm.constants import (
     AGENT_STATUS_OFFLINE,
     AGENT_STATUS_ONLINE,
+    AGENT_STATUS_OVERDUE,
     AgentMonType,
+    AgentPlat,
+    AlertSeverity,
+    CheckStatus,
+    CheckType,
     CustomFieldModel,
     CustomFieldType,
     EvtLogNames,
     PAAction,
     PAStatus,
 )
+from tacticalrmm.helpers import version_to_int
 from tacticalrmm.test import TacticalTestCase
 from winupdate.models import WinUpdatePolicy
 from winupdate.serializers import WinUpdatePolicySerializer
@@ -82,17 +89,17 @@ class TestAgentsList(TacticalTestCase):
         # test all agents
         r = self.client.get(url, format="json")
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(len(r.data), 36)
+        self.assertEqual(len(json.loads(b"".join(r.streaming_content))), 36)
 
         # test client1
         r = self.client.get(f"{url}?client={company1.pk}", format="json")
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(len(r.data), 25)
+        self.assertEqual(len(json.loads(b"".join(r.streaming_content))), 25)
 
         # test site3
         r = self.client.get(f"{url}?site={site3.pk}", format="json")
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(len(r.data), 11)
+        self.assertEqual(len(json.loads(b"".join(r.streaming_content))), 11)
 
         # test with no details
         r = self.client.get(f"{url}?site={site3.pk}&detail=false", format="json")
@@ -106,6 +113,63 @@ class TestAgentsList(TacticalTestCase):
 
         self.check_not_authenticated("get", url)
 
+    def test_get_agents_paginated(self) -> None:
+        url = f"{base_url}/"
+
+        site = baker.make("clients.Site")
+        online = baker.make_recipe(
+            "agents.online_agent",
+            site=site,
+            hostname=seq("online-"),
+            _quantity=5,
+        )
+        baker.make_recipe("agents.offline_agent", site=site, _quantity=2)
+        overdue = baker.make_recipe("agents.overdue_agent", site=site)
+        online[0].checks_failing = 2
+        online[0].save(update_fields=["checks_failing"])
+        online[1].needs_reboot = True
+        online[1].save(update_fields=["needs_reboot"])
+        baker.make("logs.PendingAction", agent=online[2], _quantity=3)
+
+        # pages are walked with the cursor until every agent has been returned
+        r = self.client.get(f"{url}?page_size=3&ordering=status", format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.data["results"]), 3)
+        self.assertEqual(r.data["results"][0]["status"], AGENT_STATUS_OFFLINE)
+        seen = [a["agent_id"] for a in r.data["results"]]
+        while r.data["next"]:
+            r = self.client.get(r.data["next"], format="json")
+            seen += [a["agent_id"] for a in r.data["results"]]
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(len(set(seen)), 8)
+
+        r = self.client.get(f"{url}?status={AGENT_STATUS_OVERDUE}", format="json")
+        data = json.loads(b"".join(r.streaming_content))
+        self.assertEqual([a["agent_id"] for a in data], [overdue.agent_id])
+
+        r = self.client.get(f"{url}?failing_checks=true", format="json")
+        data = json.loads(b"".join(r.streaming_content))
+        self.assertEqual([a["agent_id"] for a in data], [online[0].agent_id])
+        self.assertTrue(data[0]["checks"]["has_failing_checks"])
+        self.assertEqual(data[0]["checks"]["failing"], 2)
+
+        r = self.client.get(f"{url}?needs_reboot=true", format="json")
+        data = json.loads(b"".join(r.streaming_content))
+        self.assertEqual([a["agent_id"] for a in data], [online[1].agent_id])
+
+        r = self.client.get(f"{url}?pending_actions=true&page_size=10", format="json")
+        self.assertEqual(len(r.data["results"]), 1)
+        self.assertEqual(r.data["results"][0]["pending_actions_count"], 3)
+
+        r = self.client.get(
+            f"{url}?status={AGENT_STATUS_ONLINE}&ordering=-hostname", format="json"
+        )
+        data = json.loads(b"".join(r.streaming_content))
+        self.assertEqual(
+            [a["hostname"] for a in data],
+            sorted((a.hostname for a in online), reverse=True),
+        )
+
 
 class TestAgentViews(TacticalTestCase):
     def setUp(self):
@@ -208,9 +272,16 @@ class TestAgentViews(TacticalTestCase):
     @patch("asyncio.run")
     @patch("core.utils._b64_to_hex")
     @patch("agents.models.Agent.nats_cmd")
-    @patch("agents.views.reload_nats")
+    @patch("agents.views.schedule_nats_reload")
+    @patch("agents.views.schedule_dash_counts")
     def test_agent_uninstall(
-        self, reload_nats, nats_cmd, b64_to_hex, asyncio_run1, asyncio_run2
+        self,
+        schedule_dash_counts,
+        schedule_nats_reload,
+        nats_cmd,
+        b64_to_hex,
+        asyncio_run1,
+        asyncio_run2,
     ):
         asyncio_run1.return_value = "ok"
         asyncio_run2.return_value = "ok"
@@ -221,7 +292,8 @@ class TestAgentViews(TacticalTestCase):
         self.assertEqual(r.status_code, 200)
 
         nats_cmd.assert_called_with({"func": "uninstall", "code": "foo"}, wait=False)
-        reload_nats.assert_called_once()
+        schedule_nats_reload.assert_called_once()
+        schedule_dash_counts.assert_called_once()
 
         self.check_not_authenticated("delete", url)
 
@@ -290,7 +362,10 @@ class TestAgentViews(TacticalTestCase):
         r = self.client.post(url, data, format="json")
         self.assertEqual(r.status_code, 200)
 
-        mock_task.assert_called_with(agent_ids=expected)
+        mock_task.assert_called_once()
+        self.assertEqual(
+            sorted(mock_task.call_args.kwargs["agent_ids"]), sorted(expected)
+        )
 
         self.check_not_authenticated("post", url)
 
@@ -916,6 +991,42 @@ class TestAgentViewsNew(TacticalTestCase):
         self.assertEqual(r.status_code, 200)
         self.assertFalse(Agent.objects.get(pk=agent.pk).maintenance_mode)
 
+        # bulk toggles keep the site and client failing counters in line
+        failing = baker.make_recipe("agents.online_agent", site=agent.site)
+        baker.make(
+            "checks.CheckResult",
+            agent=failing,
+            assigned_check=baker.make(
+                "checks.Check",
+                agent=failing,
+                check_type=CheckType.PING,
+                alert_severity=AlertSeverity.ERROR,
+            ),
+            status=CheckStatus.FAILING,
+        )
+        failing.update_check_summary()
+
+        def counts():
+            agent.site.refresh_from_db()
+            agent.site.client.refresh_from_db()
+            return (
+                agent.site.failing_error_agents,
+                agent.site.client.failing_error_agents,
+            )
+
+        self.assertEqual(counts(), (1, 1))
+
+        data = {"type": "Client", "id": agent.site.client.id, "action": True}
+        r = self.client.post(url, data, format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(counts(), (0, 0))
+        self.assertFalse(Agent.objects.get(pk=failing.pk).failing_error)
+
+        data = {"type": "Site", "id": agent.site.id, "action": False}
+        r = self.client.post(url, data, format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(counts(), (1, 1))
+
         # Test invalid payload
         data = {"type": "Invalid", "id": agent.id, "action": True}
 
@@ -951,17 +1062,17 @@ class TestAgentPermissions(TacticalTestCase):
 
         # all agents should be returned
         response = self.check_authorized("get", url)
-        self.assertEqual(len(response.data), 10)
+        self.assertEqual(len(json.loads(b"".join(response.streaming_content))), 10)
 
         # limit user to specific client. only 1 agent should be returned
         user.role.can_view_clients.set([agents[4].client])
         response = self.check_authorized("get", url)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(json.loads(b"".join(response.streaming_content))), 2)
 
         # limit agent to specific site. 2 should be returned now
         user.role.can_view_sites.set([agents[6].site])
         response = self.check_authorized("get", url)
-        self.assertEqual(len(response.data), 4)
+        self.assertEqual(len(json.loads(b"".join(response.streaming_content))), 4)
 
         # make sure superusers work
         self.check_authorized_superuser("get", url)
@@ -969,9 +1080,15 @@ class TestAgentPermissions(TacticalTestCase):
     @patch("asyncio.run")
     @patch("core.utils._b64_to_hex")
     @patch("agents.models.Agent.nats_cmd")
-    @patch("agents.views.reload_nats")
+    @patch("agents.views.schedule_nats_reload")
+    @patch("agents.views.schedule_dash_counts")
     def test_get_edit_uninstall_permissions(
-        self, reload_nats, nats_cmd, b64_to_hex, asyncio_run
+        self,
+        schedule_dash_counts,
+        schedule_nats_reload,
+        nats_cmd,
+        b64_to_hex,
+        asyncio_run,
     ):
         b64_to_hex.return_value = "nodeid"
         # create user with empty role
@@ -1511,16 +1628,15 @@ class TestAgentTasks(TacticalTestCase):
         self.assertEqual(action.action_type, PAAction.AGENT_UPDATE)
         self.assertEqual(action.status, PAStatus.PENDING) """
 
-    @patch("agents.tasks.agent_update")
-    @patch("agents.tasks.sleep", return_value=None)
-    def test_auto_self_agent_update_task(self, mock_sleep, agent_update):
+    @patch("agents.tasks.bulk_agent_update")
+    def test_auto_self_agent_update_task(self, bulk_agent_update):
         baker.make_recipe(
             "agents.agent",
             operating_system="Windows 10 Pro, 64 bit (build 19041.450)",
             version=settings.LATEST_AGENT_VER,
             _quantity=23,
         )
-        baker.make_recipe(
+        outdated = baker.make_recipe(
             "agents.agent",
             operating_system="Windows 10 Pro, 64 bit (build 19041.450)",
             version="1.3.0",
@@ -1531,13 +1647,74 @@ class TestAgentTasks(TacticalTestCase):
         self.coresettings.save(update_fields=["agent_auto_update"])
 
         r = auto_self_agent_update_task.s().apply()
-        self.assertEqual(agent_update.call_count, 0)
+        bulk_agent_update.assert_not_called()
 
         self.coresettings.agent_auto_update = True
         self.coresettings.save(update_fields=["agent_auto_update"])
 
         r = auto_self_agent_update_task.s().apply()
-        self.assertEqual(agent_update.call_count, 33)
+        bulk_agent_update.assert_called_once()
+        self.assertEqual(
+            sorted(bulk_agent_update.call_args[0][0]),
+            sorted(i.agent_id for i in outdated),
+        )
+
+    def test_agent_version_number(self):
+        agent = baker.make_recipe("agents.agent", version="2.0.3")
+        self.assertEqual(agent.version_number, 2_000_003)
+
+        agent.version = "2.1.0"
+        agent.save(update_fields=["version"])
+        agent.refresh_from_db()
+        self.assertEqual(agent.version_number, 2_001_000)
+
+        # nats-api writes the version without going through the orm
+        Agent.objects.filter(pk=agent.pk).update(version="1.10.2")
+        agent.refresh_from_db()
+        self.assertEqual(agent.version_number, 1_010_002)
+
+        self.assertFalse(
+            Agent.objects.filter(version_number__gte=version_to_int("1.11.0")).exists()
+        )
+
+    @patch("agents.tasks.bulk_nats_command")
+    @patch("agents.tasks.get_agent_url")
+    def test_bulk_agent_update(self, get_url, bulk_nats_command):
+        from agents.tasks import bulk_agent_update
+
+        get_url.return_value = "https://exe.tacticalrmm.io"
+        agents = baker.make_recipe(
+            "agents.agent",
+            operating_system="Windows 10 Pro, 64 bit (build 19041.450)",
+            version="1.4.14",
+            _quantity=5,
+        )
+        agent_130 = baker.make_recipe(
+            "agents.agent",
+            operating_system="Windows 10 Pro, 64 bit (build 19041.450)",
+            version="1.3.0",
+        )
+        baker.make(
+            "logs.PendingAction", agent=agents[0], action_type=PAAction.AGENT_UPDATE
+        )
+
+        bulk_agent_update([i.agent_id for i in agents] + [agent_130.agent_id])
+
+        # the url is only looked up once for the whole wave
+        get_url.assert_called_once_with("64", AgentPlat.WINDOWS)
+        bulk_nats_command.assert_called_once()
+        messages = bulk_nats_command.call_args[0][0]
+        self.assertEqual(
+            sorted(agent_id for agent_id, _ in messages),
+            sorted(i.agent_id for i in agents),
+        )
+        self.assertEqual(messages[0][1]["payload"]["url"], "https://exe.tacticalrmm.io")
+        self.assertEqual(
+            bulk_nats_command.call_args[1]["rate"], settings.AGENT_UPDATE_RATE
+        )
+        self.assertEqual(
+            PendingAction.objects.filter(action_type=PAAction.AGENT_UPDATE).count(), 5
+        )
 
     def test_agent_history_prune_task(self):
         from agents.tasks import prune_agent_history
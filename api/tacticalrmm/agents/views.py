@@ -6,20 +6,36 @@ import string
 import time
 
 from django.conf import settings
-from django.db.models import Count, Exists, OuterRef, Prefetch, Q
+from django.db.models import (
+    Case,
+    Count,
+    Exists,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone as djangotime
 from meshctrl.utils import get_login_token
-from packaging import version as pyver
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import PermissionDenied
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from core.models import CodeSignToken
-from core.utils import get_core_settings, get_mesh_ws_url, remove_mesh_agent
+from core.utils import (
+    get_core_settings,
+    get_mesh_ws_url,
+    remove_mesh_agent,
+    schedule_dash_counts,
+)
 from logs.models import AuditLog, DebugLog, PendingAction
 from scripts.models import Script
 from scripts.tasks import handle_bulk_command_task, handle_bulk_script_task
@@ -27,6 +43,7 @@ from tacticalrmm.constants import (
     AGENT_DEFER,
     AGENT_STATUS_OFFLINE,
     AGENT_STATUS_ONLINE,
+    AGENT_STATUS_OVERDUE,
     AgentHistoryType,
     AgentMonType,
     AgentPlat,
@@ -35,13 +52,17 @@ from tacticalrmm.constants import (
     PAAction,
     PAStatus,
 )
-from tacticalrmm.helpers import notify_error
+from tacticalrmm.helpers import notify_error, version_to_int
 from tacticalrmm.permissions import (
     _has_perm_on_agent,
     _has_perm_on_client,
     _has_perm_on_site,
 )
-from tacticalrmm.utils import get_default_timezone, reload_nats
+from tacticalrmm.utils import (
+    get_default_timezone,
+    schedule_nats_reload,
+    stream_json_list,
+)
 from winupdate.models import WinUpdate
 from winupdate.serializers import WinUpdatePolicySerializer
 from winupdate.tasks import bulk_check_for_updates_task, bulk_install_updates_task
@@ -74,12 +95,33 @@ from .serializers import (
 from .tasks import run_script_email_results_task, send_agent_update_task
 
 
+# sort keys accepted by the agent table, they all map to non null columns so cursors work
+AGENT_TABLE_ORDERING = {
+    "hostname": "hostname",
+    "client": "client_name",
+    "site": "site_name",
+    "status": "agent_status",
+    "checks": "checks_failing",
+    "needs_reboot": "needs_reboot",
+    "pending_actions": "pending_actions_count",
+}
+
+
+class AgentTablePagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        sort = request.query_params.get("ordering", "hostname")
+        field = AGENT_TABLE_ORDERING.get(sort.lstrip("-"), "hostname")
+        return (f"-{field}" if sort.startswith("-") else field, "pk")
+
+
 class GetAgents(APIView):
     permission_classes = [IsAuthenticated, AgentPerms]
 
     def get(self, request):
-        from checks.models import Check, CheckResult
-
         monitoring_type_filter = Q()
         client_site_filter = Q()
 
@@ -101,44 +143,75 @@ class GetAgents(APIView):
             or "detail" in request.query_params.keys()
             and request.query_params["detail"] == "true"
         ):
+            now = djangotime.now()
+            offline = now - djangotime.timedelta(minutes=1) * F("offline_time")
+            overdue = now - djangotime.timedelta(minutes=1) * F("overdue_time")
+
+            # the check counts come from the stored summary columns so no policies are resolved here
             agents = (
                 Agent.objects.filter_by_role(request.user)  # type: ignore
                 .filter(monitoring_type_filter)
                 .filter(client_site_filter)
                 .defer(*AGENT_DEFER)
-                .select_related(
-                    "site__server_policy",
-                    "site__workstation_policy",
-                    "site__client__server_policy",
-                    "site__client__workstation_policy",
-                    "policy",
-                    "alert_template",
-                )
-                .prefetch_related(
-                    Prefetch(
-                        "agentchecks",
-                        queryset=Check.objects.select_related("script"),
+                .select_related("site__client", "alert_template")
+                .annotate(
+                    client_name=F("site__client__name"),
+                    site_name=F("site__name"),
+                    agent_status=Case(
+                        When(last_seen__gte=offline, then=Value(AGENT_STATUS_ONLINE)),
+                        When(last_seen__lt=overdue, then=Value(AGENT_STATUS_OVERDUE)),
+                        default=Value(AGENT_STATUS_OFFLINE),
                     ),
-                    Prefetch(
-                        "checkresults",
-                        queryset=CheckResult.objects.select_related("assigned_check"),
+                    pending_actions_count=Coalesce(
+                        Subquery(
+                            PendingAction.objects.filter(
+                                agent_id=OuterRef("pk"), status=PAStatus.PENDING
+                            )
+                            .order_by()
+                            .values("agent_id")
+                            .annotate(count=Count("pk"))
+                            .values("count")
+                        ),
+                        0,
                     ),
-                )
-                .annotate(
-                    pending_actions_count=Count(
-                        "pendingactions",
-                        filter=Q(pendingactions__status=PAStatus.PENDING),
-                    )
-                )
-                .annotate(
                     has_patches_pending=Exists(
                         WinUpdate.objects.filter(
                             agent_id=OuterRef("pk"), action="approve", installed=False
                         )
-                    )
+                    ),
                 )
             )
-            serializer = AgentTableSerializer(agents, many=True)
+
+            params = request.query_params
+            if "status" in params:
+                agents = agents.filter(agent_status=params["status"])
+            if "failing_checks" in params:
+                failing = Q(checks_failing__gt=0) | Q(checks_warning__gt=0)
+                agents = agents.filter(
+                    failing if params["failing_checks"] == "true" else ~failing
+                )
+            if "needs_reboot" in params:
+                agents = agents.filter(needs_reboot=params["needs_reboot"] == "true")
+            if "pending_actions" in params:
+                pending = Q(pending_actions_count__gt=0)
+                agents = agents.filter(
+                    pending if params["pending_actions"] == "true" else ~pending
+                )
+
+            # cursor pagination when asked for, otherwise the whole table is streamed
+            if "cursor" in params or "page_size" in params:
+                paginator = AgentTablePagination()
+                page = paginator.paginate_queryset(agents, request, view=self)
+                return paginator.get_paginated_response(
+                    AgentTableSerializer(page, many=True).data
+                )
+
+            return stream_json_list(
+                AgentTableSerializer,
+                agents.order_by(
+                    *AgentTablePagination().get_ordering(request, agents, self)
+                ),
+            )
 
         # if detail=false
         else:
@@ -216,7 +289,8 @@ class GetUpdateDeleteAgent(APIView):
         name = agent.hostname
         mesh_id = agent.mesh_node_id
         agent.delete()
-        reload_nats()
+        schedule_nats_reload()
+        schedule_dash_counts()
         uri = get_mesh_ws_url()
         asyncio.run(remove_mesh_agent(uri, mesh_id))
         return Response(f"{name} will now be uninstalled.")
@@ -320,16 +394,14 @@ def get_agent_versions(request):
 @api_view(["POST"])
 @permission_classes([IsAuthenticated, UpdateAgentPerms])
 def update_agents(request):
-    q = (
+    agent_ids: list[str] = list(
         Agent.objects.filter_by_role(request.user)  # type: ignore
-        .filter(agent_id__in=request.data["agent_ids"])
-        .only("agent_id", "version")
+        .filter(
+            agent_id__in=request.data["agent_ids"],
+            version_number__lt=version_to_int(settings.LATEST_AGENT_VER),
+        )
+        .values_list("agent_id", flat=True)
     )
-    agent_ids: list[str] = [
-        i.agent_id
-        for i in q
-        if pyver.parse(i.version) < pyver.parse(settings.LATEST_AGENT_VER)
-    ]
     send_agent_update_task.delay(agent_ids=agent_ids)
     return Response("ok")
 
@@ -870,7 +942,7 @@ def bulk(request):
     elif request.data["osType"] == AgentPlat.LINUX:
         q = q.filter(plat=AgentPlat.LINUX)
 
-    agents: list[int] = [agent.pk for agent in q]
+    agents: list[int] = list(q.values_list("pk", flat=True))
 
     if not agents:
         return notify_error("No agents where found meeting the selected criteria")
@@ -931,20 +1003,22 @@ def agent_maintenance(request):
         if not _has_perm_on_client(request.user, request.data["id"]):
             raise PermissionDenied()
 
-        count = (
-            Agent.objects.filter_by_role(request.user)  # type: ignore
-            .filter(site__client_id=request.data["id"])
-            .update(maintenance_mode=request.data["action"])
+        count = Agent.set_maintenance_mode(
+            Agent.objects.filter_by_role(request.user).filter(  # type: ignore
+                site__client_id=request.data["id"]
+            ),
+            request.data["action"],
         )
 
     elif request.data["type"] == "Site":
         if not _has_perm_on_site(request.user, request.data["id"]):
             raise PermissionDenied()
 
-        count = (
-            Agent.objects.filter_by_role(request.user)  # type: ignore
-            .filter(site_id=request.data["id"])
-            .update(maintenance_mode=request.data["action"])
+        count = Agent.set_maintenance_mode(
+            Agent.objects.filter_by_role(request.user).filter(  # type: ignore
+                site_id=request.data["id"]
+            ),
+            request.data["action"],
         )
 
     else:
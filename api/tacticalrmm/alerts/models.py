@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import re
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union, cast
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Union, cast
 
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.db import models
 from django.db.models.fields import BooleanField, PositiveIntegerField
 from django.utils import timezone as djangotime
@@ -13,6 +15,7 @@ from tacticalrmm.constants import (
     AgentMonType,
     AlertSeverity,
     AlertType,
+    CheckStatus,
     CheckType,
     DebugLogType,
 )
@@ -25,6 +28,10 @@ if TYPE_CHECKING:
     from clients.models import Client, Site
 
 
+def alert_action_key(pk: int, resolved: bool) -> str:
+    return f"alert_action_{pk}_{'resolved' if resolved else 'failure'}"
+
+
 class Alert(models.Model):
     objects = PermissionQuerySet.as_manager()
 
@@ -145,6 +152,77 @@ class Alert(models.Model):
             except cls.DoesNotExist:
                 return None
 
+    @classmethod
+    def create_availability_alerts(cls, agents: Sequence[Agent]) -> List[Alert]:
+        # agents are expected to have site__client and alert_template selected
+        return cls.objects.bulk_create(
+            [
+                cls(
+                    agent=agent,
+                    alert_type=AlertType.AVAILABILITY,
+                    severity=AlertSeverity.ERROR,
+                    message=f"{agent.hostname} in {agent.client.name}\\{agent.site.name} is overdue.",
+                    hidden=True,
+                )
+                for agent in agents
+                if agent.should_create_alert(agent.alert_template)
+            ]
+        )
+
+    @classmethod
+    def handle_check_alerts(cls, agent: Agent, results: Sequence[CheckResult]) -> None:
+        # alert handling for a batch of check results from one agent, with the open alerts
+        # loaded in one query. failing results have already reached fails_b4_alert
+        if not results:
+            return
+
+        alerts: Dict[int, Alert] = {}
+        for alert in cls.objects.filter(
+            agent=agent,
+            assigned_check_id__in=[result.assigned_check_id for result in results],
+            resolved=False,
+        ).order_by("pk"):
+            # keep the latest alert and resolve any others
+            if alert.assigned_check_id in alerts:
+                alerts[alert.assigned_check_id].resolve()
+            alerts[alert.assigned_check_id] = alert
+
+        for alert in cls.objects.bulk_create(
+            [
+                cls(
+                    assigned_check=result.assigned_check,
+                    agent=agent,
+                    alert_type=AlertType.CHECK,
+                    severity=result.assigned_check.alert_severity
+                    if result.assigned_check.check_type
+                    not in [
+                        CheckType.MEMORY,
+                        CheckType.CPU_LOAD,
+                        CheckType.DISK_SPACE,
+                        CheckType.SCRIPT,
+                    ]
+                    else result.alert_severity,
+                    message=f"{agent.hostname} has a {result.assigned_check.check_type} check: {result.assigned_check.readable_desc} that failed.",
+                    hidden=True,
+                )
+                for result in results
+                if result.status == CheckStatus.FAILING
+                and result.assigned_check_id not in alerts
+                and result.assigned_check.should_create_alert(agent.alert_template)
+            ]
+        ):
+            alerts[alert.assigned_check_id] = alert
+
+        for result in results:
+            alert = alerts.get(result.assigned_check_id)
+            if not alert:
+                continue
+
+            if result.status == CheckStatus.FAILING:
+                cls.handle_alert_failure(result, alert=alert)
+            else:
+                cls.handle_alert_resolve(result, alert=alert)
+
     @classmethod
     def create_or_return_check_alert(
         cls,
@@ -266,7 +344,9 @@ class Alert(models.Model):
 
     @classmethod
     def handle_alert_failure(
-        cls, instance: Union[Agent, TaskResult, CheckResult]
+        cls,
+        instance: Union[Agent, TaskResult, CheckResult],
+        alert: Optional[Alert] = None,
     ) -> None:
         from agents.models import Agent
         from autotasks.models import TaskResult
@@ -297,7 +377,6 @@ class Alert(models.Model):
             alert_template = instance.alert_template
             maintenance_mode = instance.maintenance_mode
             alert_severity = AlertSeverity.ERROR
-            agent = instance
             dashboard_severities = [AlertSeverity.ERROR]
             email_severities = [AlertSeverity.ERROR]
             text_severities = [AlertSeverity.ERROR]
@@ -335,7 +414,6 @@ class Alert(models.Model):
                 ]
                 else instance.alert_severity
             )
-            agent = instance.agent
 
             # set alert_template settings
             if alert_template:
@@ -376,7 +454,6 @@ class Alert(models.Model):
             alert_template = instance.agent.alert_template
             maintenance_mode = instance.agent.maintenance_mode
             alert_severity = instance.task.alert_severity
-            agent = instance.agent
 
             # set alert_template settings
             if alert_template:
@@ -404,7 +481,8 @@ class Alert(models.Model):
         else:
             return
 
-        alert = instance.get_or_create_alert_if_needed(alert_template)
+        if not alert:
+            alert = instance.get_or_create_alert_if_needed(alert_template)
 
         # return if agent is in maintenance mode
         if not alert or maintenance_mode:
@@ -425,8 +503,9 @@ class Alert(models.Model):
                 and dashboard_severities
                 and alert.severity in dashboard_severities
             ):
-                alert.hidden = False
-                alert.save(update_fields=["hidden"])
+                if alert.hidden:
+                    alert.hidden = False
+                    alert.save(update_fields=["hidden"])
 
         # send email if enabled
         if email_alert or always_email:
@@ -462,33 +541,13 @@ class Alert(models.Model):
             and run_script_action
             and not alert.action_run
         ):
-            r = agent.run_script(
-                scriptpk=alert_template.action.pk,
-                args=alert.parse_script_args(alert_template.action_args),
-                timeout=alert_template.action_timeout,
-                wait=True,
-                full=True,
-                run_on_any=True,
-            )
-
-            # command was successful
-            if isinstance(r, dict):
-                alert.action_retcode = r["retcode"]
-                alert.action_stdout = r["stdout"]
-                alert.action_stderr = r["stderr"]
-                alert.action_execution_time = "{:.4f}".format(r["execution_time"])
-                alert.action_run = djangotime.now()
-                alert.save()
-            else:
-                DebugLog.error(
-                    agent=agent,
-                    log_type=DebugLogType.SCRIPTING,
-                    message=f"Failure action: {alert_template.action.name} failed to run on any agent for {agent.hostname}({agent.pk}) failure alert",
-                )
+            alert.queue_script_action(alert_template.action_timeout)
 
     @classmethod
     def handle_alert_resolve(
-        cls, instance: Union[Agent, TaskResult, CheckResult]
+        cls,
+        instance: Union[Agent, TaskResult, CheckResult],
+        alert: Optional[Alert] = None,
     ) -> None:
         from agents.models import Agent
         from autotasks.models import TaskResult
@@ -533,7 +592,6 @@ class Alert(models.Model):
 
             alert_template = instance.agent.alert_template
             maintenance_mode = instance.agent.maintenance_mode
-            agent = instance.agent
 
             if alert_template:
                 email_on_resolved = alert_template.check_email_on_resolved
@@ -551,7 +609,6 @@ class Alert(models.Model):
 
             alert_template = instance.agent.alert_template
             maintenance_mode = instance.agent.maintenance_mode
-            agent = instance.agent
 
             if alert_template:
                 email_on_resolved = alert_template.task_email_on_resolved
@@ -561,7 +618,8 @@ class Alert(models.Model):
         else:
             return
 
-        alert = instance.get_or_create_alert_if_needed(alert_template)
+        if not alert:
+            alert = instance.get_or_create_alert_if_needed(alert_template)
 
         # return if agent is in maintenance mode
         if not alert or maintenance_mode:
@@ -584,31 +642,19 @@ class Alert(models.Model):
             and run_script_action
             and not alert.resolved_action_run
         ):
-            r = agent.run_script(
-                scriptpk=alert_template.resolved_action.pk,
-                args=alert.parse_script_args(alert_template.resolved_action_args),
-                timeout=alert_template.resolved_action_timeout,
-                wait=True,
-                full=True,
-                run_on_any=True,
+            alert.queue_script_action(
+                alert_template.resolved_action_timeout, resolved=True
             )
 
-            # command was successful
-            if isinstance(r, dict):
-                alert.resolved_action_retcode = r["retcode"]
-                alert.resolved_action_stdout = r["stdout"]
-                alert.resolved_action_stderr = r["stderr"]
-                alert.resolved_action_execution_time = "{:.4f}".format(
-                    r["execution_time"]
-                )
-                alert.resolved_action_run = djangotime.now()
-                alert.save()
-            else:
-                DebugLog.error(
-                    agent=agent,
-                    log_type=DebugLogType.SCRIPTING,
-                    message=f"Resolved action: {alert_template.action.name} failed to run on any agent for {agent.hostname}({agent.pk}) resolved alert",
-                )
+    def queue_script_action(self, timeout: int, resolved: bool = False) -> None:
+        from alerts.tasks import run_alert_action_task
+
+        # a failing check reports on every run, the key makes sure the action is only queued once
+        # it expires on its own in case the worker dies, allowing for some time in the queue
+        if cache.add(alert_action_key(self.pk, resolved), 1, timeout + 600):
+            run_alert_action_task.apply_async(
+                args=(self.pk, resolved), queue=settings.ALERT_ACTION_QUEUE
+            )
 
     def parse_script_args(self, args: List[str]) -> List[str]:
 
@@ -1,9 +1,16 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone as djangotime
 
 from agents.models import Agent
+from logs.models import DebugLog
 from tacticalrmm.celery import app
+from tacticalrmm.constants import DebugLogType
 
-from .models import Alert
+from .models import Alert, alert_action_key
+from .utils import get_alert_template_agents_filter, resolve_alert_templates
 
 
 @app.task
@@ -16,13 +23,44 @@ def unsnooze_alerts() -> str:
 
 
 @app.task
-def cache_agents_alert_template() -> str:
-    for agent in Agent.objects.only(
-        "pk", "site", "policy", "alert_template"
-    ).select_related("site", "policy", "alert_template"):
-        agent.set_alert_template()
+def cache_agents_alert_template(
+    alert_template: Optional[int] = None,
+    policy: Optional[int] = None,
+    site: Optional[int] = None,
+    client: Optional[int] = None,
+    agents: Optional[List[int]] = None,
+) -> str:
+    # only agents that the changed alert template, policy, site or client can affect,
+    # or just the agents given. nothing passed means everything is checked
+    qs = Agent.objects.only(
+        "pk",
+        "site",
+        "policy",
+        "monitoring_type",
+        "block_policy_inheritance",
+        "alert_template",
+    )
+    if agents is not None:
+        qs = qs.filter(pk__in=agents)
+    else:
+        affected = get_alert_template_agents_filter(
+            alert_template=alert_template, policy=policy, site=site, client=client
+        )
+        if affected is not None:
+            qs = qs.filter(affected)
 
-    return "ok"
+    agent_list = list(qs)
+    resolved = resolve_alert_templates(agent_list)
+
+    changed = []
+    for agent in agent_list:
+        if agent.alert_template_id != resolved[agent.pk]:
+            agent.alert_template_id = resolved[agent.pk]
+            changed.append(agent)
+
+    Agent.objects.bulk_update(changed, ["alert_template"], batch_size=1000)
+
+    return f"{len(changed)} of {len(agent_list)} agents updated"
 
 
 @app.task
@@ -32,3 +70,101 @@ def prune_resolved_alerts(older_than_days: int) -> str:
     ).delete()
 
     return "ok"
+
+
+def _acquire_alert_action_slot(timeout: int) -> Optional[str]:
+    # slots expire on their own so a killed worker can't hold one forever
+    for i in range(settings.ALERT_ACTION_CONCURRENCY):
+        key = f"alert_action_slot_{i}"
+        if cache.add(key, 1, timeout):
+            return key
+
+    return None
+
+
+@app.task(bind=True, max_retries=settings.ALERT_ACTION_MAX_RETRIES)
+def run_alert_action_task(self, pk: int, resolved: bool = False) -> str:
+    try:
+        alert = Alert.objects.select_related(
+            "agent__alert_template__action", "agent__alert_template__resolved_action"
+        ).get(pk=pk)
+    except Alert.DoesNotExist:
+        cache.delete(alert_action_key(pk, resolved))
+        return "alert does not exist"
+
+    agent = alert.agent
+    alert_template = agent.alert_template if agent else None
+    if resolved:
+        action = alert_template.resolved_action if alert_template else None
+        already_run = alert.resolved_action_run
+    else:
+        action = alert_template.action if alert_template else None
+        already_run = alert.action_run
+
+    if not action or already_run:
+        cache.delete(alert_action_key(pk, resolved))
+        return "ok"
+
+    if resolved:
+        args = alert_template.resolved_action_args
+        timeout = alert_template.resolved_action_timeout
+    else:
+        args = alert_template.action_args
+        timeout = alert_template.action_timeout
+
+    slot = _acquire_alert_action_slot(timeout + 60)
+    if not slot:
+        if self.request.retries >= self.max_retries:
+            # the next failure or resolve is free to queue it again
+            cache.delete(alert_action_key(pk, resolved))
+            DebugLog.error(
+                agent=agent,
+                log_type=DebugLogType.SCRIPTING,
+                message=f"{'Resolved' if resolved else 'Failure'} action: {action.name} for {agent.hostname}({agent.pk}) {'resolved' if resolved else 'failure'} alert was dropped after waiting too long for a free slot",
+            )
+            return "dropped"
+
+        # keeps the action from being queued again while it waits
+        cache.set(alert_action_key(pk, resolved), 1, timeout + 600)
+        raise self.retry(countdown=10)
+
+    try:
+        r = agent.run_script(
+            scriptpk=action.pk,
+            args=alert.parse_script_args(args),
+            timeout=timeout,
+            wait=True,
+            full=True,
+            run_on_any=True,
+        )
+    except Exception:
+        cache.delete(alert_action_key(pk, resolved))
+        raise
+    finally:
+        cache.delete(slot)
+
+    # command was successful
+    if isinstance(r, dict):
+        # only the fields of this action, the row may have been resolved, snoozed or had
+        # the other action run since it was loaded
+        prefix = "resolved_action" if resolved else "action"
+        Alert.objects.filter(pk=pk).update(
+            **{
+                f"{prefix}_retcode": r["retcode"],
+                f"{prefix}_stdout": r["stdout"],
+                f"{prefix}_stderr": r["stderr"],
+                f"{prefix}_execution_time": "{:.4f}".format(r["execution_time"]),
+                f"{prefix}_run": djangotime.now(),
+            }
+        )
+    else:
+        DebugLog.error(
+            agent=agent,
+            log_type=DebugLogType.SCRIPTING,
+            message=f"{'Resolved' if resolved else 'Failure'} action: {action.name} failed to run on any agent for {agent.hostname}({agent.pk}) {'resolved' if resolved else 'failure'} alert",
+        )
+
+    # released only once the run is recorded so it can't be queued again in between
+    cache.delete(alert_action_key(pk, resolved))
+
+    return "ok"
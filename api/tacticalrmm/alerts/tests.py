@@ -2,10 +2,14 @@ from datetime import datetime, timedelta
 from itertools import cycle
 from unittest.mock import patch
 
+from celery.exceptions import Retry
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
 from django.utils import timezone as djangotime
 from model_bakery import baker, seq
 
+from agents.models import Agent
 from alerts.tasks import cache_agents_alert_template
 from autotasks.models import TaskResult
 from core.tasks import cache_db_fields_task, handle_resolved_stuff
@@ -13,7 +17,7 @@ from core.utils import get_core_settings
 from tacticalrmm.constants import AgentMonType, AlertSeverity, AlertType, CheckStatus
 from tacticalrmm.test import TacticalTestCase
 
-from .models import Alert, AlertTemplate
+from .models import Alert, AlertTemplate, alert_action_key
 from .serializers import (
     AlertSerializer,
     AlertTemplateRelationSerializer,
@@ -494,6 +498,56 @@ class TestAlertTasks(TacticalTestCase):
         self.assertEqual(workstation.set_alert_template().pk, alert_templates[1].pk)
         self.assertEqual(server.set_alert_template().pk, alert_templates[2].pk)
 
+    def test_cache_agents_alert_template(self):
+        core = get_core_settings()
+        alert_templates = baker.make("alerts.AlertTemplate", _quantity=4)
+        policy = baker.make("automation.Policy", active=True)
+        policy.alert_template = alert_templates[0]
+        policy.save()
+
+        sites = baker.make("clients.Site", _quantity=3)
+        agents = baker.make_recipe("agents.agent", site=cycle(sites), _quantity=12)
+
+        core.alert_template = alert_templates[1]
+        core.save()
+        sites[0].alert_template = alert_templates[2]
+        sites[0].workstation_policy = policy
+        sites[0].save()
+        sites[1].client.alert_template = alert_templates[3]
+        sites[1].client.save()
+        alert_templates[2].excluded_agents.set([agents[0]])
+        alert_templates[3].exclude_servers = True
+        alert_templates[3].save()
+        agents[1].policy = policy
+        agents[1].save()
+
+        self.assertEqual(
+            cache_agents_alert_template(),
+            f"{len(agents)} of {len(agents)} agents updated",
+        )
+        for agent in agents:
+            cached = Agent.objects.get(pk=agent.pk).alert_template
+            self.assertEqual(cached, agent.set_alert_template())
+
+        # nothing changed so nothing is written
+        self.assertEqual(
+            cache_agents_alert_template(), f"0 of {len(agents)} agents updated"
+        )
+
+        # only agents on the changed site are looked at
+        self.assertEqual(
+            cache_agents_alert_template(site=sites[2].pk),
+            f"0 of {Agent.objects.filter(site=sites[2]).count()} agents updated",
+        )
+
+        # deleting a template only touches the agents using it
+        using = list(alert_templates[2].agents.values_list("pk", flat=True))
+        alert_templates[2].delete()
+        cache_agents_alert_template(agents=using)
+        for agent in Agent.objects.filter(pk__in=using):
+            self.assertEqual(agent.alert_template, agent.set_alert_template())
+
+    @patch("core.tasks.publish_dash_counts_task.apply_async")
     @patch("agents.tasks.sleep")
     @patch("core.models.CoreSettings.send_mail")
     @patch("core.models.CoreSettings.send_sms")
@@ -510,6 +564,7 @@ class TestAlertTasks(TacticalTestCase):
         send_sms,
         send_email,
         sleep,
+        publish_dash_counts,
     ):
         from agents.models import Agent
         from agents.tasks import (
@@ -1365,16 +1420,31 @@ class TestAlertTasks(TacticalTestCase):
 
         core.send_sms("Test", alert_template=alert_template)
 
+    @patch("core.tasks.publish_dash_counts_task.apply_async")
+    @patch("alerts.tasks.run_alert_action_task.apply_async")
     @patch("agents.models.Agent.nats_cmd")
     @patch("agents.tasks.agent_outage_sms_task.delay")
     @patch("agents.tasks.agent_outage_email_task.delay")
     @patch("agents.tasks.agent_recovery_email_task.delay")
     @patch("agents.tasks.agent_recovery_sms_task.delay")
     def test_alert_actions(
-        self, recovery_sms, recovery_email, outage_email, outage_sms, nats_cmd
+        self,
+        recovery_sms,
+        recovery_email,
+        outage_email,
+        outage_sms,
+        nats_cmd,
+        run_alert_action,
+        publish_dash_counts,
     ):
 
         from agents.tasks import agent_outages_task
+        from alerts.tasks import run_alert_action_task
+
+        # run the queued action inline
+        run_alert_action.side_effect = lambda args, **kwargs: run_alert_action_task(
+            *args
+        )
 
         # Setup cmd mock
         success = {
@@ -1427,6 +1497,10 @@ class TestAlertTasks(TacticalTestCase):
         }
 
         nats_cmd.assert_called_with(data, timeout=30, wait=True)
+        run_alert_action.assert_called_once_with(
+            args=(Alert.objects.get(agent=agent).pk, False),
+            queue=settings.ALERT_ACTION_QUEUE,
+        )
 
         nats_cmd.reset_mock()
 
@@ -1507,6 +1581,143 @@ class TestAlertTasks(TacticalTestCase):
 
         self.assertEqual(Alert.objects.count(), 31)
 
+    @patch("core.tasks.publish_dash_counts_task.apply_async")
+    @patch("alerts.models.Alert.handle_alert_failure")
+    def test_agent_outages_task_skips_alerted_agents(
+        self, handle_alert_failure, publish_dash_counts
+    ):
+        from agents.tasks import agent_outages_task
+
+        baker.make_recipe("agents.online_agent", overdue_dashboard_alert=True)
+        new_overdue = baker.make_recipe(
+            "agents.overdue_agent", overdue_dashboard_alert=True
+        )
+        already_alerted = baker.make_recipe(
+            "agents.overdue_agent", overdue_dashboard_alert=True
+        )
+        baker.make(
+            "alerts.Alert",
+            agent=already_alerted,
+            alert_type=AlertType.AVAILABILITY,
+            resolved=False,
+        )
+        # won't get an alert since no alerting is configured
+        baker.make_recipe("agents.overdue_agent")
+
+        agent_outages_task()
+
+        handle_alert_failure.assert_called_once()
+        self.assertEqual(handle_alert_failure.call_args.args[0].pk, new_overdue.pk)
+        # newly overdue agents push the dashboard counts
+        publish_dash_counts.assert_called_once_with(
+            countdown=settings.DASH_INFO_DEBOUNCE
+        )
+        self.assertTrue(
+            Alert.objects.filter(
+                agent=new_overdue, alert_type=AlertType.AVAILABILITY, resolved=False
+            ).exists()
+        )
+        self.assertEqual(Alert.objects.count(), 2)
+
+        # periodic notifications still need the already alerted agents
+        handle_alert_failure.reset_mock()
+        alert_template = baker.make(
+            "alerts.AlertTemplate", is_active=True, agent_periodic_alert_days=2
+        )
+        already_alerted.alert_template = alert_template
+        already_alerted.save(update_fields=["alert_template"])
+
+        agent_outages_task()
+
+        handle_alert_failure.assert_called_once()
+        self.assertEqual(handle_alert_failure.call_args.args[0].pk, already_alerted.pk)
+        self.assertEqual(Alert.objects.count(), 2)
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    @patch("agents.models.Agent.nats_cmd")
+    def test_alert_action_waits_for_a_slot(self, nats_cmd):
+        from alerts.tasks import run_alert_action_task
+        from logs.models import DebugLog
+
+        agent = baker.make_recipe("agents.agent")
+        agent.alert_template = baker.make(
+            "alerts.AlertTemplate",
+            is_active=True,
+            action=baker.make_recipe("scripts.script"),
+            action_timeout=30,
+        )
+        agent.save(update_fields=["alert_template"])
+        alert = baker.make("alerts.Alert", agent=agent)
+        key = alert_action_key(alert.pk, False)
+        self.addCleanup(cache.clear)
+
+        for i in range(settings.ALERT_ACTION_CONCURRENCY):
+            cache.set(f"alert_action_slot_{i}", 1)
+
+        # waiting for a slot keeps the action from being queued again
+        with patch.object(run_alert_action_task, "retry", side_effect=Retry()):
+            with self.assertRaises(Retry):
+                run_alert_action_task(alert.pk)
+        self.assertTrue(cache.get(key))
+
+        # gives up after the last retry
+        result = run_alert_action_task.apply(
+            args=(alert.pk,), retries=settings.ALERT_ACTION_MAX_RETRIES
+        )
+        self.assertEqual(result.get(), "dropped")
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(DebugLog.objects.filter(agent=agent).exists())
+        nats_cmd.assert_not_called()
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    @patch("agents.models.Agent.nats_cmd")
+    def test_alert_action_saves_only_its_results(self, nats_cmd):
+        from alerts.tasks import run_alert_action_task
+
+        agent = baker.make_recipe("agents.agent")
+        agent.alert_template = baker.make(
+            "alerts.AlertTemplate",
+            is_active=True,
+            action=baker.make_recipe("scripts.script"),
+            action_timeout=30,
+        )
+        agent.save(update_fields=["alert_template"])
+        alert = baker.make("alerts.Alert", agent=agent, resolved=False)
+        key = alert_action_key(alert.pk, False)
+        self.addCleanup(cache.clear)
+        cache.set(key, 1)
+
+        key_held = []
+
+        def run(data, **kwargs):
+            if data["func"] != "runscriptfull":
+                return "pong"
+
+            # the alert is resolved while the action is running
+            Alert.objects.get(pk=alert.pk).resolve()
+            key_held.append(cache.get(key))
+            return {
+                "retcode": 0,
+                "stdout": "done",
+                "stderr": "",
+                "execution_time": 1.0,
+            }
+
+        nats_cmd.side_effect = run
+        run_alert_action_task(alert.pk)
+
+        alert.refresh_from_db()
+        self.assertTrue(alert.resolved)
+        self.assertEqual(alert.action_stdout, "done")
+        self.assertIsNotNone(alert.action_run)
+        # the key is held until the run is recorded
+        self.assertEqual(key_held, [1])
+        self.assertIsNone(cache.get(key))
+
 
 class TestAlertPermissions(TacticalTestCase):
     def setUp(self):
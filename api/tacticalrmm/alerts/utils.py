@@ -0,0 +1,158 @@
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+from django.db.models import Q
+
+from automation.utils import get_policy_graph, resolve_policy_ids
+from core.utils import get_core_settings
+from tacticalrmm.constants import AgentMonType
+
+if TYPE_CHECKING:
+    from agents.models import Agent
+
+
+def _policy_agents_filter(policy: int) -> Optional[Q]:
+    # None means every agent can inherit the policy
+    core = get_core_settings()
+    if policy in (core.server_policy_id, core.workstation_policy_id):
+        return None
+
+    return (
+        Q(policy_id=policy)
+        | Q(site__server_policy_id=policy)
+        | Q(site__workstation_policy_id=policy)
+        | Q(site__client__server_policy_id=policy)
+        | Q(site__client__workstation_policy_id=policy)
+    )
+
+
+def _template_agents_filter(alert_template: int) -> Optional[Q]:
+    from automation.models import Policy
+
+    if get_core_settings().alert_template_id == alert_template:
+        return None
+
+    ret = (
+        Q(alert_template_id=alert_template)
+        | Q(site__alert_template_id=alert_template)
+        | Q(site__client__alert_template_id=alert_template)
+    )
+    for policy in Policy.objects.filter(alert_template_id=alert_template).values_list(
+        "pk", flat=True
+    ):
+        policy_filter = _policy_agents_filter(policy)
+        if policy_filter is None:
+            return None
+        ret |= policy_filter
+
+    return ret
+
+
+def get_alert_template_agents_filter(
+    alert_template: Optional[int] = None,
+    policy: Optional[int] = None,
+    site: Optional[int] = None,
+    client: Optional[int] = None,
+) -> Optional[Q]:
+    # agents whose alert template can change when one of these objects changes.
+    # None means all agents
+    filters: List[Optional[Q]] = []
+    if alert_template:
+        filters.append(_template_agents_filter(alert_template))
+    if policy:
+        filters.append(_policy_agents_filter(policy))
+    if site:
+        filters.append(Q(site_id=site))
+    if client:
+        filters.append(Q(site__client_id=client))
+
+    if not filters or None in filters:
+        return None
+
+    ret = Q()
+    for i in filters:
+        ret |= i
+
+    return ret
+
+
+def resolve_alert_templates(agents: "Sequence[Agent]") -> Dict[int, Optional[int]]:
+    # same result as Agent.set_alert_template for a batch of agents, in a fixed number of queries.
+    # agents need pk, site_id, policy_id, monitoring_type and block_policy_inheritance
+    from automation.models import Policy
+    from clients.models import Site
+
+    from .models import AlertTemplate
+
+    core = get_core_settings()
+    _, graph = get_policy_graph()
+
+    templates: Dict[int, Dict[Any, Any]] = {
+        pk: {
+            "active": active,
+            AgentMonType.WORKSTATION: bool(exclude_workstations),
+            AgentMonType.SERVER: bool(exclude_servers),
+            "agent": set(),
+            "site": set(),
+            "client": set(),
+        }
+        for pk, active, exclude_workstations, exclude_servers in AlertTemplate.objects.values_list(
+            "pk", "is_active", "exclude_workstations", "exclude_servers"
+        )
+    }
+    for field, through in (
+        ("agent", AlertTemplate.excluded_agents.through),
+        ("site", AlertTemplate.excluded_sites.through),
+        ("client", AlertTemplate.excluded_clients.through),
+    ):
+        for template, pk in through.objects.values_list(
+            "alerttemplate_id", f"{field}_id"
+        ):
+            templates[template][field].add(pk)
+
+    policies = dict(
+        Policy.objects.filter(active=True).values_list("pk", "alert_template_id")
+    )
+    sites = {
+        pk: (client, site_template, client_template)
+        for pk, client, site_template, client_template in Site.objects.values_list(
+            "pk", "client_id", "alert_template_id", "client__alert_template_id"
+        )
+    }
+
+    # templates that apply to a policy/site combination before agent exclusions
+    candidates: Dict[Tuple[Any, ...], List[int]] = {}
+    ret = {}
+    for agent in agents:
+        policy_ids = resolve_policy_ids(agent, graph)
+        key = (*policy_ids.values(), agent.site_id, agent.monitoring_type)
+
+        if key not in candidates:
+            client, site_template, client_template = sites[agent.site_id]
+
+            chain = []
+            for policy_key, pk in policy_ids.items():
+                # default alert template overrides a default policy with one applied
+                if "default" in policy_key:
+                    chain.append(core.alert_template_id)
+                chain.append(policies.get(pk))
+                if "site" in policy_key:
+                    chain.append(site_template)
+                elif "client" in policy_key:
+                    chain.append(client_template)
+
+            candidates[key] = [
+                pk
+                for pk in chain
+                if pk
+                and templates[pk]["active"]
+                and not templates[pk][agent.monitoring_type]
+                and agent.site_id not in templates[pk]["site"]
+                and client not in templates[pk]["client"]
+            ]
+
+        ret[agent.pk] = next(
+            (pk for pk in candidates[key] if agent.pk not in templates[pk]["agent"]),
+            None,
+        )
+
+    return ret
@@ -204,9 +204,6 @@ class GetAddAlertTemplates(APIView):
         serializer.is_valid(raise_exception=True)
         serializer.save()
 
-        # cache alert_template value on agents
-        cache_agents_alert_template.delay()
-
         return Response("ok")
 
 
@@ -228,15 +225,18 @@ class GetUpdateDeleteAlertTemplate(APIView):
         serializer.save()
 
         # cache alert_template value on agents
-        cache_agents_alert_template.delay()
+        cache_agents_alert_template.delay(alert_template=pk)
 
         return Response("ok")
 
     def delete(self, request, pk):
-        get_object_or_404(AlertTemplate, pk=pk).delete()
+        alert_template = get_object_or_404(AlertTemplate, pk=pk)
+        # only the agents using it can end up with a different template
+        agents = list(alert_template.agents.values_list("pk", flat=True))
+        alert_template.delete()
 
         # cache alert_template value on agents
-        cache_agents_alert_template.delay()
+        cache_agents_alert_template.delay(agents=agents)
 
         return Response("ok")
 
@@ -1,3 +1,5 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone as djangotime
 from model_bakery import baker
 
@@ -296,3 +298,89 @@ class TestAPIv3(TacticalTestCase):
             AgentCustomField.objects.get(field=multiple, agent=task.agent).value,
             ["this"],
         )
+
+    def test_winupdates_post(self):
+        from winupdate.models import WinUpdate
+
+        url = "/api/v3/winupdates/"
+
+        def wua_update(guid, kb, title, installed=False):
+            return {
+                "guid": guid,
+                "kb_article_ids": [kb],
+                "title": title,
+                "installed": installed,
+                "downloaded": installed,
+                "description": "",
+                "severity": "Important",
+                "categories": [],
+                "category_ids": [],
+                "more_info_urls": [],
+                "support_url": "",
+                "revision_number": 200,
+            }
+
+        r = self.client.post(
+            url, {"agent_id": self.agent.agent_id, "wua_updates": []}, format="json"
+        )
+        self.assertEqual(r.status_code, 400)
+
+        existing = baker.make(
+            "winupdate.WinUpdate",
+            agent=self.agent,
+            guid="guid1",
+            kb="KB111",
+            title="Definition Update (Version 1.2.0)",
+        )
+        updates = [
+            wua_update("guid1", "111", "Definition Update (Version 1.2.0)", True),
+            wua_update("guid2", "111", "Definition Update (Version 1.3.0)"),
+            wua_update("guid3", "222", "Cumulative Update"),
+            {**wua_update("guid4", "333", "No KB"), "kb_article_ids": []},
+        ]
+        r = self.client.post(
+            url,
+            {"agent_id": self.agent.agent_id, "wua_updates": updates},
+            format="json",
+        )
+        self.assertEqual(r.status_code, 200)
+
+        # the older version of KB111 got superseded
+        self.assertFalse(WinUpdate.objects.filter(pk=existing.pk).exists())
+        self.assertEqual(
+            set(self.agent.winupdates.values_list("guid", flat=True)),
+            {"guid2", "guid3"},
+        )
+
+        # only changed updates get written
+        updates[1]["installed"] = True
+        r = self.client.post(
+            url,
+            {"agent_id": self.agent.agent_id, "wua_updates": updates[1:3]},
+            format="json",
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(self.agent.winupdates.get(guid="guid2").installed)
+        self.assertFalse(self.agent.winupdates.get(guid="guid3").installed)
+
+        # the number of queries doesn't depend on the number of updates
+        queries = []
+        for count in (2, 20):
+            agent = baker.make_recipe("agents.agent")
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.post(
+                    url,
+                    {
+                        "agent_id": agent.agent_id,
+                        "wua_updates": [
+                            wua_update(f"guid{i}", str(i), f"Update {i}")
+                            for i in range(count)
+                        ],
+                    },
+                    format="json",
+                )
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(agent.winupdates.count(), count)
+            queries.append(len(ctx))
+
+        self.assertEqual(queries[0], queries[1])
@@ -24,6 +24,7 @@ from core.utils import (
     get_core_settings,
     get_mesh_device_id,
     get_mesh_ws_url,
+    schedule_dash_counts,
 )
 from logs.models import DebugLog, PendingAction
 from software.models import InstalledSoftware
@@ -39,10 +40,19 @@ from tacticalrmm.constants import (
     PAStatus,
 )
 from tacticalrmm.helpers import notify_error
-from tacticalrmm.utils import reload_nats
+from tacticalrmm.utils import schedule_nats_reload
 from winupdate.models import WinUpdate, WinUpdatePolicy
 
 
+def run_check_assigned_tasks(check: Check, agent: Agent) -> None:
+    for task in check.assignedtasks.all():
+        if task.enabled:
+            if task.policy:
+                task.run_win_task(agent)
+            else:
+                task.run_win_task()
+
+
 class CheckIn(APIView):
 
     authentication_classes = [TokenAuthentication]
@@ -57,6 +67,7 @@ class CheckIn(APIView):
             asyncio.run(agent.nats_cmd({"func": "installchoco"}, wait=False))
 
         asyncio.run(agent.nats_cmd({"func": "getwinupdates"}, wait=False))
+        schedule_dash_counts()
         return Response("ok")
 
 
@@ -158,19 +169,34 @@ class WinUpdates(APIView):
             Agent.objects.defer(*AGENT_DEFER), agent_id=request.data["agent_id"]
         )
 
+        # every update the agent already has, keyed by guid, the newest row wins
+        current = list(
+            agent.winupdates.only(  # type: ignore
+                "pk", "agent_id", "guid", "kb", "title", "downloaded", "installed"
+            ).order_by("pk")
+        )
+        existing = {u.guid: u for u in current}
+
+        to_create: "list[WinUpdate]" = []
+        to_update: "dict[int, WinUpdate]" = {}
         for update in updates:
-            if agent.winupdates.filter(guid=update["guid"]).exists():  # type: ignore
-                u = agent.winupdates.filter(guid=update["guid"]).last()  # type: ignore
-                u.downloaded = update["downloaded"]
-                u.installed = update["installed"]
-                u.save(update_fields=["downloaded", "installed"])
+            u = existing.get(update["guid"])
+            if u:
+                if (u.downloaded, u.installed) != (
+                    update["downloaded"],
+                    update["installed"],
+                ):
+                    u.downloaded = update["downloaded"]
+                    u.installed = update["installed"]
+                    if u.pk:
+                        to_update[u.pk] = u
             else:
                 try:
                     kb = "KB" + update["kb_article_ids"][0]
                 except:
                     continue
 
-                WinUpdate(
+                u = WinUpdate(
                     agent=agent,
                     guid=update["guid"],
                     kb=kb,
@@ -185,9 +211,14 @@ class WinUpdates(APIView):
                     more_info_urls=update["more_info_urls"],
                     support_url=update["support_url"],
                     revision_number=update["revision_number"],
-                ).save()
+                )
+                existing[u.guid] = u
+                to_create.append(u)
 
-        agent.delete_superseded_updates()
+        WinUpdate.objects.bulk_create(to_create)
+        WinUpdate.objects.bulk_update(to_update.values(), ["downloaded", "installed"])
+
+        agent.delete_superseded_updates(current + to_create)
         return Response("ok")
 
 
@@ -292,13 +323,94 @@ class CheckRunner(APIView):
             check_result.save()
 
         status = check_result.handle_check(request.data, check, agent)
-        if status == CheckStatus.FAILING and check.assignedtasks.exists():
-            for task in check.assignedtasks.all():
-                if task.enabled:
-                    if task.policy:
-                        task.run_win_task(agent)
-                    else:
-                        task.run_win_task()
+        if status == CheckStatus.FAILING:
+            run_check_assigned_tasks(check, agent)
+
+        return Response("ok")
+
+
+class CheckRunnerResults(APIView):
+    """Receives the results of a whole check run in one request"""
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, agentid):
+        from alerts.models import Alert
+        from checks.models import CheckHistory
+
+        agent = get_object_or_404(
+            Agent.objects.defer(*AGENT_DEFER).select_related(
+                "site__client", "alert_template"
+            ),
+            agent_id=agentid,
+        )
+
+        results = request.data.get("results")
+        if not isinstance(results, list) or not all(
+            isinstance(result, dict) and "id" in result for result in results
+        ):
+            return notify_error("Invalid check results")
+
+        try:
+            data = {int(result["id"]): result for result in results}
+        except (TypeError, ValueError):
+            return notify_error("Invalid check results")
+
+        checks = (
+            Check.objects.defer(*CHECK_DEFER)
+            .select_related("script")
+            .prefetch_related("assignedtasks")
+            .in_bulk(list(data.keys()))
+        )
+
+        check_results = {
+            check_result.assigned_check_id: check_result
+            for check_result in CheckResult.objects.defer(*CHECK_RESULT_DEFER).filter(
+                agent=agent, assigned_check_id__in=checks.keys()
+            )
+        }
+        check_results.update(
+            {
+                check_result.assigned_check_id: check_result
+                for check_result in CheckResult.objects.bulk_create(
+                    [
+                        CheckResult(assigned_check=check, agent=agent)
+                        for pk, check in checks.items()
+                        if pk not in check_results
+                    ]
+                )
+            }
+        )
+
+        history: "list[CheckHistory]" = []
+        pending_alerts: "list[CheckResult]" = []
+        changed = False
+        for pk, check in checks.items():
+            check_result = check_results[pk]
+            # avoid a lookup per result when alerting
+            check_result.agent = agent
+            check_result.assigned_check = check
+
+            prev_state = (check_result.status, check_result.alert_severity)
+            status = check_result.handle_check(
+                data[pk],
+                check,
+                agent,
+                history=history,
+                pending_alerts=pending_alerts,
+                update_summary=False,
+            )
+            changed |= (status, check_result.alert_severity) != prev_state
+
+            if status == CheckStatus.FAILING:
+                run_check_assigned_tasks(check, agent)
+
+        CheckHistory.objects.bulk_create(history)
+        Alert.handle_check_alerts(agent, pending_alerts)
+
+        if changed:
+            agent.update_check_summary()
 
         return Response("ok")
 
@@ -351,6 +463,7 @@ class TaskRunner(APIView):
         except TaskResult.DoesNotExist:
             serializer = TaskResultSerializer(data=request.data, partial=True)
 
+        prev_status = serializer.instance.status if serializer.instance else None
         serializer.is_valid(raise_exception=True)
         task_result = serializer.save(last_run=djangotime.now())
 
@@ -388,6 +501,9 @@ class TaskRunner(APIView):
         else:
             Alert.handle_alert_failure(task_result)
 
+        if status != prev_status:
+            agent.update_check_summary()
+
         return Response("ok")
 
 
@@ -461,7 +577,8 @@ class NewAgent(APIView):
         else:
             WinUpdatePolicy(agent=agent).save()
 
-        reload_nats()
+        schedule_nats_reload()
+        schedule_dash_counts()
 
         # create agent install audit record
         AuditLog.objects.create(
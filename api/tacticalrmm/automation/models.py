@@ -4,6 +4,7 @@ from django.core.cache import cache
 from django.db import models
 
 from agents.models import Agent
+from automation.utils import bump_policy_graph_version
 from clients.models import Client, Site
 from logs.models import BaseAuditModel
 from tacticalrmm.constants import (
@@ -52,21 +53,17 @@ class Policy(BaseAuditModel):
         # check if alert template was changes and cache on agents
         if old_policy:
             if old_policy.alert_template != self.alert_template:
-                cache_agents_alert_template.delay()
+                cache_agents_alert_template.delay(policy=self.pk)
             elif self.alert_template and old_policy.active != self.active:
-                cache_agents_alert_template.delay()
+                cache_agents_alert_template.delay(policy=self.pk)
 
             if old_policy.active != self.active or old_policy.enforced != self.enforced:
                 cache.delete(CORESETTINGS_CACHE_KEY)
-                cache.delete_many_pattern("site_workstation_*")
-                cache.delete_many_pattern("site_server_*")
-                cache.delete_many_pattern("agent_*")
+                bump_policy_graph_version()
 
     def delete(self, *args, **kwargs):
         cache.delete(CORESETTINGS_CACHE_KEY)
-        cache.delete_many_pattern("site_workstation_*")
-        cache.delete_many_pattern("site_server_*")
-        cache.delete_many_pattern("agent_*")
+        bump_policy_graph_version()
 
         super(Policy, self).delete(
             *args,
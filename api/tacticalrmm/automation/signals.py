@@ -0,0 +1,14 @@
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from .models import Policy
+from .utils import bump_policy_graph_version
+
+
+@receiver(m2m_changed, sender=Policy.excluded_agents.through)
+@receiver(m2m_changed, sender=Policy.excluded_sites.through)
+@receiver(m2m_changed, sender=Policy.excluded_clients.through)
+def handle_policy_exclusions(sender, action: str, **kwargs):
+    # exclusions are part of the compiled policy graph
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_policy_graph_version()
@@ -15,6 +15,7 @@ from .serializers import (
     PolicySerializer,
     PolicyTaskStatusSerializer,
 )
+from .utils import prime_policy_cache, resolve_policy_ids
 
 
 class TestPolicyViews(TacticalTestCase):
@@ -699,3 +700,46 @@ class TestPolicyTasks(TacticalTestCase):
         # should get policies from agent policy
         self.assertTrue(tasks)
         self.assertTrue(checks)
+
+    def test_batch_policy_resolution(self):
+        policy = baker.make("automation.Policy", active=True)
+        baker.make_recipe("checks.memory_check", policy=policy)
+        baker.make_recipe("autotasks.task", policy=policy)
+        site = baker.make("clients.Site", server_policy=policy)
+        agents = baker.make_recipe(
+            "agents.agent",
+            site=site,
+            monitoring_type=AgentMonType.SERVER,
+            _quantity=3,
+        )
+        policy.excluded_agents.add(agents[0])
+
+        self.assertIsNone(resolve_policy_ids(agents[0])["site_policy"])
+        self.assertEqual(resolve_policy_ids(agents[1])["site_policy"], policy.pk)
+
+        prime_policy_cache(agents)
+
+        self.assertEqual(
+            [len(agent.get_checks_from_policies()) for agent in agents], [0, 1, 1]
+        )
+        self.assertEqual(
+            [len(agent.get_tasks_from_policies()) for agent in agents], [0, 1, 1]
+        )
+
+        # results get attached to checks so agents can't share instances
+        self.assertIsNot(
+            agents[1].get_checks_from_policies()[0],
+            agents[2].get_checks_from_policies()[0],
+        )
+
+    @patch("automation.signals.bump_policy_graph_version")
+    def test_policy_exclusions_bump_graph_version(self, bump_policy_graph_version):
+        policy = baker.make("automation.Policy")
+        site = baker.make("clients.Site")
+        bump_policy_graph_version.reset_mock()
+
+        policy.excluded_sites.add(site)
+        bump_policy_graph_version.assert_called_once()
+
+        policy.excluded_sites.clear()
+        self.assertEqual(bump_policy_graph_version.call_count, 2)
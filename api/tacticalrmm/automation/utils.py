@@ -0,0 +1,236 @@
+import copy
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from django.core.cache import cache
+
+from tacticalrmm.constants import POLICY_GRAPH_VERSION_KEY, AgentMonType
+from tacticalrmm.helpers import bump_cache_version, get_cache_version
+
+if TYPE_CHECKING:
+    from agents.models import Agent
+    from autotasks.models import AutomatedTask
+    from checks.models import Check
+
+# the compiled graph for the current version, kept per process so resolving
+# an agent only costs a single cache round trip for the version number
+_compiled: Tuple[Optional[int], Optional[Dict[str, Any]]] = (None, None)
+
+
+def get_policy_graph_version() -> Optional[int]:
+    return get_cache_version(POLICY_GRAPH_VERSION_KEY)
+
+
+def bump_policy_graph_version() -> None:
+    # called whenever policies, their assignments, exclusions or inheritance change
+    bump_cache_version(POLICY_GRAPH_VERSION_KEY)
+
+
+def compile_policy_graph() -> Dict[str, Any]:
+    from automation.models import Policy
+    from clients.models import Client, Site
+    from core.utils import get_core_settings
+
+    core = get_core_settings()
+    graph: Dict[str, Any] = {
+        "default": {
+            AgentMonType.SERVER: core.server_policy_id,
+            AgentMonType.WORKSTATION: core.workstation_policy_id,
+        },
+        "clients": {
+            pk: {
+                "block": block,
+                AgentMonType.SERVER: server_policy,
+                AgentMonType.WORKSTATION: workstation_policy,
+            }
+            for pk, block, server_policy, workstation_policy in Client.objects.values_list(
+                "pk",
+                "block_policy_inheritance",
+                "server_policy_id",
+                "workstation_policy_id",
+            )
+        },
+        "sites": {
+            pk: {
+                "client": client,
+                "block": block,
+                AgentMonType.SERVER: server_policy,
+                AgentMonType.WORKSTATION: workstation_policy,
+            }
+            for pk, client, block, server_policy, workstation_policy in Site.objects.values_list(
+                "pk",
+                "client_id",
+                "block_policy_inheritance",
+                "server_policy_id",
+                "workstation_policy_id",
+            )
+        },
+        "exclusions": {},
+    }
+
+    for field, through in (
+        ("agent", Policy.excluded_agents.through),
+        ("site", Policy.excluded_sites.through),
+        ("client", Policy.excluded_clients.through),
+    ):
+        for policy, pk in through.objects.values_list("policy_id", f"{field}_id"):
+            graph["exclusions"].setdefault(
+                policy, {"agent": set(), "site": set(), "client": set()}
+            )[field].add(pk)
+
+    return graph
+
+
+def get_policy_graph() -> Tuple[Optional[int], Dict[str, Any]]:
+    global _compiled
+
+    version = get_policy_graph_version()
+    if version is not None and _compiled[0] == version and _compiled[1] is not None:
+        return version, _compiled[1]
+
+    graph = cache.get(f"policy_graph_{version}") if version is not None else None
+    if graph is None:
+        graph = compile_policy_graph()
+        if version is not None:
+            cache.set(f"policy_graph_{version}", graph, 600)
+
+    _compiled = (version, graph)
+    return version, graph
+
+
+def resolve_policy_ids(
+    agent: "Agent", graph: Optional[Dict[str, Any]] = None
+) -> Dict[str, Optional[int]]:
+    # same precedence as Agent.get_agent_policies but without touching the database
+    if graph is None:
+        _, graph = get_policy_graph()
+
+    site = graph["sites"].get(agent.site_id)
+    if site is None:
+        # site was added without going through save(), recompile
+        bump_policy_graph_version()
+        _, graph = get_policy_graph()
+        site = graph["sites"][agent.site_id]
+
+    client = graph["clients"][site["client"]]
+    mon_type = agent.monitoring_type
+
+    def applies(pk: Optional[int]) -> bool:
+        if not pk:
+            return False
+
+        excluded = graph["exclusions"].get(pk)
+        return not excluded or (
+            agent.pk not in excluded["agent"]
+            and agent.site_id not in excluded["site"]
+            and site["client"] not in excluded["client"]
+        )
+
+    site_policy = site[mon_type]
+    client_policy = client[mon_type]
+    default_policy = graph["default"][mon_type]
+
+    return {
+        "agent_policy": agent.policy_id if applies(agent.policy_id) else None,
+        "site_policy": site_policy
+        if applies(site_policy) and not agent.block_policy_inheritance
+        else None,
+        "client_policy": client_policy
+        if applies(client_policy)
+        and not agent.block_policy_inheritance
+        and not site["block"]
+        else None,
+        "default_policy": default_policy
+        if applies(default_policy)
+        and not agent.block_policy_inheritance
+        and not site["block"]
+        and not client["block"]
+        else None,
+    }
+
+
+def _build_policy_checks(agent: "Agent") -> "List[Check]":
+    from automation.models import Policy
+
+    if agent.agentchecks.exists():
+        # clear agent checks that have overridden_by_policy set
+        agent.agentchecks.update(overridden_by_policy=False)  # type: ignore
+
+    return Policy.get_policy_checks(agent)
+
+
+def _build_policy_tasks(agent: "Agent") -> "List[AutomatedTask]":
+    from automation.models import Policy
+
+    return Policy.get_policy_tasks(agent)
+
+
+def _resolve_for_agents(
+    agents: "Sequence[Agent]",
+    kind: str,
+    build: "Callable[[Agent], List[Any]]",
+) -> Dict[int, List[Any]]:
+    version, graph = get_policy_graph()
+
+    entries = {}
+    for agent in agents:
+        policies = "_".join(
+            str(pk or 0) for pk in resolve_policy_ids(agent, graph).values()
+        )
+        if kind == "checks" and agent.agentchecks.exists():
+            # agent checks can override policy checks so these can't be shared
+            key = f"agent_{agent.agent_id}_checks"
+        elif kind == "checks":
+            key = f"policy_checks_{version}_{agent.plat}_{policies}"
+        else:
+            key = f"policy_tasks_{version}_{policies}"
+
+        entries[agent.pk] = (key, (version, policies))
+
+    found = (
+        cache.get_many({key for key, _ in entries.values()})
+        if version is not None
+        else {}
+    )
+    to_set = {}
+    ret = {}
+    for agent in agents:
+        key, stamp = entries[agent.pk]
+        value = found.get(key)
+        if not (isinstance(value, tuple) and value[0] == stamp):
+            value = (stamp, build(agent))
+            found[key] = to_set[key] = value
+
+        # every agent gets its own copies since results get attached to them
+        ret[agent.pk] = [copy.copy(obj) for obj in value[1]]
+
+    if to_set and version is not None:
+        cache.set_many(to_set, 600)
+
+    return ret
+
+
+def get_policy_checks_for_agents(
+    agents: "Sequence[Agent]",
+) -> "Dict[int, List[Check]]":
+    return _resolve_for_agents(agents, "checks", _build_policy_checks)
+
+
+def get_policy_tasks_for_agents(
+    agents: "Sequence[Agent]",
+) -> "Dict[int, List[AutomatedTask]]":
+    return _resolve_for_agents(agents, "tasks", _build_policy_tasks)
+
+
+def prime_policy_cache(
+    agents: "Sequence[Agent]", checks: bool = True, tasks: bool = True
+) -> None:
+    # resolves a whole batch of agents up front, each distinct policy combination is only looked up once
+    if checks:
+        policy_checks = get_policy_checks_for_agents(agents)
+        for agent in agents:
+            agent._policy_checks = policy_checks[agent.pk]
+
+    if tasks:
+        policy_tasks = get_policy_tasks_for_agents(agents)
+        for agent in agents:
+            agent._policy_tasks = policy_tasks[agent.pk]
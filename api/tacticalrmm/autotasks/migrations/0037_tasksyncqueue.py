@@ -0,0 +1,53 @@
+# Generated by Django 4.0.4 on 2026-10-18 18:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def queue_unsynced_agents(apps, schema_editor):
+    TaskResult = apps.get_model("autotasks", "TaskResult")
+    TaskSyncQueue = apps.get_model("autotasks", "TaskSyncQueue")
+
+    agent_ids = (
+        TaskResult.objects.exclude(sync_status="synced")
+        .values_list("agent_id", flat=True)
+        .distinct()
+    )
+    TaskSyncQueue.objects.bulk_create(
+        [TaskSyncQueue(agent_id=pk) for pk in agent_ids], ignore_conflicts=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("agents", "0055_agent_version_number"),
+        ("autotasks", "0036_alter_automatedtask_win_task_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaskSyncQueue",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("queued", models.DateTimeField(auto_now_add=True)),
+                (
+                    "agent",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="tasksyncqueue",
+                        to="agents.agent",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(queue_unsynced_agents, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,9 @@
 import asyncio
 import random
 import string
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Union
 
 import pytz
-from django.core.cache import cache
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models.fields import DateTimeField
@@ -12,6 +11,7 @@ from django.db.models.fields.json import JSONField
 from django.db.utils import DatabaseError
 from django.utils import timezone as djangotime
 
+from automation.utils import bump_policy_graph_version
 from core.utils import get_core_settings
 from logs.models import BaseAuditModel, DebugLog
 from tacticalrmm.constants import (
@@ -144,8 +144,7 @@ class AutomatedTask(BaseAuditModel):
 
         # if task is a policy task clear cache on everything
         if self.policy:
-            cache.delete_many_pattern("site_*_tasks")
-            cache.delete_many_pattern("agent_*_tasks")
+            bump_policy_graph_version()
 
         # get old task if exists
         old_task = AutomatedTask.objects.get(pk=self.pk) if self.pk else None
@@ -156,22 +155,25 @@ class AutomatedTask(BaseAuditModel):
             for field in self.fields_that_trigger_task_update_on_agent:
                 if getattr(self, field) != getattr(old_task, field):
                     if self.policy:
-                        TaskResult.objects.exclude(
+                        results = TaskResult.objects.exclude(
                             sync_status=TaskSyncStatus.INITIAL
-                        ).filter(task__policy_id=self.policy.id).update(
-                            sync_status=TaskSyncStatus.NOT_SYNCED
-                        )
+                        ).filter(task__policy_id=self.policy.id)
                     else:
-                        TaskResult.objects.filter(agent=self.agent, task=self).update(
-                            sync_status=TaskSyncStatus.NOT_SYNCED
-                        )
+                        results = TaskResult.objects.filter(agent=self.agent, task=self)
+
+                    results.update(sync_status=TaskSyncStatus.NOT_SYNCED)
+                    TaskSyncQueue.add(results.values_list("agent_id", flat=True))
+                    break
+
+        # new policy tasks get queued when the policy graph is reconciled
+        elif self.agent_id:
+            TaskSyncQueue.add([self.agent_id])
 
     def delete(self, *args, **kwargs):
 
         # if task is a policy task clear cache on everything
         if self.policy:
-            cache.delete_many_pattern("site_*_tasks")
-            cache.delete_many_pattern("agent_*_tasks")
+            bump_policy_graph_version()
 
         super(AutomatedTask, self).delete(
             *args,
@@ -333,71 +335,65 @@ class AutomatedTask(BaseAuditModel):
 
         return task
 
-    def create_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
-        if self.policy and not agent:
-            return "agent parameter needs to be passed with policy task"
-        else:
-            agent = agent if self.policy else self.agent
-
-        try:
-            task_result = TaskResult.objects.get(agent=agent, task=self)
-        except TaskResult.DoesNotExist:
-            task_result = TaskResult(agent=agent, task=self)
-            task_result.save()
-
-        nats_data = {
+    def get_sync_payload(self, sync_status: str, agent: "Agent") -> Dict[str, Any]:
+        # nats payload that brings the task on the agent in line with sync_status
+        if sync_status == TaskSyncStatus.PENDING_DELETION:
+            return {
+                "func": "delschedtask",
+                "schedtaskpayload": {"name": self.win_task_name},
+            }
+        elif sync_status == TaskSyncStatus.NOT_SYNCED:
+            return {
+                "func": "schedtask",
+                "schedtaskpayload": self.generate_nats_task_payload(editing=True),
+            }
+
+        return {
             "func": "schedtask",
             "schedtaskpayload": self.generate_nats_task_payload(agent),
         }
 
-        r = asyncio.run(task_result.agent.nats_cmd(nats_data, timeout=5))
-
-        if r != "ok":
-            task_result.sync_status = TaskSyncStatus.INITIAL
-            task_result.save(update_fields=["sync_status"])
-            DebugLog.warning(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"Unable to create scheduled task {self.name} on {task_result.agent.hostname}. It will be created when the agent checks in.",
-            )
-            return "timeout"
-        else:
-            task_result.sync_status = TaskSyncStatus.SYNCED
-            task_result.save(update_fields=["sync_status"])
-            DebugLog.info(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"{task_result.agent.hostname} task {self.name} was successfully created",
-            )
-
-        return "ok"
-
-    def modify_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
-        if self.policy and not agent:
-            return "agent parameter needs to be passed with policy task"
-        else:
-            agent = agent if self.policy else self.agent
-
-        try:
-            task_result = TaskResult.objects.get(agent=agent, task=self)
-        except TaskResult.DoesNotExist:
-            task_result = TaskResult(agent=agent, task=self)
-            task_result.save()
-
-        nats_data = {
-            "func": "schedtask",
-            "schedtaskpayload": self.generate_nats_task_payload(editing=True),
-        }
+    def handle_sync_result(
+        self, sync_status: str, task_result: "TaskResult", r: Any
+    ) -> str:
+        agent = task_result.agent
+
+        if sync_status == TaskSyncStatus.PENDING_DELETION:
+            if r != "ok" and "The system cannot find the file specified" not in str(r):
+                task_result.sync_status = TaskSyncStatus.PENDING_DELETION
+
+                try:
+                    task_result.save(update_fields=["sync_status"])
+                except DatabaseError:
+                    pass
+
+                TaskSyncQueue.add([agent.pk])
+                DebugLog.warning(
+                    agent=agent,
+                    log_type=DebugLogType.AGENT_ISSUES,
+                    message=f"{agent.hostname} task {self.name} will be deleted on next checkin",
+                )
+                return "timeout"
+            else:
+                self.delete()
+                DebugLog.info(
+                    agent=agent,
+                    log_type=DebugLogType.AGENT_ISSUES,
+                    message=f"{agent.hostname}({agent.agent_id}) task {self.name} was deleted",
+                )
 
-        r = asyncio.run(task_result.agent.nats_cmd(nats_data, timeout=5))
+            return "ok"
 
         if r != "ok":
-            task_result.sync_status = TaskSyncStatus.NOT_SYNCED
+            task_result.sync_status = sync_status
             task_result.save(update_fields=["sync_status"])
+            TaskSyncQueue.add([agent.pk])
             DebugLog.warning(
                 agent=agent,
                 log_type=DebugLogType.AGENT_ISSUES,
-                message=f"Unable to modify scheduled task {self.name} on {task_result.agent.hostname}({task_result.agent.agent_id}). It will try again on next agent checkin",
+                message=f"Unable to modify scheduled task {self.name} on {agent.hostname}({agent.agent_id}). It will try again on next agent checkin"
+                if sync_status == TaskSyncStatus.NOT_SYNCED
+                else f"Unable to create scheduled task {self.name} on {agent.hostname}. It will be created when the agent checks in.",
             )
             return "timeout"
         else:
@@ -406,12 +402,16 @@ class AutomatedTask(BaseAuditModel):
             DebugLog.info(
                 agent=agent,
                 log_type=DebugLogType.AGENT_ISSUES,
-                message=f"{task_result.agent.hostname} task {self.name} was successfully modified",
+                message=f"{agent.hostname} task {self.name} was successfully modified"
+                if sync_status == TaskSyncStatus.NOT_SYNCED
+                else f"{agent.hostname} task {self.name} was successfully created",
             )
 
         return "ok"
 
-    def delete_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
+    def _sync_task_on_agent(
+        self, sync_status: str, agent: "Optional[Agent]", timeout: int
+    ) -> str:
         if self.policy and not agent:
             return "agent parameter needs to be passed with policy task"
         else:
@@ -423,35 +423,23 @@ class AutomatedTask(BaseAuditModel):
             task_result = TaskResult(agent=agent, task=self)
             task_result.save()
 
-        nats_data = {
-            "func": "delschedtask",
-            "schedtaskpayload": {"name": self.win_task_name},
-        }
-        r = asyncio.run(task_result.agent.nats_cmd(nats_data, timeout=10))
-
-        if r != "ok" and "The system cannot find the file specified" not in r:
-            task_result.sync_status = TaskSyncStatus.PENDING_DELETION
+        r = asyncio.run(
+            task_result.agent.nats_cmd(
+                self.get_sync_payload(sync_status, task_result.agent), timeout=timeout
+            )
+        )
+        return self.handle_sync_result(sync_status, task_result, r)
 
-            try:
-                task_result.save(update_fields=["sync_status"])
-            except DatabaseError:
-                pass
+    def create_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
+        return self._sync_task_on_agent(TaskSyncStatus.INITIAL, agent, timeout=5)
 
-            DebugLog.warning(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"{task_result.agent.hostname} task {self.name} will be deleted on next checkin",
-            )
-            return "timeout"
-        else:
-            self.delete()
-            DebugLog.info(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"{task_result.agent.hostname}({task_result.agent.agent_id}) task {self.name} was deleted",
-            )
+    def modify_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
+        return self._sync_task_on_agent(TaskSyncStatus.NOT_SYNCED, agent, timeout=5)
 
-        return "ok"
+    def delete_task_on_agent(self, agent: "Optional[Agent]" = None) -> str:
+        return self._sync_task_on_agent(
+            TaskSyncStatus.PENDING_DELETION, agent, timeout=10
+        )
 
     def run_win_task(self, agent: "Optional[Agent]" = None) -> str:
         if self.policy and not agent:
@@ -593,3 +581,23 @@ class TaskResult(models.Model):
             + f" - Return code: {self.retcode}\nStdout:{self.stdout}\nStderr: {self.stderr}"
         )
         CORE.send_sms(body, alert_template=self.agent.alert_template)
+
+
+class TaskSyncQueue(models.Model):
+    """Agents that may have scheduled tasks waiting to be created, modified or deleted"""
+
+    agent = models.OneToOneField(
+        "agents.Agent",
+        related_name="tasksyncqueue",
+        on_delete=models.CASCADE,
+    )
+    queued = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.agent_id} - {self.queued}"
+
+    @classmethod
+    def add(cls, agent_ids: "Iterable[int]") -> None:
+        cls.objects.bulk_create(
+            [cls(agent_id=pk) for pk in set(agent_ids)], ignore_conflicts=True
+        )
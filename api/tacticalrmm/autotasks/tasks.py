@@ -1,17 +1,32 @@
-import asyncio
 import datetime as dt
 import random
 from time import sleep
 from typing import Optional, Union
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Prefetch
 from django.utils import timezone as djangotime
 
 from agents.models import Agent
 from alerts.models import Alert
-from autotasks.models import AutomatedTask, TaskResult
+from automation.utils import (
+    get_policy_graph,
+    prime_policy_cache,
+    resolve_policy_ids,
+)
+from autotasks.models import AutomatedTask, TaskResult, TaskSyncQueue
 from logs.models import DebugLog
 from tacticalrmm.celery import app
-from tacticalrmm.constants import DebugLogType
+from tacticalrmm.constants import (
+    AGENT_DEFER,
+    TASK_SYNC_POLICY_VERSION_KEY,
+    DebugLogType,
+    TaskSyncStatus,
+)
+from tacticalrmm.helpers import version_to_int
+from tacticalrmm.nats_utils import bulk_nats_command, bulk_nats_rounds
 
 
 @app.task
@@ -74,56 +89,239 @@ def run_win_task(pk: int, agent_id: Optional[str] = None) -> str:
     return "ok"
 
 
-@app.task
-def remove_orphaned_win_tasks() -> None:
-    from agents.models import Agent
+def queue_policy_task_syncs() -> None:
+    # after the policy graph changes, queue agents that are missing results for their policy tasks
+    version, graph = get_policy_graph()
+    if version is not None and cache.get(TASK_SYNC_POLICY_VERSION_KEY) == version:
+        return
+
+    policy_tasks: "dict[int, set[int]]" = {}
+    for policy, pk in AutomatedTask.objects.filter(policy__active=True).values_list(
+        "policy_id", "pk"
+    ):
+        policy_tasks.setdefault(policy, set()).add(pk)
+
+    if policy_tasks:
+        existing: "dict[int, set[int]]" = {}
+        for agent, task in TaskResult.objects.filter(
+            task__policy__isnull=False
+        ).values_list("agent_id", "task_id"):
+            existing.setdefault(agent, set()).add(task)
+
+        to_queue = []
+        for agent in Agent.objects.only(
+            "pk", "site_id", "monitoring_type", "policy_id", "block_policy_inheritance"
+        ):
+            expected = set()
+            for policy in resolve_policy_ids(agent, graph).values():
+                expected |= policy_tasks.get(policy, set())
+
+            if expected - existing.get(agent.pk, set()):
+                to_queue.append(agent.pk)
+
+        TaskSyncQueue.add(to_queue)
+
+    if version is not None:
+        cache.set(TASK_SYNC_POLICY_VERSION_KEY, version, None)
+
+
+def sync_queued_tasks() -> None:
+    queue_policy_task_syncs()
+
+    # claim a batch of online agents, agents that are offline stay queued until they check in
+    with transaction.atomic():
+        agent_ids = list(
+            TaskSyncQueue.objects.select_for_update(skip_locked=True)
+            .filter(
+                agent__last_seen__gte=djangotime.now()
+                - djangotime.timedelta(minutes=1) * F("agent__offline_time"),
+                agent__version_number__gte=version_to_int("1.6.0"),
+            )
+            .order_by("queued")
+            .values_list("agent_id", flat=True)[: settings.TASK_SYNC_BATCH_SIZE]
+        )
+        TaskSyncQueue.objects.filter(agent_id__in=agent_ids).delete()
 
-    for agent in Agent.online_agents():
-        r = asyncio.run(agent.nats_cmd({"func": "listschedtasks"}, timeout=10))
+    if not agent_ids:
+        return
 
-        if not isinstance(r, list):  # empty list
-            DebugLog.error(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"Unable to pull list of scheduled tasks on {agent.hostname}: {r}",
+    # the rows are removed when claimed so changes made during the sync queue the agent
+    # again, agents that don't get to finish are put back
+    done: "set[int]" = set()
+    try:
+        _sync_queued_agents(agent_ids, done)
+    finally:
+        TaskSyncQueue.add(set(agent_ids) - done)
+
+
+def _sync_queued_agents(agent_ids: "list[int]", done: "set[int]") -> None:
+    agents = list(
+        Agent.objects.defer(*AGENT_DEFER)
+        .select_related(
+            "site__server_policy",
+            "site__workstation_policy",
+            "site__client__server_policy",
+            "site__client__workstation_policy",
+            "policy",
+        )
+        .prefetch_related(
+            Prefetch("taskresults", queryset=TaskResult.objects.select_related("task")),
+            "autotasks",
+        )
+        .filter(pk__in=agent_ids)
+    )
+    # agents deleted since they were queued
+    done.update(set(agent_ids) - {agent.pk for agent in agents})
+    prime_policy_cache(agents, checks=False)
+
+    agents_by_id = {agent.agent_id: agent for agent in agents}
+    pending: "dict[str, list[tuple[AutomatedTask, str]]]" = {}
+    for agent in agents:
+        for task in agent.get_tasks_with_policies():
+            sync_status = (
+                task.task_result.sync_status
+                if task.task_result
+                else TaskSyncStatus.INITIAL
             )
-            continue
+            if sync_status != TaskSyncStatus.SYNCED:
+                pending.setdefault(agent.agent_id, []).append((task, sync_status))
 
-        agent_task_names = [
-            task.win_task_name for task in agent.get_tasks_with_policies()
-        ]
+        if agent.agent_id not in pending:
+            done.add(agent.pk)
 
-        exclude_tasks = (
-            "TacticalRMM_fixmesh",
-            "TacticalRMM_SchedReboot",
-            "TacticalRMM_sync",
-            "TacticalRMM_agentupdate",
+    remaining = {agent_id: len(tasks) for agent_id, tasks in pending.items()}
+
+    def handle(agent_id: str, item: "tuple[AutomatedTask, str]", r) -> bool:
+        task, sync_status = item
+        agent = agents_by_id[agent_id]
+        task_result = (
+            task.task_result
+            or TaskResult.objects.get_or_create(agent=agent, task=task)[0]
+        )
+        task_result.agent = agent
+        # the agent got queued again when it fails, leave the rest of its tasks for then
+        ok = task.handle_sync_result(sync_status, task_result, r) == "ok"
+
+        remaining[agent_id] -= 1
+        if not ok or not remaining[agent_id]:
+            done.add(agent.pk)
+
+        return ok
+
+    bulk_nats_rounds(
+        pending,
+        lambda agent_id, item: item[0].get_sync_payload(
+            item[1], agents_by_id[agent_id]
+        ),
+        handle,
+        timeout=10,
+    )
+
+
+@app.task(bind=True)
+def remove_orphaned_win_tasks(self) -> str:
+    exclude_tasks = (
+        "TacticalRMM_fixmesh",
+        "TacticalRMM_SchedReboot",
+        "TacticalRMM_sync",
+        "TacticalRMM_agentupdate",
+    )
+    online = [agent.pk for agent in Agent.online_agents()]
+    totals = {
+        "agents": len(online),
+        "checked": 0,
+        "unreachable": 0,
+        "removed": 0,
+        "failed": 0,
+    }
+
+    for i in range(0, len(online), settings.ORPHANED_TASK_BATCH_SIZE):
+        agents = {
+            agent.agent_id: agent
+            for agent in Agent.objects.defer(*AGENT_DEFER)
+            .select_related(
+                "site__server_policy",
+                "site__workstation_policy",
+                "site__client__server_policy",
+                "site__client__workstation_policy",
+                "policy",
+            )
+            .prefetch_related("autotasks")
+            .filter(pk__in=online[i : i + settings.ORPHANED_TASK_BATCH_SIZE])
+        }
+        prime_policy_cache(list(agents.values()), checks=False)
+
+        # every agent in the batch is asked at once, each one gets its own timeout
+        replies = bulk_nats_command(
+            [(agent_id, {"func": "listschedtasks"}) for agent_id in agents],
+            wait=True,
+            timeout=10,
         )
 
-        for task in r:
-            if task.startswith(exclude_tasks):
-                # skip system tasks or any pending reboots
+        orphans: dict[str, list[str]] = {}
+        for agent_id, agent in agents.items():
+            r = replies.get(agent_id, "timeout")
+            if not isinstance(r, list):  # empty list
+                totals["unreachable"] += 1
+                DebugLog.error(
+                    agent=agent,
+                    log_type=DebugLogType.AGENT_ISSUES,
+                    message=f"Unable to pull list of scheduled tasks on {agent.hostname}: {r}",
+                )
                 continue
 
-            if task.startswith("TacticalRMM_") and task not in agent_task_names:
-                # delete task since it doesn't exist in UI
-                nats_data = {
-                    "func": "delschedtask",
-                    "schedtaskpayload": {"name": task},
-                }
-                ret = asyncio.run(agent.nats_cmd(nats_data, timeout=10))
-                if ret != "ok":
-                    DebugLog.error(
-                        agent=agent,
-                        log_type=DebugLogType.AGENT_ISSUES,
-                        message=f"Unable to clean up orphaned task {task} on {agent.hostname}: {ret}",
-                    )
-                else:
-                    DebugLog.info(
-                        agent=agent,
-                        log_type=DebugLogType.AGENT_ISSUES,
-                        message=f"Removed orphaned task {task} from {agent.hostname}",
-                    )
+            totals["checked"] += 1
+            agent_task_names = {
+                task.win_task_name for task in agent.get_tasks_with_policies()
+            }
+            # delete tasks that don't exist in the UI, skipping system tasks and pending reboots
+            tasks = [
+                task
+                for task in r
+                if task.startswith("TacticalRMM_")
+                and not task.startswith(exclude_tasks)
+                and task not in agent_task_names
+            ]
+            if tasks:
+                orphans[agent_id] = tasks
+
+        def handle(agent_id: str, task: str, ret) -> bool:
+            agent = agents[agent_id]
+            if ret != "ok":
+                totals["failed"] += 1
+                DebugLog.error(
+                    agent=agent,
+                    log_type=DebugLogType.AGENT_ISSUES,
+                    message=f"Unable to clean up orphaned task {task} on {agent.hostname}: {ret}",
+                )
+            else:
+                totals["removed"] += 1
+                DebugLog.info(
+                    agent=agent,
+                    log_type=DebugLogType.AGENT_ISSUES,
+                    message=f"Removed orphaned task {task} from {agent.hostname}",
+                )
+            return True
+
+        bulk_nats_rounds(
+            orphans,
+            lambda agent_id, task: {
+                "func": "delschedtask",
+                "schedtaskpayload": {"name": task},
+            },
+            handle,
+            timeout=10,
+        )
+
+        if self.request.id:
+            self.update_state(state="PROGRESS", meta=totals)
+
+    summary = (
+        f"Checked {totals['checked']} of {totals['agents']} online agents for orphaned tasks, "
+        f"{totals['unreachable']} unreachable, {totals['removed']} removed, {totals['failed']} failed"
+    )
+    DebugLog.info(log_type=DebugLogType.AGENT_ISSUES, message=summary)
+    return summary
 
 
 @app.task
@@ -1,14 +1,21 @@
-from unittest.mock import call, patch
+from unittest.mock import patch
 
+from django.conf import settings
 from django.utils import timezone as djangotime
 from model_bakery import baker
 
-from tacticalrmm.constants import TaskType
+from tacticalrmm.constants import AgentMonType, TaskType
 from tacticalrmm.test import TacticalTestCase
 
-from .models import AutomatedTask, TaskResult, TaskSyncStatus
+from .models import AutomatedTask, TaskResult, TaskSyncQueue, TaskSyncStatus
 from .serializers import TaskSerializer
-from .tasks import create_win_task_schedule, remove_orphaned_win_tasks, run_win_task
+from .tasks import (
+    create_win_task_schedule,
+    queue_policy_task_syncs,
+    remove_orphaned_win_tasks,
+    run_win_task,
+    sync_queued_tasks,
+)
 
 base_url = "/tasks"
 
@@ -381,9 +388,11 @@ class TestAutoTaskCeleryTasks(TacticalTestCase):
         self.authenticate()
         self.setup_coresettings()
 
-    @patch("agents.models.Agent.nats_cmd")
-    def test_remove_orphaned_win_task(self, nats_cmd):
+    @patch("tacticalrmm.nats_utils.bulk_nats_command")
+    @patch("autotasks.tasks.bulk_nats_command")
+    def test_remove_orphaned_win_task(self, bulk_nats_command, delete_command):
         agent = baker.make_recipe("agents.online_agent")
+        unreachable = baker.make_recipe("agents.online_agent")
         baker.make_recipe("agents.offline_agent")
         task1 = AutomatedTask.objects.create(
             agent=agent,
@@ -401,39 +410,71 @@ class TestAutoTaskCeleryTasks(TacticalTestCase):
             "TacticalRMM_fixmesh",
             "TacticalRMM_SchedReboot_jk324kajd",
             "TacticalRMM_iggrLcOaldIZnUzLuJWPLNwikiOoJJHHznb",  # orphaned task
+            "TacticalRMM_kdjhfJHFkjshdfKJHSDFkjhsdfKJHsdfkj",  # orphaned task
         ]
 
-        calls = [
-            call({"func": "listschedtasks"}, timeout=10),
-            call(
-                {
-                    "func": "delschedtask",
-                    "schedtaskpayload": {
-                        "name": "TacticalRMM_iggrLcOaldIZnUzLuJWPLNwikiOoJJHHznb"
-                    },
-                },
-                timeout=10,
-            ),
+        bulk_nats_command.return_value = {
+            agent.agent_id: win_tasks,
+            unreachable.agent_id: "timeout",
+        }
+        delete_command.side_effect = [
+            {agent.agent_id: "ok"},
+            {agent.agent_id: "ok"},
         ]
-
-        nats_cmd.side_effect = [win_tasks, "ok"]
-        remove_orphaned_win_tasks()
-        self.assertEqual(nats_cmd.call_count, 2)
-        nats_cmd.assert_has_calls(calls)
+        ret = remove_orphaned_win_tasks()
+        self.assertEqual(bulk_nats_command.call_count, 1)
+        self.assertEqual(delete_command.call_count, 2)
+        self.assertEqual(
+            sorted(bulk_nats_command.call_args_list[0].args[0]),
+            sorted(
+                [
+                    (agent.agent_id, {"func": "listschedtasks"}),
+                    (unreachable.agent_id, {"func": "listschedtasks"}),
+                ]
+            ),
+        )
+        # the deletes for one agent are sent one after the other
+        self.assertEqual(
+            delete_command.call_args_list[0].args[0],
+            [
+                (
+                    agent.agent_id,
+                    {
+                        "func": "delschedtask",
+                        "schedtaskpayload": {
+                            "name": "TacticalRMM_iggrLcOaldIZnUzLuJWPLNwikiOoJJHHznb"
+                        },
+                    },
+                )
+            ],
+        )
+        self.assertIn("Checked 1 of 2 online agents", ret)
+        self.assertIn("1 unreachable, 2 removed, 0 failed", ret)
 
         # test nats delete task fail
-        nats_cmd.reset_mock()
-        nats_cmd.side_effect = [win_tasks, "error deleting task"]
-        remove_orphaned_win_tasks()
-        nats_cmd.assert_has_calls(calls)
-        self.assertEqual(nats_cmd.call_count, 2)
+        delete_command.reset_mock()
+        bulk_nats_command.return_value = {
+            agent.agent_id: win_tasks,
+            unreachable.agent_id: win_tasks,
+        }
+        delete_command.side_effect = [
+            {agent.agent_id: "error deleting task", unreachable.agent_id: "ok"},
+            {agent.agent_id: "ok", unreachable.agent_id: "ok"},
+            # task1 only belongs to the first agent
+            {unreachable.agent_id: "ok"},
+        ]
+        ret = remove_orphaned_win_tasks()
+        self.assertEqual(delete_command.call_count, 3)
+        self.assertIn("4 removed, 1 failed", ret)
 
         # no orphaned tasks
-        nats_cmd.reset_mock()
-        win_tasks.remove("TacticalRMM_iggrLcOaldIZnUzLuJWPLNwikiOoJJHHznb")
-        nats_cmd.side_effect = [win_tasks, "ok"]
+        delete_command.reset_mock()
+        bulk_nats_command.return_value = {
+            agent.agent_id: [task1.win_task_name],
+            unreachable.agent_id: [],
+        }
         remove_orphaned_win_tasks()
-        self.assertEqual(nats_cmd.call_count, 1)
+        delete_command.assert_not_called()
 
     @patch("agents.models.Agent.nats_cmd")
     def test_run_win_task(self, nats_cmd):
@@ -756,6 +797,88 @@ class TestAutoTaskCeleryTasks(TacticalTestCase):
             timeout=5,
         )
 
+    @patch("tacticalrmm.nats_utils.bulk_nats_command")
+    def test_sync_queued_tasks(self, bulk_nats_command):
+        policy = baker.make("automation.Policy", active=True)
+        site = baker.make("clients.Site", client__server_policy=policy)
+        agent = baker.make_recipe(
+            "agents.agent",
+            site=site,
+            monitoring_type=AgentMonType.SERVER,
+            version=settings.LATEST_AGENT_VER,
+            last_seen=djangotime.now(),
+        )
+        offline = baker.make_recipe(
+            "agents.offline_agent",
+            site=site,
+            monitoring_type=AgentMonType.SERVER,
+            version=settings.LATEST_AGENT_VER,
+        )
+
+        # new agents are queued
+        self.assertTrue(TaskSyncQueue.objects.filter(agent=agent).exists())
+        TaskSyncQueue.objects.all().delete()
+
+        baker.make("autotasks.AutomatedTask", policy=policy, name="policy task")
+        agent_task = baker.make(
+            "autotasks.AutomatedTask", agent=agent, name="agent task"
+        )
+        self.assertEqual(
+            list(TaskSyncQueue.objects.values_list("agent_id", flat=True)), [agent.pk]
+        )
+
+        queue_policy_task_syncs()
+        self.assertEqual(
+            set(TaskSyncQueue.objects.values_list("agent_id", flat=True)),
+            {agent.pk, offline.pk},
+        )
+
+        bulk_nats_command.side_effect = lambda messages, **kwargs: {
+            agent_id: "ok" for agent_id, _ in messages
+        }
+        sync_queued_tasks()
+
+        # one task per round so two rounds for the online agent
+        self.assertEqual(bulk_nats_command.call_count, 2)
+        self.assertEqual(
+            TaskResult.objects.filter(
+                agent=agent, sync_status=TaskSyncStatus.SYNCED
+            ).count(),
+            2,
+        )
+        # offline agents stay queued until they check in
+        self.assertEqual(
+            list(TaskSyncQueue.objects.values_list("agent_id", flat=True)),
+            [offline.pk],
+        )
+
+        # nothing left to do for the online agent
+        bulk_nats_command.reset_mock()
+        sync_queued_tasks()
+        bulk_nats_command.assert_not_called()
+
+        # a failed sync queues the agent again
+        bulk_nats_command.side_effect = lambda messages, **kwargs: {
+            agent_id: "timeout" for agent_id, _ in messages
+        }
+        agent_task.enabled = False
+        agent_task.save()
+        self.assertTrue(TaskSyncQueue.objects.filter(agent=agent).exists())
+
+        sync_queued_tasks()
+        bulk_nats_command.assert_called_once()
+        self.assertEqual(
+            TaskResult.objects.get(agent=agent, task=agent_task).sync_status,
+            TaskSyncStatus.NOT_SYNCED,
+        )
+        self.assertTrue(TaskSyncQueue.objects.filter(agent=agent).exists())
+
+        # claimed agents are put back when the sync doesn't get to finish
+        bulk_nats_command.side_effect = Exception("worker lost")
+        with self.assertRaises(Exception):
+            sync_queued_tasks()
+        self.assertTrue(TaskSyncQueue.objects.filter(agent=agent).exists())
+
 
 class TestTaskPermissions(TacticalTestCase):
     def setUp(self):
@@ -1,3 +1,5 @@
+from tacticalrmm.constants import CheckHistoryResolution
+
 CHECK_DEFER = (
     "created_by",
     "created_time",
@@ -24,3 +26,11 @@ CHECK_RESULT_DEFER = (
     "stderr",
     "execution_time",
 )
+
+# the longest window in days served from each check history resolution, anything
+# longer is served from daily rollups. None means the raw rows
+CHECK_HISTORY_WINDOWS = (
+    (1, None),
+    (3, CheckHistoryResolution.MINUTE),
+    (90, CheckHistoryResolution.HOUR),
+)
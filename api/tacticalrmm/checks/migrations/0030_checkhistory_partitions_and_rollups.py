@@ -0,0 +1,93 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:54
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0029_alter_checkresult_alert_severity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckHistoryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('check_id', models.PositiveIntegerField()),
+                ('agent_id', models.CharField(max_length=200)),
+                ('resolution', models.PositiveIntegerField(choices=[(60, '1m'), (3600, '1h'), (86400, '1d')])),
+                ('x', models.DateTimeField()),
+                ('y_min', models.PositiveIntegerField()),
+                ('y_max', models.PositiveIntegerField()),
+                ('y_sum', models.BigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            """
+            DO $$
+            DECLARE
+                pkey text;
+                seq text;
+                first_partition text := 'checks_checkhistory_p' || to_char(now() AT TIME ZONE 'UTC', 'YYYYMMDD');
+            BEGIN
+                SELECT conname INTO pkey FROM pg_constraint
+                    WHERE conrelid = 'checks_checkhistory'::regclass AND contype = 'p';
+                seq := pg_get_serial_sequence('checks_checkhistory', 'id');
+
+                -- the existing table becomes the first partition, holding everything up to the end of today
+                EXECUTE format('ALTER TABLE checks_checkhistory RENAME TO %I', first_partition);
+                EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', first_partition, pkey);
+                EXECUTE format(
+                    'CREATE TABLE checks_checkhistory (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (x)',
+                    first_partition
+                );
+                -- unique constraints on a partitioned table have to include the partition key
+                ALTER TABLE checks_checkhistory ADD PRIMARY KEY (id, x);
+                EXECUTE format('ALTER SEQUENCE %s OWNED BY checks_checkhistory.id', seq);
+                EXECUTE format(
+                    'ALTER TABLE checks_checkhistory ATTACH PARTITION %I FOR VALUES FROM (MINVALUE) TO (%L)',
+                    first_partition,
+                    date_trunc('day', now(), 'UTC') + interval '1 day'
+                );
+                CREATE TABLE checks_checkhistory_default PARTITION OF checks_checkhistory DEFAULT;
+            END
+            $$;
+            """,
+            reverse_sql="""
+            DO $$
+            DECLARE
+                seq text := pg_get_serial_sequence('checks_checkhistory', 'id');
+            BEGIN
+                -- copy every partition's rows back into a plain table keyed on id alone
+                CREATE TABLE checks_checkhistory_unpartitioned
+                    (LIKE checks_checkhistory INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+                INSERT INTO checks_checkhistory_unpartitioned SELECT * FROM checks_checkhistory;
+                -- hand the id sequence over first, dropping the partitioned table would take it along
+                EXECUTE format('ALTER SEQUENCE %s OWNED BY checks_checkhistory_unpartitioned.id', seq);
+                DROP TABLE checks_checkhistory;
+                ALTER TABLE checks_checkhistory_unpartitioned RENAME TO checks_checkhistory;
+                ALTER TABLE checks_checkhistory ADD PRIMARY KEY (id);
+            END
+            $$;
+            """,
+        ),
+        migrations.AddIndex(
+            model_name='checkhistory',
+            index=models.Index(fields=['check_id', 'agent_id', 'x'], name='checks_chec_check_i_b3c085_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='checkhistory',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['x'], name='checks_chec_x_48d135_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='checkhistoryrollup',
+            index=models.Index(fields=['x'], name='checks_chec_x_684f9f_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='checkhistoryrollup',
+            constraint=models.UniqueConstraint(fields=('check_id', 'agent_id', 'resolution', 'x'), name='unique_check_history_rollup'),
+        ),
+    ]
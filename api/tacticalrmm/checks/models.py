@@ -1,18 +1,25 @@
+import datetime as dt
+import math
 from statistics import mean
-from typing import TYPE_CHECKING, Any, Dict, Optional, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import BrinIndex
 from django.core.cache import cache
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import Trunc
 from django.utils import timezone as djangotime
 
+from automation.utils import bump_policy_graph_version
 from core.utils import get_core_settings
 from logs.models import BaseAuditModel
 from tacticalrmm.constants import (
     CHECKS_NON_EDITABLE_FIELDS,
     POLICY_CHECK_FIELDS_TO_COPY,
     AlertSeverity,
+    CheckHistoryResolution,
     CheckStatus,
     CheckType,
     EvtLogFailWhen,
@@ -156,8 +163,7 @@ class Check(BaseAuditModel):
 
         # if check is a policy check clear cache on everything
         if self.policy:
-            cache.delete_many_pattern("site_*_checks")
-            cache.delete_many_pattern("agent_*_checks")
+            bump_policy_graph_version()
 
         # if check is an agent check
         elif self.agent:
@@ -172,8 +178,7 @@ class Check(BaseAuditModel):
 
         # if check is a policy check clear cache on everything
         if self.policy:
-            cache.delete_many_pattern("site_*_checks")
-            cache.delete_many_pattern("agent_*_checks")
+            bump_policy_graph_version()
 
         # if check is an agent check
         elif self.agent:
@@ -184,6 +189,10 @@ class Check(BaseAuditModel):
             **kwargs,
         )
 
+        # policy checks are picked up by sweep_failing_checks_on_policy_change
+        if self.agent:
+            self.agent.update_check_summary()
+
     @property
     def readable_desc(self):
         display = self.get_check_type_display()  # type: ignore
@@ -365,9 +374,35 @@ class CheckResult(models.Model):
             skip_create=not self.assigned_check.should_create_alert(alert_template),
         )
 
-    def handle_check(self, data, check: "Check", agent: "Agent"):
+    def handle_check(
+        self,
+        data,
+        check: "Check",
+        agent: "Agent",
+        history: "Optional[List[CheckHistory]]" = None,
+        pending_alerts: "Optional[List[CheckResult]]" = None,
+        update_summary: bool = True,
+    ):
+        # history, pending_alerts and update_summary let a batch of results be processed
+        # together: history rows are collected for one bulk_create, results that need alert
+        # handling are collected for Alert.handle_check_alerts and the agent summary is
+        # updated by the caller
         from alerts.models import Alert
 
+        def add_check_history(value: int, more_info: Any = None) -> None:
+            if history is None:
+                check.add_check_history(value, agent.agent_id, more_info)
+            else:
+                history.append(
+                    CheckHistory(
+                        check_id=check.pk,
+                        y=value,
+                        results=more_info,
+                        agent_id=agent.agent_id,
+                    )
+                )
+
+        prev_state = (self.status, self.alert_severity)
         update_fields = []
         # cpuload or mem checks
         if check.check_type in (CheckType.CPU_LOAD, CheckType.MEMORY):
@@ -391,7 +426,7 @@ class CheckResult(models.Model):
                 self.status = CheckStatus.PASSING
 
             # add check history
-            check.add_check_history(data["percent"], agent.agent_id)
+            add_check_history(data["percent"])
 
         # diskspace checks
         elif check.check_type == CheckType.DISK_SPACE:
@@ -416,7 +451,7 @@ class CheckResult(models.Model):
                 self.more_info = data["more_info"]
 
                 # add check history
-                check.add_check_history(100 - percent_used, agent.agent_id)
+                add_check_history(100 - percent_used)
             else:
                 self.status = CheckStatus.FAILING
                 self.alert_severity = AlertSeverity.ERROR
@@ -453,9 +488,8 @@ class CheckResult(models.Model):
             )
 
             # add check history
-            check.add_check_history(
+            add_check_history(
                 1 if self.status == CheckStatus.FAILING else 0,
-                agent.agent_id,
                 {
                     "retcode": data["retcode"],
                     "stdout": data["stdout"][:60],
@@ -470,9 +504,8 @@ class CheckResult(models.Model):
             self.more_info = data["output"]
             update_fields.extend(["more_info"])
 
-            check.add_check_history(
+            add_check_history(
                 1 if self.status == CheckStatus.FAILING else 0,
-                agent.agent_id,
                 self.more_info[:60],
             )
 
@@ -482,9 +515,8 @@ class CheckResult(models.Model):
             self.more_info = data["more_info"]
             update_fields.extend(["more_info"])
 
-            check.add_check_history(
+            add_check_history(
                 1 if self.status == CheckStatus.FAILING else 0,
-                agent.agent_id,
                 self.more_info[:60],
             )
 
@@ -505,9 +537,8 @@ class CheckResult(models.Model):
             self.extra_details = {"log": log}
             update_fields.extend(["extra_details"])
 
-            check.add_check_history(
+            add_check_history(
                 1 if self.status == CheckStatus.FAILING else 0,
-                agent.agent_id,
                 "Events Found:" + str(len(self.extra_details["log"])),
             )
 
@@ -519,13 +550,18 @@ class CheckResult(models.Model):
             self.save(update_fields=update_fields)
 
             if self.fail_count >= check.fails_b4_alert:
-                Alert.handle_alert_failure(self)
+                if pending_alerts is None:
+                    Alert.handle_alert_failure(self)
+                else:
+                    pending_alerts.append(self)
 
         elif self.status == CheckStatus.PASSING:
             self.fail_count = 0
             update_fields.extend(["status", "fail_count", "alert_severity", "last_run"])
             self.save(update_fields=update_fields)
-            if Alert.objects.filter(
+            if pending_alerts is not None:
+                pending_alerts.append(self)
+            elif Alert.objects.filter(
                 assigned_check=check, agent=agent, resolved=False
             ).exists():
                 Alert.handle_alert_resolve(self)
@@ -533,6 +569,10 @@ class CheckResult(models.Model):
             update_fields.extend(["last_run"])
             self.save(update_fields=update_fields)
 
+        # only touch the agent/site/client rollup when the outcome actually changed
+        if update_summary and (self.status, self.alert_severity) != prev_state:
+            agent.update_check_summary()
+
         return self.status
 
     def send_email(self):
@@ -690,5 +730,219 @@ class CheckHistory(models.Model):
     y = models.PositiveIntegerField(null=True, blank=True, default=None)
     results = models.JSONField(null=True, blank=True)
 
+    class Meta:
+        # the table is range partitioned by day on x, see checks.utils
+        indexes = [
+            models.Index(fields=["check_id", "agent_id", "x"]),
+            BrinIndex(fields=["x"]),
+        ]
+
     def __str__(self):
         return str(self.x)
+
+    @classmethod
+    def get_state_runs(
+        cls, check_id: int, agent_id: str, start: dt.datetime, limit: int
+    ) -> List[Dict[str, Any]]:
+        # collapses consecutive rows with the same value into one run, oldest first
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT MIN(x), MAX(x), y, COUNT(*) FROM (
+                    SELECT x, y, SUM(changed) OVER (ORDER BY x) AS run FROM (
+                        SELECT x, y, CASE WHEN y IS DISTINCT FROM LAG(y) OVER (ORDER BY x)
+                            THEN 1 ELSE 0 END AS changed
+                        FROM {cls._meta.db_table}
+                        WHERE check_id = %s AND agent_id = %s AND y IS NOT NULL AND x >= %s
+                    ) changes
+                ) runs
+                GROUP BY run, y ORDER BY run LIMIT %s
+                """,
+                [check_id, agent_id, start, limit],
+            )
+            return [
+                {"x": x, "x_end": x_end, "y": y, "count": count}
+                for x, x_end, y, count in cursor.fetchall()
+            ]
+
+
+def floor_time(value: dt.datetime, resolution: int) -> dt.datetime:
+    return dt.datetime.fromtimestamp(
+        int(value.timestamp()) // resolution * resolution, tz=dt.timezone.utc
+    )
+
+
+TRUNC_KINDS = {
+    CheckHistoryResolution.MINUTE: "minute",
+    CheckHistoryResolution.HOUR: "hour",
+    CheckHistoryResolution.DAY: "day",
+}
+
+
+class CheckHistoryRollup(models.Model):
+    # hourly and daily aggregates of CheckHistory, minute buckets are built from the raw rows
+    check_id = models.PositiveIntegerField()
+    agent_id = models.CharField(max_length=200)
+    resolution = models.PositiveIntegerField(choices=CheckHistoryResolution.choices)
+    x = models.DateTimeField()
+    y_min = models.PositiveIntegerField()
+    y_max = models.PositiveIntegerField()
+    y_sum = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["check_id", "agent_id", "resolution", "x"],
+                name="unique_check_history_rollup",
+            ),
+        ]
+        indexes = [models.Index(fields=["x"])]
+
+    def __str__(self):
+        return f"{self.get_resolution_display()} {self.x}"
+
+    @classmethod
+    def build(cls, resolution: int, until: dt.datetime) -> int:
+        # aggregates every complete bucket after the latest one stored,
+        # hours come from the raw rows and days from the hours
+        if resolution == CheckHistoryResolution.HOUR:
+            source = CheckHistory.objects.filter(
+                agent_id__isnull=False, y__isnull=False
+            )
+            aggregates = {
+                "min_y": Min("y"),
+                "max_y": Max("y"),
+                "sum_y": Sum("y"),
+                "samples": Count("y"),
+            }
+            step = dt.timedelta(hours=6)
+        else:
+            source = cls.objects.filter(resolution=CheckHistoryResolution.HOUR)
+            # annotations can't reuse the field names of the model they're on
+            aggregates = {
+                "min_y": Min("y_min"),
+                "max_y": Max("y_max"),
+                "sum_y": Sum("y_sum"),
+                "samples": Sum("count"),
+            }
+            step = dt.timedelta(days=7)
+
+        latest = cls.objects.filter(resolution=resolution).aggregate(latest=Max("x"))[
+            "latest"
+        ]
+        if latest:
+            start = latest + dt.timedelta(seconds=resolution)
+        else:
+            first = source.aggregate(first=Min("x"))["first"]
+            if not first:
+                return 0
+
+            start = floor_time(first, resolution)
+
+        end = floor_time(until, resolution)
+        created = 0
+        while start < end:
+            chunk_end = min(start + step, end)
+            rows = (
+                source.filter(x__gte=start, x__lt=chunk_end)
+                .annotate(bucket=Trunc("x", TRUNC_KINDS[resolution]))
+                .values("check_id", "agent_id", "bucket")
+                .annotate(**aggregates)
+                .order_by()
+            )
+            rollups = [
+                cls(
+                    check_id=row["check_id"],
+                    agent_id=row["agent_id"],
+                    resolution=resolution,
+                    x=row["bucket"],
+                    y_min=row["min_y"],
+                    y_max=row["max_y"],
+                    y_sum=row["sum_y"],
+                    count=row["samples"],
+                )
+                for row in rows
+            ]
+            cls.objects.bulk_create(rollups, batch_size=1000, ignore_conflicts=True)
+            created += len(rollups)
+            start = chunk_end
+
+        return created
+
+    @classmethod
+    def get_buckets(
+        cls,
+        check_id: int,
+        agent_id: str,
+        resolution: int,
+        start: Optional[dt.datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        raw_start = floor_time(start, resolution) if start else None
+        buckets: List[Dict[str, Any]] = []
+        if resolution != CheckHistoryResolution.MINUTE:
+            rollups = cls.objects.filter(
+                check_id=check_id, agent_id=agent_id, resolution=resolution
+            )
+            if raw_start:
+                rollups = rollups.filter(x__gte=raw_start)
+
+            buckets = list(
+                rollups.order_by("x").values("x", "y_min", "y_max", "y_sum", "count")
+            )
+            if buckets:
+                raw_start = buckets[-1]["x"] + dt.timedelta(seconds=resolution)
+
+        # anything that hasn't been rolled up yet is aggregated from the raw rows
+        raw = CheckHistory.objects.filter(
+            check_id=check_id, agent_id=agent_id, y__isnull=False
+        )
+        if raw_start:
+            raw = raw.filter(x__gte=raw_start)
+
+        buckets.extend(
+            {
+                "x": row.pop("bucket"),
+                **row,
+            }
+            for row in raw.annotate(bucket=Trunc("x", TRUNC_KINDS[resolution]))
+            .values("bucket")
+            .annotate(y_min=Min("y"), y_max=Max("y"), y_sum=Sum("y"), count=Count("y"))
+            .order_by("bucket")
+        )
+
+        for bucket in buckets:
+            bucket["x_end"] = bucket["x"] + dt.timedelta(seconds=resolution)
+
+        return buckets
+
+    @classmethod
+    def get_downsampled(
+        cls,
+        check_id: int,
+        agent_id: str,
+        start: dt.datetime,
+        end: dt.datetime,
+        max_points: int,
+    ) -> List[Dict[str, Any]]:
+        # evenly sized buckets so the window never comes back as more than max_points,
+        # built from the coarsest stored resolution that still fits inside one bucket
+        width = max(
+            math.ceil((end - start).total_seconds() / max(max_points - 1, 1)),
+            CheckHistoryResolution.MINUTE,
+        )
+        resolution = max(r for r in CheckHistoryResolution.values if r <= width)
+
+        merged: Dict[dt.datetime, Dict[str, Any]] = {}
+        for bucket in cls.get_buckets(check_id, agent_id, resolution, start):
+            x = floor_time(bucket["x"], width)
+            if x not in merged:
+                merged[x] = {**bucket, "x": x, "x_end": x + dt.timedelta(seconds=width)}
+            else:
+                row = merged[x]
+                row["y_min"] = min(row["y_min"], bucket["y_min"])
+                row["y_max"] = max(row["y_max"], bucket["y_max"])
+                row["y_sum"] += bucket["y_sum"]
+                row["count"] += bucket["count"]
+
+        return list(merged.values())[-max_points:]
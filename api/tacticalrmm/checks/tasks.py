@@ -7,7 +7,9 @@ from django.utils import timezone as djangotime
 
 from alerts.models import Alert
 from checks.models import CheckResult
+from checks.utils import create_check_history_partitions, drop_check_history_partitions
 from tacticalrmm.celery import app
+from tacticalrmm.constants import CheckHistoryResolution
 
 
 @app.task
@@ -121,11 +123,34 @@ def handle_resolved_check_email_alert_task(pk: int) -> str:
 
 @app.task
 def prune_check_history(older_than_days: int) -> str:
-    from .models import CheckHistory
+    from .models import CheckHistory, CheckHistoryRollup
 
-    CheckHistory.objects.filter(
-        x__lt=djangotime.make_aware(dt.datetime.today())
-        - djangotime.timedelta(days=older_than_days)
-    ).delete()
+    older_than = djangotime.make_aware(dt.datetime.today()) - djangotime.timedelta(
+        days=older_than_days
+    )
+
+    # whole days go with their partition, only the rest needs deleting row by row
+    drop_check_history_partitions(older_than)
+    CheckHistory.objects.filter(x__lt=older_than).delete()
+    CheckHistoryRollup.objects.filter(x__lt=older_than).delete()
+
+    return "ok"
+
+
+@app.task
+def rollup_check_history() -> str:
+    from .models import CheckHistoryRollup
+
+    now = djangotime.now()
+    # days are built from the hours so those go first
+    CheckHistoryRollup.build(CheckHistoryResolution.HOUR, now)
+    CheckHistoryRollup.build(CheckHistoryResolution.DAY, now)
+
+    return "ok"
+
+
+@app.task
+def create_check_history_partitions_task() -> str:
+    create_check_history_partitions()
 
     return "ok"
@@ -2,11 +2,14 @@ from unittest.mock import patch
 
 from django.conf import settings
 from django.utils import timezone as djangotime
-from model_bakery import baker
+from model_bakery import baker, seq
 
-from checks.models import CheckHistory, CheckResult
+from alerts.models import Alert
+from checks.models import CheckHistory, CheckHistoryRollup, CheckResult, floor_time
 from tacticalrmm.constants import (
     AlertSeverity,
+    AlertType,
+    CheckHistoryResolution,
     CheckStatus,
     CheckType,
     EvtLogFailWhen,
@@ -258,23 +261,29 @@ class TestCheckViews(TacticalTestCase):
         check_result = baker.make(
             "checks.CheckResult", assigned_check=check, agent=agent
         )
-        baker.make(
+        recent = baker.make(
             "checks.CheckHistory",
             check_id=check.id,
             agent_id=agent.agent_id,
+            y=seq(0),
             _quantity=30,
         )
-        check_history_data = baker.make(
+        old = baker.make(
             "checks.CheckHistory",
             check_id=check.id,
             agent_id=agent.agent_id,
+            y=50,
             _quantity=30,
         )
 
-        # need to manually set the date back 35 days
-        for check_history in check_history_data:
-            check_history.x = djangotime.now() - djangotime.timedelta(days=35)
-            check_history.save()
+        # keep each group inside a single hour and set the old ones back 35 days
+        now = djangotime.now()
+        CheckHistory.objects.filter(pk__in=[i.pk for i in recent]).update(
+            x=now - djangotime.timedelta(seconds=now.minute * 60 + now.second)
+        )
+        CheckHistory.objects.filter(pk__in=[i.pk for i in old]).update(
+            x=now - djangotime.timedelta(days=35)
+        )
 
         # test invalid check pk
         resp = self.client.patch("/checks/500/history/", format="json")
@@ -282,20 +291,99 @@ class TestCheckViews(TacticalTestCase):
 
         url = f"/checks/{check_result.id}/history/"
 
-        # test with timeFilter last 30 days
-        data = {"timeFilter": 30}
+        # short windows get the raw rows
+        data = {"timeFilter": 1}
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data), 30)
 
-        # test with timeFilter equal to 0
+        # test with timeFilter last 30 days, served hourly
+        data = {"timeFilter": 30}
+        resp = self.client.patch(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data[0]["y_min"], 1)
+        self.assertEqual(resp.data[0]["y_max"], 30)
+        self.assertEqual(resp.data[0]["y"], 16)
+
+        # test with timeFilter equal to 0, covers the retention period
         data = {"timeFilter": 0}
         resp = self.client.patch(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(len(resp.data), 60)
+        self.assertEqual(len(resp.data), 2)
+        self.assertEqual(resp.data[1]["y"], 50)
 
         self.check_not_authenticated("patch", url)
 
+    def test_get_check_history_downsampled(self):
+        agent = baker.make_recipe("agents.agent")
+        check = baker.make_recipe("checks.diskspace_check", agent=agent)
+        check_result = baker.make(
+            "checks.CheckResult", assigned_check=check, agent=agent
+        )
+        history = baker.make(
+            "checks.CheckHistory",
+            check_id=check.id,
+            agent_id=agent.agent_id,
+            y=seq(0),
+            _quantity=100,
+        )
+        now = djangotime.now()
+        for i, check_history in enumerate(history):
+            check_history.x = now - djangotime.timedelta(minutes=2 * i + 1)
+            check_history.save()
+
+        url = f"/checks/{check_result.id}/history/"
+
+        resp = self.client.patch(
+            url, {"timeFilter": 1, "maxPoints": "abc"}, format="json"
+        )
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.patch(url, {"timeFilter": 1, "maxPoints": 10}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(resp.data), 10)
+        self.assertEqual(min(i["y_min"] for i in resp.data), 1)
+        self.assertEqual(max(i["y_max"] for i in resp.data), 100)
+        # newest first
+        self.assertGreater(resp.data[0]["x"], resp.data[-1]["x"])
+
+        # pass/fail checks come back as runs of the same state
+        ping = baker.make_recipe("checks.ping_check", agent=agent)
+        ping_result = baker.make("checks.CheckResult", assigned_check=ping, agent=agent)
+        for i, y in enumerate((0, 0, 1, 1, 1, 0)):
+            CheckHistory.objects.create(check_id=ping.id, agent_id=agent.agent_id, y=y)
+            CheckHistory.objects.filter(check_id=ping.id, x__gt=now).update(
+                x=now - djangotime.timedelta(minutes=10 - i)
+            )
+
+        url = f"/checks/{ping_result.id}/history/"
+        resp = self.client.patch(url, {"timeFilter": 1, "maxPoints": 10}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [(i["y"], i["count"]) for i in resp.data], [(0, 1), (1, 3), (0, 2)]
+        )
+        runs = resp.data
+
+        # too many state changes for the budget falls back to buckets
+        resp = self.client.patch(url, {"timeFilter": 1, "maxPoints": 2}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(resp.data), 2)
+        self.assertEqual(max(i["y"] for i in resp.data), 1)
+
+        # both shapes come back with the same keys
+        self.assertEqual(set(runs[0].keys()), set(resp.data[0].keys()))
+
+        # history kept forever covers everything stored
+        self.coresettings.check_history_prune_days = 0
+        self.coresettings.save(update_fields=["check_history_prune_days"])
+        CheckHistory.objects.filter(check_id=ping.id).update(
+            x=now - djangotime.timedelta(days=60)
+        )
+        resp = self.client.patch(url, {"timeFilter": 0, "maxPoints": 10}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sum(i["count"] for i in resp.data), 6)
+
 
 class TestCheckTasks(TacticalTestCase):
     def setUp(self):
@@ -328,6 +416,93 @@ class TestCheckTasks(TacticalTestCase):
         prune_check_history(0)
         self.assertEqual(CheckHistory.objects.count(), 0)
 
+    def test_rollup_check_history(self):
+        from .tasks import rollup_check_history
+
+        check = baker.make_recipe("checks.diskspace_check", agent=self.agent)
+        history = baker.make(
+            "checks.CheckHistory",
+            check_id=check.id,
+            agent_id=self.agent.agent_id,
+            y=seq(0),
+            _quantity=10,
+        )
+        now = djangotime.now()
+        day = floor_time(now - djangotime.timedelta(days=2), 86400)
+        for i, check_history in enumerate(history):
+            check_history.x = day + djangotime.timedelta(hours=1 + i % 2, minutes=i)
+            check_history.save()
+
+        rollup_check_history()
+        hourly = CheckHistoryRollup.objects.filter(
+            resolution=CheckHistoryResolution.HOUR
+        ).order_by("x")
+        self.assertEqual(hourly.count(), 2)
+        self.assertEqual(
+            [(i.y_min, i.y_max, i.y_sum, i.count) for i in hourly],
+            [(1, 9, 25, 5), (2, 10, 30, 5)],
+        )
+        daily = CheckHistoryRollup.objects.get(resolution=CheckHistoryResolution.DAY)
+        self.assertEqual(
+            (daily.y_min, daily.y_max, daily.y_sum, daily.count), (1, 10, 55, 10)
+        )
+
+        # running again doesn't duplicate anything
+        rollup_check_history()
+        self.assertEqual(CheckHistoryRollup.objects.count(), 3)
+
+        # newer rows are served from the raw table until they're rolled up
+        baker.make(
+            "checks.CheckHistory",
+            check_id=check.id,
+            agent_id=self.agent.agent_id,
+            y=20,
+        )
+        buckets = CheckHistoryRollup.get_buckets(
+            check.id, self.agent.agent_id, CheckHistoryResolution.HOUR
+        )
+        self.assertEqual([i["count"] for i in buckets], [5, 5, 1])
+        self.assertEqual(buckets[-1]["y_max"], 20)
+
+        # raw rows are gone after pruning but the rollups still answer
+        CheckHistory.objects.filter(x__lt=now - djangotime.timedelta(days=1)).delete()
+        buckets = CheckHistoryRollup.get_buckets(
+            check.id,
+            self.agent.agent_id,
+            CheckHistoryResolution.DAY,
+            now - djangotime.timedelta(days=3),
+        )
+        self.assertEqual([i["count"] for i in buckets], [10, 1])
+
+    def test_check_history_partitions(self):
+        from .tasks import prune_check_history
+        from .utils import (
+            create_check_history_partitions,
+            get_check_history_partitions,
+        )
+
+        today = djangotime.now().date()
+        self.assertEqual(list(get_check_history_partitions().keys()), [today])
+
+        # a row with nowhere to go lands in the default partition and is moved later
+        check_history = baker.make("checks.CheckHistory")
+        check_history.x = djangotime.now() + djangotime.timedelta(days=1)
+        check_history.save()
+
+        created = create_check_history_partitions(days_ahead=2)
+        self.assertEqual(len(created), 2)
+        self.assertEqual(
+            sorted(get_check_history_partitions().keys()),
+            [today + djangotime.timedelta(days=i) for i in range(3)],
+        )
+        self.assertEqual(create_check_history_partitions(days_ahead=2), [])
+        self.assertTrue(CheckHistory.objects.filter(pk=check_history.pk).exists())
+
+        # nothing is old enough to drop yet
+        prune_check_history(30)
+        self.assertEqual(len(get_check_history_partitions()), 3)
+        self.assertEqual(CheckHistory.objects.count(), 1)
+
     def test_handle_script_check(self):
         url = "/api/v3/checkrunner/"
 
@@ -875,6 +1050,66 @@ class TestCheckTasks(TacticalTestCase):
 
         self.assertEqual(check_result.status, CheckStatus.PASSING)
 
+    def test_handle_check_results_batch(self):
+        url = f"/api/v3/{self.agent.agent_id}/checkresults/"
+
+        ping = baker.make_recipe(
+            "checks.ping_check", agent=self.agent, dashboard_alert=True
+        )
+        script = baker.make_recipe("checks.script_check", agent=self.agent)
+        baker.make("checks.CheckResult", assigned_check=ping, agent=self.agent)
+        script_alert = baker.make(
+            "alerts.Alert",
+            agent=self.agent,
+            assigned_check=script,
+            alert_type=AlertType.CHECK,
+            resolved=False,
+        )
+
+        data = {
+            "results": [
+                {"id": ping.id, "status": CheckStatus.FAILING, "output": "timeout"},
+                {
+                    "id": script.id,
+                    "retcode": 0,
+                    "stderr": "",
+                    "stdout": "ok",
+                    "runtime": 1.5,
+                },
+            ]
+        }
+
+        resp = self.client.post(url, data, format="json")
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(
+            CheckResult.objects.get(assigned_check=ping).status, CheckStatus.FAILING
+        )
+        self.assertEqual(
+            CheckResult.objects.get(assigned_check=script).status, CheckStatus.PASSING
+        )
+        self.assertEqual(CheckHistory.objects.filter(check_id=ping.id).count(), 1)
+        self.assertEqual(CheckHistory.objects.filter(check_id=script.id).count(), 1)
+
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.checks_warning, 1)
+
+        # alerts are handled once for the whole batch
+        ping_alert = Alert.objects.get(assigned_check=ping, agent=self.agent)
+        self.assertFalse(ping_alert.resolved)
+        self.assertFalse(ping_alert.hidden)
+        script_alert.refresh_from_db()
+        self.assertTrue(script_alert.resolved)
+
+        resp = self.client.post(url, {"results": "bad"}, format="json")
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post(url, {"results": [{"id": "abc"}]}, format="json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.data, "Invalid check results")
+
+        self.check_not_authenticated("post", url)
+
 
 class TestCheckPermissions(TacticalTestCase):
     def setUp(self):
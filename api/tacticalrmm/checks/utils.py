@@ -1,3 +1,20 @@
+import datetime as dt
+import re
+from typing import Dict, List, Optional
+
+from django.db import connection, transaction
+from django.utils import timezone as djangotime
+
+from tacticalrmm.constants import CheckHistoryResolution
+
+from .constants import CHECK_HISTORY_WINDOWS
+
+# CheckHistory is range partitioned on x with one partition per day, named after the
+# last day it holds. The first partition (the table from before partitioning) also
+# holds everything older than that, rows outside of any partition go to the default one
+CHECK_HISTORY_TABLE = "checks_checkhistory"
+
+
 def bytes2human(n: int) -> str:
     # http://code.activestate.com/recipes/578019
     symbols = ("K", "M", "G", "T", "P", "E", "Z", "Y")
@@ -9,3 +26,93 @@ def bytes2human(n: int) -> str:
             value = float(n) / prefix[s]
             return "%.1f%s" % (value, s)
     return "%sB" % n
+
+
+def get_check_history_resolution(days: int) -> Optional[int]:
+    # the finest resolution that still fits the window, 0 days means no limit
+    for max_days, resolution in CHECK_HISTORY_WINDOWS:
+        if days and days <= max_days:
+            return resolution
+
+    return CheckHistoryResolution.DAY
+
+
+def _day_start(day: dt.date) -> dt.datetime:
+    return dt.datetime.combine(day, dt.time.min, tzinfo=dt.timezone.utc)
+
+
+def get_check_history_partitions() -> Optional[Dict[dt.date, str]]:
+    # returns None when the table isn't partitioned
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE oid = %s::regclass",
+            [CHECK_HISTORY_TABLE],
+        )
+        if cursor.fetchone()[0] != "p":
+            return None
+
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [CHECK_HISTORY_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = {}
+    for name in names:
+        match = re.fullmatch(rf"{CHECK_HISTORY_TABLE}_p(\d{{8}})", name)
+        if match:
+            partitions[dt.datetime.strptime(match.group(1), "%Y%m%d").date()] = name
+
+    return partitions
+
+
+def create_check_history_partitions(days_ahead: int = 3) -> List[str]:
+    partitions = get_check_history_partitions()
+    if partitions is None:
+        return []
+
+    today = djangotime.now().date()
+    day = max(max(partitions) + dt.timedelta(days=1), today) if partitions else today
+    created = []
+    while day <= today + dt.timedelta(days=days_ahead):
+        name = f"{CHECK_HISTORY_TABLE}_p{day:%Y%m%d}"
+        start = _day_start(day)
+        end = start + dt.timedelta(days=1)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TABLE "{name}" (LIKE "{CHECK_HISTORY_TABLE}" '
+                "INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            )
+            # rows that went to the default partition because this one didn't exist yet
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM "{CHECK_HISTORY_TABLE}_default" '
+                "WHERE x >= %s AND x < %s RETURNING *) "
+                f'INSERT INTO "{name}" SELECT * FROM moved',
+                [start, end],
+            )
+            cursor.execute(
+                f'ALTER TABLE "{CHECK_HISTORY_TABLE}" ATTACH PARTITION "{name}" '
+                "FOR VALUES FROM (%s) TO (%s)",
+                [start, end],
+            )
+
+        created.append(name)
+        day += dt.timedelta(days=1)
+
+    return created
+
+
+def drop_check_history_partitions(older_than: dt.datetime) -> List[str]:
+    # a partition only holds rows from before the end of its day
+    dropped = []
+    for day, name in sorted((get_check_history_partitions() or {}).items()):
+        if _day_start(day + dt.timedelta(days=1)) > older_than:
+            break
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE "{name}"')
+
+        dropped.append(name)
+
+    return dropped
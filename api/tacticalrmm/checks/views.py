@@ -1,7 +1,8 @@
 import asyncio
 from datetime import datetime as dt
+from typing import Any, Dict, List
 
-from django.db.models import Q
+from django.db.models import Min, Q
 from django.shortcuts import get_object_or_404
 from django.utils import timezone as djangotime
 from rest_framework.decorators import api_view, permission_classes
@@ -13,13 +14,15 @@ from rest_framework.views import APIView
 from agents.models import Agent
 from alerts.models import Alert
 from automation.models import Policy
+from core.utils import get_core_settings
 from tacticalrmm.constants import CheckStatus, CheckType
 from tacticalrmm.helpers import notify_error
 from tacticalrmm.permissions import _has_perm_on_agent
 
-from .models import Check, CheckHistory, CheckResult
+from .models import Check, CheckHistory, CheckHistoryRollup, CheckResult
 from .permissions import ChecksPerms, RunChecksPerms
 from .serializers import CheckHistorySerializer, CheckSerializer
+from .utils import get_check_history_resolution
 
 
 class GetAddChecks(APIView):
@@ -139,25 +142,115 @@ class GetCheckHistory(APIView):
         if result.agent and not _has_perm_on_agent(request.user, result.agent.agent_id):
             raise PermissionDenied()
 
-        timeFilter = Q()
+        days = request.data.get("timeFilter", 0)
+        check = result.assigned_check
+        agent_id = result.agent.agent_id
 
-        if "timeFilter" in request.data:
-            if request.data["timeFilter"] != 0:
+        # percentages are averaged, pass/fail checks show a failure anywhere in the bucket
+        averaged = check.check_type in (
+            CheckType.CPU_LOAD,
+            CheckType.MEMORY,
+            CheckType.DISK_SPACE,
+        )
+
+        if "maxPoints" in request.data:
+            try:
+                max_points = int(request.data["maxPoints"])
+            except (TypeError, ValueError):
+                return notify_error("maxPoints must be a number")
+
+            if max_points < 1:
+                return notify_error("maxPoints must be at least 1")
+
+            end = djangotime.now()
+            days = days or get_core_settings().check_history_prune_days
+            if days:
+                start = end - djangotime.timedelta(days=days)
+            else:
+                # history is kept forever, so the window starts at the oldest row
+                start = (
+                    CheckHistory.objects.filter(
+                        check_id=check.id, agent_id=agent_id
+                    ).aggregate(start=Min("x"))["start"]
+                    or end
+                )
+
+            if not averaged:
+                # one point per run of the same state, as long as the state didn't flap too often
+                runs = CheckHistory.get_state_runs(
+                    check.id, agent_id, start, max_points + 1
+                )
+                if len(runs) <= max_points:
+                    return Response(self.format_runs(runs))
+
+            buckets = CheckHistoryRollup.get_downsampled(
+                check.id, agent_id, start, end, max_points
+            )
+            return Response(self.format_buckets(buckets, averaged))
+
+        # "all" covers whatever is kept
+        resolution = get_check_history_resolution(
+            days or get_core_settings().check_history_prune_days
+        )
+
+        if resolution is None:
+            timeFilter = Q()
+            if days != 0:
                 timeFilter = Q(
                     x__lte=djangotime.make_aware(dt.today()),
                     x__gt=djangotime.make_aware(dt.today())
-                    - djangotime.timedelta(days=request.data["timeFilter"]),
+                    - djangotime.timedelta(days=days),
                 )
 
-        check_history = (
-            CheckHistory.objects.filter(
-                check_id=result.assigned_check.id, agent_id=result.agent.agent_id
+            check_history = (
+                CheckHistory.objects.filter(check_id=check.id, agent_id=agent_id)
+                .filter(timeFilter)
+                .order_by("-x")
             )
-            .filter(timeFilter)
-            .order_by("-x")
+
+            return Response(CheckHistorySerializer(check_history, many=True).data)
+
+        buckets = CheckHistoryRollup.get_buckets(
+            check.id,
+            agent_id,
+            resolution,
+            djangotime.now() - djangotime.timedelta(days=days) if days else None,
         )
 
-        return Response(CheckHistorySerializer(check_history, many=True).data)
+        return Response(self.format_buckets(buckets, averaged))
+
+    @staticmethod
+    def format_runs(runs) -> List[Dict[str, Any]]:
+        # same schema as format_buckets so the chart doesn't care which one it got
+        return [
+            {
+                "x": run["x"],
+                "x_end": run["x_end"],
+                "y": run["y"],
+                "y_min": run["y"],
+                "y_max": run["y"],
+                "count": run["count"],
+                "results": None,
+            }
+            for run in reversed(runs)
+        ]
+
+    @staticmethod
+    def format_buckets(buckets, averaged: bool) -> List[Dict[str, Any]]:
+        return [
+            {
+                "x": bucket["x"],
+                "x_end": bucket["x_end"],
+                "y": round(bucket["y_sum"] / bucket["count"])
+                if averaged
+                else bucket["y_max"],
+                "y_min": bucket["y_min"],
+                "y_max": bucket["y_max"],
+                "count": bucket["count"],
+                "results": None,
+            }
+            for bucket in reversed(buckets)
+        ]
 
 
 @api_view(["POST"])
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0021_remove_client_agent_count_remove_site_agent_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='failing_error_agents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='failing_warning_agents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='failing_error_agents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='failing_warning_agents',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -2,10 +2,12 @@ import uuid
 from typing import Dict
 
 from django.contrib.postgres.fields import ArrayField
-from django.core.cache import cache
 from django.db import models
+from django.db.models import BooleanField, ExpressionWrapper, F, Q
+from django.db.models.functions import JSONObject
 
 from agents.models import Agent
+from automation.utils import bump_policy_graph_version
 from logs.models import BaseAuditModel
 from tacticalrmm.constants import AGENT_DEFER, AgentMonType, CustomFieldType
 from tacticalrmm.models import PermissionQuerySet
@@ -15,12 +17,33 @@ def _default_failing_checks_data() -> Dict[str, bool]:
     return {"error": False, "warning": False}
 
 
+class FailingChecksQuerySet(PermissionQuerySet):
+    def apply_failing_delta(self, error: int, warning: int) -> int:
+        # adjusts the failing agent counters and rebuilds failing_checks from them in one statement
+        # the right hand side sees the old counter values, hence comparing against the negated delta
+        return self.update(
+            failing_error_agents=F("failing_error_agents") + error,
+            failing_warning_agents=F("failing_warning_agents") + warning,
+            failing_checks=JSONObject(
+                error=ExpressionWrapper(
+                    Q(failing_error_agents__gt=-error), output_field=BooleanField()
+                ),
+                warning=ExpressionWrapper(
+                    Q(failing_warning_agents__gt=-warning), output_field=BooleanField()
+                ),
+            ),
+        )
+
+
 class Client(BaseAuditModel):
-    objects = PermissionQuerySet.as_manager()
+    objects = FailingChecksQuerySet.as_manager()
 
     name = models.CharField(max_length=255, unique=True)
     block_policy_inheritance = models.BooleanField(default=False)
     failing_checks = models.JSONField(default=_default_failing_checks_data)
+    # number of agents currently contributing an error/warning to failing_checks
+    failing_error_agents = models.IntegerField(default=0)
+    failing_warning_agents = models.IntegerField(default=0)
     workstation_policy = models.ForeignKey(
         "automation.Policy",
         related_name="workstation_clients",
@@ -61,20 +84,15 @@ class Client(BaseAuditModel):
             or old_client.workstation_policy != self.workstation_policy
             or old_client.server_policy != self.server_policy
         ):
-            cache_agents_alert_template.delay()
+            cache_agents_alert_template.delay(client=self.pk)
 
-        if old_client and (
-            old_client.workstation_policy != self.workstation_policy
+        if (
+            not old_client
+            or old_client.workstation_policy != self.workstation_policy
             or old_client.server_policy != self.server_policy
+            or old_client.block_policy_inheritance != self.block_policy_inheritance
         ):
-            sites = self.sites.all()
-            if old_client.workstation_policy != self.workstation_policy:
-                for site in sites:
-                    cache.delete_many_pattern(f"site_workstation_{site.pk}_*")
-
-            if old_client.server_policy != self.server_policy:
-                for site in sites:
-                    cache.delete_many_pattern(f"site_server_{site.pk}_*")
+            bump_policy_graph_version()
 
     class Meta:
         ordering = ("name",)
@@ -95,12 +113,15 @@ class Client(BaseAuditModel):
 
 
 class Site(BaseAuditModel):
-    objects = PermissionQuerySet.as_manager()
+    objects = FailingChecksQuerySet.as_manager()
 
     client = models.ForeignKey(Client, related_name="sites", on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     block_policy_inheritance = models.BooleanField(default=False)
     failing_checks = models.JSONField(default=_default_failing_checks_data)
+    # number of agents currently contributing an error/warning to failing_checks
+    failing_error_agents = models.IntegerField(default=0)
+    failing_warning_agents = models.IntegerField(default=0)
     workstation_policy = models.ForeignKey(
         "automation.Policy",
         related_name="workstation_sites",
@@ -142,13 +163,16 @@ class Site(BaseAuditModel):
                 or old_site.workstation_policy != self.workstation_policy
                 or old_site.server_policy != self.server_policy
             ):
-                cache_agents_alert_template.delay()
-
-            if old_site.workstation_policy != self.workstation_policy:
-                cache.delete_many_pattern(f"site_workstation_{self.pk}_*")
-
-            if old_site.server_policy != self.server_policy:
-                cache.delete_many_pattern(f"site_server_{self.pk}_*")
+                cache_agents_alert_template.delay(site=self.pk)
+
+        if (
+            not old_site
+            or old_site.workstation_policy != self.workstation_policy
+            or old_site.server_policy != self.server_policy
+            or old_site.block_policy_inheritance != self.block_policy_inheritance
+            or old_site.client_id != self.client_id
+        ):
+            bump_policy_graph_version()
 
     class Meta:
         ordering = ("name",)
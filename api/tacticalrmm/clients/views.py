@@ -1,8 +1,17 @@
 import datetime as dt
 import re
 import uuid
-
-from django.db.models import Count, Exists, OuterRef, Prefetch, prefetch_related_objects
+from typing import Tuple
+
+from django.db.models import (
+    Count,
+    Exists,
+    OuterRef,
+    Prefetch,
+    Q,
+    QuerySet,
+    prefetch_related_objects,
+)
 from django.shortcuts import get_object_or_404
 from django.utils import timezone as djangotime
 from knox.models import AuthToken
@@ -27,6 +36,15 @@ from .serializers import (
 )
 
 
+def _failing_counts(agents: "QuerySet[Agent]") -> Tuple[int, int]:
+    # agents counted in failing_checks, for moving them to another site in bulk
+    counts = agents.aggregate(
+        error=Count("pk", filter=Q(failing_error=True)),
+        warning=Count("pk", filter=Q(failing_warning=True)),
+    )
+    return counts["error"], counts["warning"]
+
+
 class GetAddClients(APIView):
     permission_classes = [IsAuthenticated, ClientsPerms]
 
@@ -175,7 +193,9 @@ class GetUpdateDeleteClient(APIView):
         if agent_count > 0 and "move_to_site" in request.query_params.keys():
             agents = Agent.objects.filter(site__client=client)
             site = get_object_or_404(Site, pk=request.query_params["move_to_site"])
+            failing = _failing_counts(agents)
             agents.update(site=site)
+            Agent.apply_site_failing_delta(site.pk, *failing)
 
         elif agent_count > 0:
             return notify_error(
@@ -275,7 +295,12 @@ class GetUpdateDeleteSite(APIView):
         if agent_count > 0 and "move_to_site" in request.query_params.keys():
             agents = Agent.objects.filter(site=site)
             new_site = get_object_or_404(Site, pk=request.query_params["move_to_site"])
+            error, warning = _failing_counts(agents)
             agents.update(site=new_site)
+            Client.objects.filter(pk=site.client_id).apply_failing_delta(
+                -error, -warning
+            )
+            Agent.apply_site_failing_delta(new_site.pk, error, warning)
 
         elif agent_count > 0:
             return notify_error(
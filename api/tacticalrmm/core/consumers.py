@@ -1,13 +1,14 @@
-import asyncio
+import time
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import F
-from django.utils import timezone as djangotime
+from django.core.cache import cache
 
-from agents.models import Agent
-from tacticalrmm.constants import AgentMonType
+from tacticalrmm.constants import DASH_INFO_COUNTS_KEY, DASH_INFO_GROUP, AgentMonType
+
+from .utils import get_site_agent_counts
 
 
 class DashInfo(AsyncJsonWebsocketConsumer):
@@ -17,64 +18,65 @@ class DashInfo(AsyncJsonWebsocketConsumer):
 
         if isinstance(self.user, AnonymousUser):
             await self.close()
+            return
+
+        # what the user can see is worked out once, a role change needs a reconnect
+        self.sites, self.clients = await self.get_visible_sites()
 
         await self.accept()
-        self.connected = True
-        self.dash_info = asyncio.create_task(self.send_dash_info())
+        await self.channel_layer.group_add(DASH_INFO_GROUP, self.channel_name)
+        await self.send_counts(await self.get_latest_counts())
 
     async def disconnect(self, close_code):
-
-        try:
-            self.dash_info.cancel()
-        except:
-            pass
-
-        self.connected = False
-        await self.close()
+        await self.channel_layer.group_discard(DASH_INFO_GROUP, self.channel_name)
 
     async def receive(self, json_data=None):
         pass
 
     @database_sync_to_async
-    def get_dashboard_info(self):
-        total_server_agents_count = (
-            Agent.objects.filter_by_role(self.user)
-            .filter(monitoring_type=AgentMonType.SERVER)
-            .count()
-        )
-        offline_server_agents_count = (
-            Agent.objects.filter_by_role(self.user)
-            .filter(monitoring_type=AgentMonType.SERVER)
-            .filter(
-                last_seen__lt=djangotime.now()
-                - (djangotime.timedelta(minutes=1) * F("offline_time"))
-            )
-            .count()
-        )
-        total_workstation_agents_count = (
-            Agent.objects.filter_by_role(self.user)
-            .filter(monitoring_type=AgentMonType.WORKSTATION)
-            .count()
-        )
-        offline_workstation_agents_count = (
-            Agent.objects.filter_by_role(self.user)
-            .filter(monitoring_type=AgentMonType.WORKSTATION)
-            .filter(
-                last_seen__lt=djangotime.now()
-                - (djangotime.timedelta(minutes=1) * F("offline_time"))
-            )
-            .count()
-        )
-
-        return {
-            "total_server_offline_count": offline_server_agents_count,
-            "total_workstation_offline_count": offline_workstation_agents_count,
-            "total_server_count": total_server_agents_count,
-            "total_workstation_count": total_workstation_agents_count,
+    def get_visible_sites(self):
+        # same rules as filter_by_role on agents, None means everything
+        role = self.user.role
+        if self.user.is_superuser or (role and role.is_superuser) or not role:
+            return None, None
+
+        sites = set(role.can_view_sites.values_list("pk", flat=True))
+        clients = set(role.can_view_clients.values_list("pk", flat=True))
+        if not sites and not clients:
+            return None, None
+
+        return sites, clients
+
+    @database_sync_to_async
+    def get_latest_counts(self):
+        # whatever the producer sent last, unless it stopped sending
+        last = cache.get(DASH_INFO_COUNTS_KEY)
+        if last and time.time() - last["published"] < settings.DASH_INFO_HEARTBEAT * 2:
+            return last["counts"]
+
+        return get_site_agent_counts()
+
+    async def dash_counts(self, event):
+        await self.send_counts(event["counts"])
+
+    async def send_counts(self, counts):
+        ret = {
+            "total_server_offline_count": 0,
+            "total_workstation_offline_count": 0,
+            "total_server_count": 0,
+            "total_workstation_count": 0,
         }
+        for site, client, mon_type, total, offline in counts:
+            if self.sites is not None and not (
+                site in self.sites or client in self.clients
+            ):
+                continue
+
+            if mon_type == AgentMonType.SERVER:
+                ret["total_server_count"] += total
+                ret["total_server_offline_count"] += offline
+            elif mon_type == AgentMonType.WORKSTATION:
+                ret["total_workstation_count"] += total
+                ret["total_workstation_offline_count"] += offline
 
-    async def send_dash_info(self):
-        while self.connected:
-            c = await self.get_dashboard_info()
-            await self.send_json(c)
-            await asyncio.sleep(30)
+        await self.send_json(ret)
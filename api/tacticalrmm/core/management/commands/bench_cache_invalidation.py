@@ -0,0 +1,109 @@
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tacticalrmm.cache import TacticalRedisCache
+
+
+class Command(BaseCommand):
+    help = "Measure redis latency while invalidating a key pattern with KEYS vs SCAN"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--location",
+            type=str,
+            default=settings.CACHES["default"]["LOCATION"],
+            help="Redis url, defaults to the cache from settings. e.g. redis://127.0.0.1:6379",
+        )
+        parser.add_argument(
+            "--db",
+            type=int,
+            default=15,
+            help="Redis db to fill, it is flushed afterwards so don't point this at a db in use",
+        )
+        parser.add_argument(
+            "--keys", type=int, default=100_000, help="Unrelated keys present in redis"
+        )
+        parser.add_argument(
+            "--matching", type=int, default=5000, help="Keys matching the pattern"
+        )
+
+    def handle(self, *args, **kwargs):
+        cache = TacticalRedisCache(
+            kwargs["location"], {"OPTIONS": {"db": kwargs["db"]}}
+        )
+        client = cache._cache.get_client(write=True)
+
+        results = {}
+        for name in ("keys", "scan"):
+            client.flushdb()
+            self.fill(cache, client, kwargs["keys"], kwargs["matching"])
+
+            latencies: list[float] = []
+            stop = threading.Event()
+            probe = threading.Thread(
+                target=self.probe, args=(cache, latencies, stop), daemon=True
+            )
+            probe.start()
+            time.sleep(0.5)
+
+            start = time.perf_counter()
+            if name == "keys":
+                # what delete_many_pattern used to do
+                found = client.keys(cache.make_key("bench_inv_*"))
+                if found:
+                    client.delete(*found)
+            else:
+                cache.delete_many_pattern("bench_inv_*")
+            elapsed = time.perf_counter() - start
+
+            time.sleep(0.5)
+            stop.set()
+            probe.join()
+
+            left = len(client.keys(cache.make_key("bench_inv_*")))
+            latencies.sort()
+            results[name] = {
+                "invalidation_ms": elapsed * 1000,
+                "probe_p50_ms": statistics.median(latencies) * 1000,
+                "probe_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+                "probe_max_ms": latencies[-1] * 1000,
+                "left": left,
+            }
+
+        client.flushdb()
+
+        self.stdout.write(
+            f"{kwargs['keys']:,} unrelated keys, {kwargs['matching']:,} matching keys"
+        )
+        self.stdout.write(
+            f"{'':<6}{'invalidate':>12}{'probe p50':>12}{'probe p99':>12}{'probe max':>12}"
+        )
+        for name, r in results.items():
+            self.stdout.write(
+                f"{name:<6}{r['invalidation_ms']:>10.1f}ms{r['probe_p50_ms']:>10.2f}ms"
+                f"{r['probe_p99_ms']:>10.2f}ms{r['probe_max_ms']:>10.2f}ms"
+            )
+            if r["left"]:
+                self.stdout.write(self.style.ERROR(f"{name}: {r['left']} keys left"))
+
+    def fill(self, cache, client, keys: int, matching: int) -> None:
+        pipe = client.pipeline(transaction=False)
+        for i in range(keys):
+            pipe.set(cache.make_key(f"bench_fill_{i}"), 1)
+            if i % 10_000 == 0:
+                pipe.execute()
+        for i in range(matching):
+            pipe.set(cache.make_key(f"bench_inv_{i}"), 1)
+        pipe.execute()
+
+    def probe(self, cache, latencies: list[float], stop: threading.Event) -> None:
+        # stands in for everything else sharing redis, like the celery broker
+        client = cache._cache.get_client(write=True)
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.get(cache.make_key("bench_fill_0"))
+            latencies.append(time.perf_counter() - start)
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import msgpack
+import nats
+from django.core.management.base import BaseCommand
+
+from tacticalrmm.nats_utils import NatsConnectionManager, get_nats_options
+
+
+class Command(BaseCommand):
+    help = "Compare connect-per-call NATS messaging with the pooled connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--server",
+            type=str,
+            help="NATS server url, defaults to the one from settings. e.g. nats://127.0.0.1:4222",
+        )
+        parser.add_argument("--user", type=str, help="NATS user")
+        parser.add_argument("--password", type=str, help="NATS password")
+        parser.add_argument(
+            "--count", type=int, default=1000, help="Messages to send per path"
+        )
+        parser.add_argument(
+            "--request",
+            action="store_true",
+            help="Use request/reply against a local echo responder instead of publish",
+        )
+
+    def handle(self, *args, **kwargs):
+        options = get_nats_options()
+        if kwargs["server"]:
+            options["servers"] = kwargs["server"]
+            options.pop("user", None)
+            options.pop("password", None)
+        if kwargs["user"]:
+            options["user"] = kwargs["user"]
+        if kwargs["password"]:
+            options["password"] = kwargs["password"]
+
+        count: int = kwargs["count"]
+        request: bool = kwargs["request"]
+        subject = "trmm-bench"
+        payload = msgpack.dumps({"func": "ping"})
+
+        async def one_shot() -> None:
+            # what Agent.nats_cmd did before the pooled connection
+            nc = await nats.connect(**options)
+            if request:
+                await nc.request(subject, payload, timeout=5)
+            else:
+                await nc.publish(subject, payload)
+                await nc.flush()
+            await nc.close()
+
+        manager = NatsConnectionManager(options=options)
+
+        async def pooled() -> None:
+            if request:
+                await manager.request(subject, payload, timeout=5)
+            else:
+                await manager.publish(subject, payload)
+
+        async def responder(ready, stop) -> None:
+            nc = await nats.connect(**options)
+
+            async def reply(msg):
+                await msg.respond(msgpack.dumps("pong"))
+
+            await nc.subscribe(subject, cb=reply)
+            await nc.flush()
+            ready.set()
+            await stop.wait()
+            await nc.drain()
+
+        # the responder lives on the manager's loop so it doesn't compete with the callers
+        ready, stop = asyncio.Event(), asyncio.Event()
+        if request:
+            manager.loop.call_soon_threadsafe(
+                lambda: asyncio.ensure_future(responder(ready, stop))
+            )
+            while not ready.is_set():
+                time.sleep(0.05)
+
+        results = {}
+        for name, func, run in (
+            ("connect per call", one_shot, asyncio.run),
+            ("pooled", pooled, manager.run),
+        ):
+            start = time.perf_counter()
+            for _ in range(count):
+                run(func())
+            elapsed = time.perf_counter() - start
+            results[name] = count / elapsed
+            self.stdout.write(
+                f"{name:<20} {count} msgs in {elapsed:.2f}s ({results[name]:,.0f} msg/s)"
+            )
+
+        if request:
+            manager.loop.call_soon_threadsafe(stop.set)
+        manager.close()
+
+        speedup = results["pooled"] / results["connect per call"]
+        self.stdout.write(self.style.SUCCESS(f"pooled is {speedup:.1f}x faster"))
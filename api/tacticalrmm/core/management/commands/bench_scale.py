@@ -0,0 +1,438 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+import uuid
+from typing import Any, Callable
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as djangotime
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from accounts.models import User
+from agents.management.commands.fake_agents import WIN_UPDATES
+from agents.models import Agent
+from agents.tasks import agent_outages_task
+from agents.views import GetAgents
+from alerts.models import Alert
+from apiv3.views import CheckRunner, CheckRunnerResults, WinUpdates
+from automation.models import Policy
+from automation.utils import bump_policy_graph_version
+from checks.models import Check, CheckHistory, CheckHistoryRollup, CheckResult
+from clients.models import Client, Site
+from core.tasks import cache_db_fields_task, handle_resolved_stuff
+from tacticalrmm.constants import (
+    AgentMonType,
+    AgentPlat,
+    AlertSeverity,
+    AlertType,
+    CheckStatus,
+    CheckType,
+)
+from tacticalrmm.demo_data import disks, disks_linux_deb, ping_success_output
+from winupdate.models import WinUpdate, WinUpdatePolicy
+
+
+class Command(BaseCommand):
+    help = "Generate a large fleet of fake agents and measure beat tasks and agent facing endpoints against it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--agents", type=int, default=10_000, help="Number of agents to generate"
+        )
+        parser.add_argument(
+            "--sites", type=int, default=100, help="Sites the agents are spread over"
+        )
+        parser.add_argument(
+            "--history", type=int, default=10, help="Check history rows per check"
+        )
+        parser.add_argument(
+            "--failing",
+            type=float,
+            default=0.05,
+            help="Fraction of check results failing with an open alert",
+        )
+        parser.add_argument(
+            "--overdue",
+            type=float,
+            default=0.02,
+            help="Fraction of agents that are overdue without an alert yet",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Times each target is measured"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=5000, help="bulk_create batch size"
+        )
+        parser.add_argument(
+            "--output",
+            type=str,
+            default="",
+            help="Write the report as json to this file, e.g. bench-$(git rev-parse --short HEAD).json",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Don't delete the generated agents afterwards",
+        )
+
+    def handle(self, *args, **kwargs):
+        random.seed(0)
+        self.batch_size = kwargs["batch_size"]
+        self.prefix = f"bench-{uuid.uuid4().hex[:8]}"
+
+        start = time.perf_counter()
+        self.generate(kwargs)
+        self.stdout.write(
+            f"Generated {kwargs['agents']:,} agents in {time.perf_counter() - start:.1f}s"
+        )
+
+        try:
+            results = {
+                name: self.measure(func, kwargs["repeat"])
+                for name, func in self.targets().items()
+            }
+        finally:
+            if not kwargs["keep"]:
+                self.cleanup()
+
+        report = {
+            "commit": self.get_commit(),
+            "date": djangotime.now().isoformat(),
+            "agents": kwargs["agents"],
+            "sites": kwargs["sites"],
+            "history": kwargs["history"],
+            "failing": kwargs["failing"],
+            "overdue": kwargs["overdue"],
+            "repeat": kwargs["repeat"],
+            "results": results,
+        }
+
+        if kwargs["output"]:
+            with open(kwargs["output"], "w") as f:
+                json.dump(report, f, indent=2)
+
+        self.stdout.write(
+            f"{'target':<28}{'queries':>10}{'first ms':>12}{'median ms':>12}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28}{result['queries']:>10}{result['first_ms']:>12.1f}{result['median_ms']:>12.1f}"
+            )
+
+    def generate(self, kwargs) -> None:
+        now = djangotime.now()
+        history = kwargs["history"]
+
+        self.user = User.objects.create_user(  # type: ignore
+            username=self.prefix, password=uuid.uuid4().hex, is_superuser=True
+        )
+
+        self.policy = Policy(name=self.prefix, desc=self.prefix, active=True)
+        self.policy.save()
+        policy_checks = Check.objects.bulk_create(
+            [
+                Check(
+                    policy=self.policy,
+                    check_type=CheckType.CPU_LOAD,
+                    warning_threshold=70,
+                    error_threshold=90,
+                ),
+                Check(
+                    policy=self.policy,
+                    check_type=CheckType.MEMORY,
+                    warning_threshold=70,
+                    error_threshold=90,
+                ),
+                Check(
+                    policy=self.policy,
+                    check_type=CheckType.DISK_SPACE,
+                    disk="C:",
+                    warning_threshold=25,
+                    error_threshold=10,
+                ),
+            ]
+        )
+
+        sites = []
+        for i in range(max(1, kwargs["sites"] // 10)):
+            client = Client(
+                name=f"{self.prefix}-{i}",
+                server_policy=self.policy,
+                workstation_policy=self.policy,
+            )
+            client.save()
+            for j in range(10):
+                site = Site(client=client, name=f"{self.prefix}-{i}-{j}")
+                site.save()
+                sites.append(site)
+
+        bump_policy_graph_version()
+
+        agents = []
+        for i in range(kwargs["agents"]):
+            linux = i % 10 == 0
+            overdue = random.random() < kwargs["overdue"]
+            agents.append(
+                Agent(
+                    agent_id=f"{self.prefix}-{i:07d}",
+                    hostname=f"{self.prefix}-{i}",
+                    site=sites[i % len(sites)],
+                    version=settings.LATEST_AGENT_VER,
+                    plat=AgentPlat.LINUX if linux else AgentPlat.WINDOWS,
+                    goarch="amd64",
+                    monitoring_type=AgentMonType.SERVER
+                    if linux or i % 4 == 0
+                    else AgentMonType.WORKSTATION,
+                    operating_system="Microsoft Windows 10 Pro, 64bit (build 19044)",
+                    disks=disks_linux_deb if linux else random.choice(disks),
+                    total_ram=16,
+                    boot_time=now.timestamp() - 3600,
+                    logged_in_username="None",
+                    last_seen=now - djangotime.timedelta(hours=2) if overdue else now,
+                    overdue_dashboard_alert=True,
+                )
+            )
+        agents = self.bulk_create(Agent, agents)
+        self.bulk_create(WinUpdatePolicy, [WinUpdatePolicy(agent=a) for a in agents])
+
+        agent_checks = self.bulk_create(
+            Check,
+            [
+                Check(
+                    agent=agent,
+                    check_type=CheckType.PING,
+                    name="Gateway",
+                    ip="10.0.0.1",
+                    alert_severity=AlertSeverity.ERROR,
+                )
+                for agent in agents
+            ],
+        )
+
+        # agents that came back online and still have an availability alert to resolve
+        alerts = [
+            Alert(
+                agent=agent,
+                alert_type=AlertType.AVAILABILITY,
+                severity=AlertSeverity.ERROR,
+                message=f"{agent.hostname} is overdue",
+            )
+            for agent in agents
+            if agent.last_seen == now and random.random() < kwargs["overdue"]
+        ]
+        results = []
+        for agent, agent_check in zip(agents, agent_checks):
+            for check in (agent_check, *policy_checks):
+                failing = random.random() < kwargs["failing"]
+                results.append(
+                    CheckResult(
+                        agent=agent,
+                        assigned_check=check,
+                        status=CheckStatus.FAILING if failing else CheckStatus.PASSING,
+                        alert_severity=AlertSeverity.ERROR if failing else None,
+                        last_run=now
+                        - djangotime.timedelta(minutes=random.randint(0, 5)),
+                        more_info=ping_success_output
+                        if check.check_type == CheckType.PING
+                        else "",
+                    )
+                )
+                if failing:
+                    alerts.append(
+                        Alert(
+                            agent=agent,
+                            assigned_check=check,
+                            alert_type=AlertType.CHECK,
+                            severity=AlertSeverity.ERROR,
+                            message=f"{agent.hostname} has a check failing",
+                        )
+                    )
+
+            if len(results) >= self.batch_size:
+                self.flush_results(results, history, now)
+                results = []
+
+        self.flush_results(results, history, now)
+        self.bulk_create(Alert, alerts)
+
+        with open(WIN_UPDATES) as f:
+            windows_updates = json.load(f)["samplecomputer"]
+
+        self.wua_updates = [
+            {
+                "guid": guid,
+                "kb_article_ids": [u["KBs"][0].replace("KB", "")],
+                "title": u["Title"],
+                "installed": u["Installed"],
+                "downloaded": u["Downloaded"],
+                "description": u["Description"],
+                "severity": u["Severity"],
+                "categories": [],
+                "category_ids": [],
+                "more_info_urls": [],
+                "support_url": "",
+                "revision_number": 200,
+            }
+            for guid, u in windows_updates.items()
+        ]
+
+        windows = [a for a in agents if a.plat == AgentPlat.WINDOWS]
+        self.online = next(a for a in windows if a.last_seen == now)
+        self.patched = windows[-1]
+        self.bulk_create(
+            WinUpdate,
+            [
+                WinUpdate(
+                    agent=self.patched,
+                    guid=u["guid"],
+                    kb="KB" + u["kb_article_ids"][0],
+                    title=u["title"],
+                    installed=False,
+                    downloaded=False,
+                    description=u["description"],
+                    severity=u["severity"],
+                )
+                for u in self.wua_updates
+            ],
+        )
+        self.online_checks = [*Check.objects.filter(agent=self.online), *policy_checks]
+
+    def flush_results(self, results, history: int, now) -> None:
+        self.bulk_create(CheckResult, results)
+        if history:
+            self.insert_history(
+                [
+                    (
+                        result.assigned_check.pk,
+                        result.agent.agent_id,
+                        now - djangotime.timedelta(minutes=n * 2),
+                        random.randint(0, 100),
+                    )
+                    for result in results
+                    for n in range(history)
+                ]
+            )
+
+    def insert_history(self, rows: list) -> None:
+        # x is auto_now_add so bulk_create would stamp every row with the current time
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i : i + self.batch_size]
+                cursor.execute(
+                    f"INSERT INTO {CheckHistory._meta.db_table} (check_id, agent_id, x, y) "
+                    f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(batch))}",
+                    [value for row in batch for value in row],
+                )
+
+    def bulk_create(self, model, objs: list) -> list:
+        return model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def targets(self) -> "dict[str, Callable[[], Any]]":
+        factory = APIRequestFactory()
+
+        def call(view, method: str, data=None, **kwargs) -> None:
+            request = getattr(factory, method)("/", data, format="json")
+            force_authenticate(request, user=self.user)
+            response = view(request, **kwargs)
+            response.render()
+            if response.status_code != 200:
+                raise Exception(f"{view} returned {response.status_code}")
+
+        def check_data(check: Check) -> dict:
+            if check.check_type == CheckType.PING:
+                return {"status": CheckStatus.PASSING, "output": ping_success_output}
+            elif check.check_type == CheckType.DISK_SPACE:
+                return {"exists": True, "percent_used": 40, "total": 500, "free": 300}
+            return {"percent": 30}
+
+        return {
+            "agent_outages_task": agent_outages_task,
+            "cache_db_fields_task": cache_db_fields_task,
+            "handle_resolved_stuff": handle_resolved_stuff,
+            "GetAgents.get": lambda: call(GetAgents.as_view(), "get"),
+            "CheckRunner.get": lambda: call(
+                CheckRunner.as_view(), "get", agentid=self.online.agent_id
+            ),
+            "CheckRunner.patch": lambda: [
+                call(
+                    CheckRunner.as_view(),
+                    "patch",
+                    {
+                        "id": check.pk,
+                        "agent_id": self.online.agent_id,
+                        **check_data(check),
+                    },
+                )
+                for check in self.online_checks
+            ],
+            "CheckRunnerResults.post": lambda: call(
+                CheckRunnerResults.as_view(),
+                "post",
+                {
+                    "results": [
+                        {"id": check.pk, **check_data(check)}
+                        for check in self.online_checks
+                    ]
+                },
+                agentid=self.online.agent_id,
+            ),
+            "WinUpdates.post new": lambda: call(
+                WinUpdates.as_view(),
+                "post",
+                {"agent_id": self.online.agent_id, "wua_updates": self.wua_updates},
+            ),
+            "WinUpdates.post existing": lambda: call(
+                WinUpdates.as_view(),
+                "post",
+                {"agent_id": self.patched.agent_id, "wua_updates": self.wua_updates},
+            ),
+        }
+
+    def measure(self, func: "Callable[[], Any]", repeat: int) -> "dict[str, Any]":
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            # every run starts from the same data, only caches carry over
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    func()
+                    timings.append((time.perf_counter() - start) * 1000)
+                transaction.set_rollback(True)
+
+            queries = len(ctx.captured_queries)
+
+        return {
+            "queries": queries,
+            "first_ms": timings[0],
+            "median_ms": statistics.median(timings),
+            "runs_ms": timings,
+        }
+
+    def cleanup(self) -> None:
+        CheckHistory.objects.filter(agent_id__startswith=self.prefix).delete()
+        CheckHistoryRollup.objects.filter(agent_id__startswith=self.prefix).delete()
+        for site in Site.objects.filter(name__startswith=self.prefix):
+            Agent.objects.filter(site=site).delete()
+
+        Client.objects.filter(name__startswith=self.prefix).delete()
+        self.policy.delete()
+        self.user.delete()
+        bump_policy_graph_version()
+
+    def get_commit(self) -> str:
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=settings.BASE_DIR,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
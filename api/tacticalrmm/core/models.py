@@ -1,3 +1,4 @@
+import hashlib
 import smtplib
 from email.message import EmailMessage
 from typing import TYPE_CHECKING, List, Optional, cast
@@ -9,11 +10,14 @@ from django.contrib.postgres.fields import ArrayField
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
 from twilio.base.exceptions import TwilioRestException
 from twilio.rest import Client as TwClient
 
+from automation.utils import bump_policy_graph_version
 from logs.models import BaseAuditModel, DebugLog
 from tacticalrmm.constants import (
+    CODESIGN_VALID_CACHE_PREFIX,
     CORESETTINGS_CACHE_KEY,
     CustomFieldModel,
     CustomFieldType,
@@ -126,17 +130,18 @@ class CoreSettings(BaseAuditModel):
             ):
                 cache_agents_alert_template.delay()
 
-            if old_settings.workstation_policy != self.workstation_policy:
-                cache.delete_many_pattern(f"site_workstation_*")
-
-            if old_settings.server_policy != self.server_policy:
-                cache.delete_many_pattern(f"site_server_*")
-
             if (
                 old_settings.server_policy != self.server_policy
                 or old_settings.workstation_policy != self.workstation_policy
             ):
-                cache.delete_many_pattern("agent_*")
+                bump_policy_graph_version()
+
+            if old_settings.default_time_zone != self.default_time_zone:
+                from agents.models import Agent
+
+                Agent.objects.filter(
+                    Q(time_zone__isnull=True) | Q(time_zone="")
+                ).update(patch_window_stale=True)
 
     def __str__(self) -> str:
         return "Global Site Settings"
@@ -353,6 +358,20 @@ class CodeSignToken(models.Model):
         if not self.token:
             return False
 
+        # keyed by the token so a new one is checked right away
+        key = (
+            CODESIGN_VALID_CACHE_PREFIX
+            + hashlib.sha256(self.token.encode()).hexdigest()
+        )
+        valid = cache.get(key)
+        if valid is None:
+            valid = self.check_token()
+            # failures are only remembered briefly so an outage of the exe server recovers quickly
+            cache.set(key, valid, 60 * 60 if valid else 60 * 5)
+
+        return valid
+
+    def check_token(self) -> bool:
         try:
             r = requests.post(
                 f"{settings.EXE_GEN_URL}/api/v1/checktoken",
@@ -1,41 +1,46 @@
-from typing import TYPE_CHECKING, Any, Dict
+from collections import Counter, defaultdict
+from typing import Dict
 
 from django.conf import settings
-from django.db.models import Prefetch
-from packaging import version as pyver
+from django.core.cache import cache
+from django.db.models import Exists, F, OuterRef, Prefetch
+from django.utils import timezone as djangotime
 
 from agents.models import Agent
 from agents.tasks import clear_faults_task, prune_agent_history
 from alerts.models import Alert
 from alerts.tasks import prune_resolved_alerts
+from automation.utils import get_policy_graph_version, prime_policy_cache
 from autotasks.models import TaskResult
+from autotasks.tasks import sync_queued_tasks
 from checks.models import Check, CheckResult
-from checks.tasks import prune_check_history
+from checks.tasks import create_check_history_partitions_task, prune_check_history
 from clients.models import Client, Site
-from core.utils import get_core_settings
+from core.utils import get_core_settings, publish_dash_counts, schedule_dash_counts
 from logs.models import PendingAction
 from logs.tasks import prune_audit_log, prune_debug_log
 from tacticalrmm.celery import app
 from tacticalrmm.constants import (
     AGENT_DEFER,
     AGENT_STATUS_ONLINE,
-    AGENT_STATUS_OVERDUE,
-    AlertSeverity,
+    CHECK_SUMMARY_FIELDS,
+    DASH_INFO_PENDING_KEY,
+    FAILING_CHECKS_POLICY_VERSION_KEY,
+    NATS_RELOAD_PENDING_KEY,
     AlertType,
     PAAction,
     PAStatus,
-    TaskStatus,
-    TaskSyncStatus,
 )
-
-if TYPE_CHECKING:
-    from django.db.models import QuerySet
+from tacticalrmm.helpers import version_to_int
 
 
 @app.task
 def core_maintenance_tasks() -> None:
     core = get_core_settings()
 
+    # make sure the upcoming days have their CheckHistory partitions
+    create_check_history_partitions_task.delay()
+
     # remove old CheckHistory data
     if core.check_history_prune_days > 0:
         prune_check_history.delay(core.check_history_prune_days)
@@ -68,115 +73,54 @@ def handle_resolved_stuff() -> None:
     actions = (
         PendingAction.objects.select_related("agent")
         .defer("agent__services", "agent__wmi_detail")
-        .filter(action_type=PAAction.AGENT_UPDATE, status=PAStatus.PENDING)
+        .filter(
+            action_type=PAAction.AGENT_UPDATE,
+            status=PAStatus.PENDING,
+            agent__version_number=version_to_int(settings.LATEST_AGENT_VER),
+        )
     )
 
     to_update = [
-        action.id
-        for action in actions
-        if pyver.parse(action.agent.version) == pyver.parse(settings.LATEST_AGENT_VER)
-        and action.agent.status == AGENT_STATUS_ONLINE
+        action.id for action in actions if action.agent.status == AGENT_STATUS_ONLINE
     ]
 
     PendingAction.objects.filter(pk__in=to_update).update(status=PAStatus.COMPLETED)
 
-    agent_queryset = (
-        Agent.objects.defer(*AGENT_DEFER)
-        .select_related(
-            "site__server_policy",
-            "site__workstation_policy",
-            "site__client__server_policy",
-            "site__client__workstation_policy",
-            "policy",
-            "alert_template",
-        )
-        .prefetch_related(
-            Prefetch(
-                "agentchecks",
-                queryset=Check.objects.select_related("script"),
-            ),
-            Prefetch(
-                "checkresults",
-                queryset=CheckResult.objects.select_related("assigned_check"),
-            ),
-            Prefetch(
-                "taskresults",
-                queryset=TaskResult.objects.select_related("task"),
-            ),
-            "autotasks",
-        )
+    # scheduled task syncs only look at agents that have something queued
+    sync_queued_tasks()
+
+    online = Agent.objects.defer(*AGENT_DEFER).filter(
+        last_seen__gte=djangotime.now()
+        - djangotime.timedelta(minutes=1) * F("offline_time"),
+        version_number__gte=version_to_int("1.6.0"),
     )
 
-    for agent in agent_queryset:
-        if (
-            pyver.parse(agent.version) >= pyver.parse("1.6.0")
-            and agent.status == AGENT_STATUS_ONLINE
-        ):
-            # sync scheduled tasks
-            for task in agent.get_tasks_with_policies():
-                if (
-                    not task.task_result
-                    or task.task_result.sync_status == TaskSyncStatus.INITIAL
-                ):
-                    task.create_task_on_agent(agent=agent if task.policy else None)
-                elif task.task_result.sync_status == TaskSyncStatus.PENDING_DELETION:
-                    task.delete_task_on_agent(agent=agent if task.policy else None)
-                elif task.task_result.sync_status == TaskSyncStatus.NOT_SYNCED:
-                    task.modify_task_on_agent(agent=agent if task.policy else None)
-                elif task.task_result.sync_status == TaskSyncStatus.SYNCED:
-                    continue
-
-            # handles any alerting actions
-            if Alert.objects.filter(
-                alert_type=AlertType.AVAILABILITY, agent=agent, resolved=False
-            ).exists():
-                Alert.handle_alert_resolve(agent)
-
-
-def _get_failing_data(agents: "QuerySet[Any]") -> Dict[str, bool]:
-    data = {"error": False, "warning": False}
-    for agent in agents:
-        if agent.maintenance_mode:
-            break
+    # handles any alerting actions
+    recovered = False
+    for agent in online.select_related("site__client", "alert_template").filter(
+        Exists(
+            Alert.objects.filter(
+                agent=OuterRef("pk"),
+                alert_type=AlertType.AVAILABILITY,
+                resolved=False,
+            )
+        )
+    ):
+        Alert.handle_alert_resolve(agent)
+        recovered = True
 
-        if (
-            agent.overdue_email_alert
-            or agent.overdue_text_alert
-            or agent.overdue_dashboard_alert
-        ):
-            if agent.status == AGENT_STATUS_OVERDUE:
-                data["error"] = True
-                break
-
-        if agent.checks["has_failing_checks"]:
-
-            if agent.checks["warning"]:
-                data["warning"] = True
-
-            if agent.checks["failing"]:
-                data["error"] = True
-                break
-
-        if not data["error"] and not data["warning"]:
-            for task in agent.get_tasks_with_policies():
-                if data["error"] and data["warning"]:
-                    break
-                elif not isinstance(task.task_result, TaskResult):
-                    continue
-                elif (
-                    not data["error"]
-                    and task.task_result.status == TaskStatus.FAILING
-                    and task.alert_severity == AlertSeverity.ERROR
-                ):
-                    data["error"] = True
-                elif (
-                    not data["warning"]
-                    and task.task_result.status == TaskStatus.FAILING
-                    and task.alert_severity == AlertSeverity.WARNING
-                ):
-                    data["warning"]
-
-    return data
+    if recovered:
+        schedule_dash_counts()
+
+    # clears the overdue contribution to the site/client rollup
+    for agent in online.filter(failing_error=True).prefetch_related(
+        Prefetch("agentchecks", queryset=Check.objects.select_related("script")),
+        Prefetch(
+            "checkresults",
+            queryset=CheckResult.objects.select_related("assigned_check"),
+        ),
+    ):
+        agent.update_check_summary()
 
 
 @app.task
@@ -207,13 +151,82 @@ def cache_db_fields_task() -> None:
             "autotasks",
         )
     )
-    # update client/site failing check fields and agent counts
-    for site in Site.objects.all():
-        agents = qs.filter(site=site)
-        site.failing_checks = _get_failing_data(agents)
-        site.save(update_fields=["failing_checks"])
-
-    for client in Client.objects.all():
-        agents = qs.filter(site__client=client)
-        client.failing_checks = _get_failing_data(agents)
-        client.save(update_fields=["failing_checks"])
+    # consistency sweep for the incrementally maintained check summaries
+    # each agent is evaluated once and the results are rolled up to sites and clients in memory
+    agent_fields = list(CHECK_SUMMARY_FIELDS)
+    site_counts: Dict[int, Counter] = defaultdict(Counter)
+    client_counts: Dict[int, Counter] = defaultdict(Counter)
+    changed_agents = []
+    # no iterator() here, it would drop the prefetches on this django version
+    agents = list(qs)
+    prime_policy_cache(agents)
+    for agent in agents:
+        checks = agent.checks
+        failing = agent.get_failing_data(checks)
+        if agent.set_check_summary(checks, failing):
+            changed_agents.append(agent)
+
+        for counts in (site_counts[agent.site_id], client_counts[agent.site.client_id]):
+            counts["error"] += failing["error"]
+            counts["warning"] += failing["warning"]
+
+        if len(changed_agents) >= 500:
+            Agent.objects.bulk_update(changed_agents, fields=agent_fields)
+            changed_agents = []
+
+    if changed_agents:
+        Agent.objects.bulk_update(changed_agents, fields=agent_fields)
+
+    for model, counts in ((Site, site_counts), (Client, client_counts)):
+        changed = []
+        for obj in model.objects.only(
+            "pk", "failing_checks", "failing_error_agents", "failing_warning_agents"
+        ):
+            error, warning = counts[obj.pk]["error"], counts[obj.pk]["warning"]
+            failing_checks = {"error": error > 0, "warning": warning > 0}
+            if (
+                obj.failing_error_agents != error
+                or obj.failing_warning_agents != warning
+                or obj.failing_checks != failing_checks
+            ):
+                obj.failing_error_agents = error
+                obj.failing_warning_agents = warning
+                obj.failing_checks = failing_checks
+                changed.append(obj)
+
+        model.objects.bulk_update(
+            changed,
+            fields=["failing_checks", "failing_error_agents", "failing_warning_agents"],
+            batch_size=500,
+        )
+
+
+@app.task
+def sweep_failing_checks_on_policy_change() -> None:
+    # assigning, unassigning or deleting policies and policy checks changes which checks
+    # count for every agent it applied to, so those run the sweep straight away
+    version = get_policy_graph_version()
+    if version is not None and cache.get(FAILING_CHECKS_POLICY_VERSION_KEY) == version:
+        return
+
+    cache_db_fields_task()
+    if version is not None:
+        cache.set(FAILING_CHECKS_POLICY_VERSION_KEY, version, None)
+
+
+@app.task
+def publish_dash_counts_task() -> None:
+    # cleared first so changes made while the counts are built schedule another publish
+    cache.delete(DASH_INFO_PENDING_KEY)
+    publish_dash_counts()
+
+
+@app.task
+def reload_nats_task() -> str:
+    from tacticalrmm.utils import reload_nats
+
+    # cleared first so changes made while the config is being built schedule another reload
+    cache.delete(NATS_RELOAD_PENDING_KEY)
+    reload_nats()
+
+    return "ok"
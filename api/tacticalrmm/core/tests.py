@@ -4,19 +4,28 @@ import requests
 from channels.db import database_sync_to_async
 from channels.testing import WebsocketCommunicator
 from django.conf import settings
+from django.test import override_settings
 from model_bakery import baker
 from rest_framework.authtoken.models import Token
 
 from agents.models import Agent
-from core.utils import get_core_settings
+from core.utils import get_core_settings, publish_dash_counts, schedule_dash_counts
 from logs.models import PendingAction
-from tacticalrmm.constants import CustomFieldModel, PAAction, PAStatus
+from tacticalrmm.constants import (
+    AgentMonType,
+    AlertSeverity,
+    CheckStatus,
+    CheckType,
+    CustomFieldModel,
+    PAAction,
+    PAStatus,
+)
 from tacticalrmm.test import TacticalTestCase
 
 from .consumers import DashInfo
 from .models import CustomField, GlobalKVStore, URLAction
 from .serializers import CustomFieldSerializer, KeyStoreSerializer, URLActionSerializer
-from .tasks import core_maintenance_tasks, handle_resolved_stuff
+from .tasks import cache_db_fields_task, core_maintenance_tasks, handle_resolved_stuff
 
 
 class TestCodeSign(TacticalTestCase):
@@ -40,7 +49,29 @@ class TestCodeSign(TacticalTestCase):
 
         self.check_not_authenticated("patch", self.url)
 
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    @patch("requests.post")
+    def test_codesign_is_valid_cached(self, mock_post):
+        mock_post.return_value.status_code = 200
+        token = baker.make("core.CodeSignToken", token="token123")
+
+        self.assertTrue(token.is_valid)
+        self.assertTrue(token.is_valid)
+        mock_post.assert_called_once()
+
+        # a different token is checked again and failures are cached as well
+        mock_post.return_value.status_code = 401
+        token.token = "token456"
+        self.assertFalse(token.is_valid)
+        self.assertFalse(token.is_valid)
+        self.assertEqual(mock_post.call_count, 2)
 
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
 class TestConsumers(TacticalTestCase):
     def setUp(self):
         self.setup_coresettings()
@@ -62,6 +93,75 @@ class TestConsumers(TacticalTestCase):
         assert connected
         await communicator.disconnect()
 
+    @database_sync_to_async
+    def setup_dash_agents(self):
+        site = baker.make("clients.Site")
+        other_site = baker.make("clients.Site")
+        baker.make_recipe(
+            "agents.online_agent",
+            site=site,
+            monitoring_type=AgentMonType.WORKSTATION,
+            _quantity=2,
+        )
+        baker.make_recipe(
+            "agents.overdue_agent", site=site, monitoring_type=AgentMonType.WORKSTATION
+        )
+        baker.make_recipe(
+            "agents.online_agent",
+            site=other_site,
+            monitoring_type=AgentMonType.SERVER,
+            _quantity=3,
+        )
+        return site
+
+    @database_sync_to_async
+    def limit_user_to_site(self, site):
+        user = self.create_user_with_roles([])
+        user.role.can_view_sites.set([site])
+        return user
+
+    async def test_dash_info_counts(self):
+        site = await self.setup_dash_agents()
+
+        communicator = WebsocketCommunicator(DashInfo.as_asgi(), "/ws/dashinfo/")
+        communicator.scope["user"] = self.john
+        connected, _ = await communicator.connect()
+        assert connected
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {
+                "total_server_offline_count": 0,
+                "total_workstation_offline_count": 1,
+                "total_server_count": 3,
+                "total_workstation_count": 3,
+            },
+        )
+
+        # limited users only count the sites they can see
+        limited = WebsocketCommunicator(DashInfo.as_asgi(), "/ws/dashinfo/")
+        limited.scope["user"] = await self.limit_user_to_site(site)
+        connected, _ = await limited.connect()
+        assert connected
+        self.assertEqual(
+            await limited.receive_json_from(),
+            {
+                "total_server_offline_count": 0,
+                "total_workstation_offline_count": 1,
+                "total_server_count": 0,
+                "total_workstation_count": 3,
+            },
+        )
+
+        # one publish reaches every connected dashboard
+        await database_sync_to_async(publish_dash_counts)()
+        self.assertEqual(
+            (await communicator.receive_json_from())["total_server_count"], 3
+        )
+        self.assertEqual((await limited.receive_json_from())["total_server_count"], 0)
+
+        await communicator.disconnect()
+        await limited.disconnect()
+
 
 class TestCoreTasks(TacticalTestCase):
     def setUp(self):
@@ -79,6 +179,15 @@ class TestCoreTasks(TacticalTestCase):
 
         self.check_not_authenticated("get", url)
 
+    @patch("core.tasks.publish_dash_counts_task.apply_async")
+    def test_schedule_dash_counts(self, apply_async):
+        # only the first change within the delay schedules a publish
+        with patch("core.utils.cache.add", side_effect=[True, False]):
+            schedule_dash_counts()
+            schedule_dash_counts()
+
+        apply_async.assert_called_once_with(countdown=settings.DASH_INFO_DEBOUNCE)
+
     def test_vue_version(self):
         url = "/core/version/"
         r = self.client.get(url)
@@ -423,6 +532,138 @@ class TestCoreTasks(TacticalTestCase):
         self.assertEqual(complete, 20)
         self.assertEqual(old, 20)
 
+    def test_check_summary_rollup(self):
+        site = baker.make("clients.Site")
+        agent = baker.make_recipe("agents.online_agent", site=site)
+        other = baker.make_recipe("agents.online_agent", site=site)
+        check = baker.make(
+            "checks.Check",
+            agent=agent,
+            check_type=CheckType.PING,
+            alert_severity=AlertSeverity.ERROR,
+        )
+        result = baker.make(
+            "checks.CheckResult",
+            agent=agent,
+            assigned_check=check,
+            status=CheckStatus.FAILING,
+        )
+
+        agent.update_check_summary()
+        site.refresh_from_db()
+        site.client.refresh_from_db()
+        self.assertEqual(site.failing_error_agents, 1)
+        self.assertEqual(site.failing_checks, {"error": True, "warning": False})
+        self.assertEqual(site.client.failing_checks, {"error": True, "warning": False})
+
+        # nothing changed for the other agent so the site is left alone
+        other.update_check_summary()
+        site.refresh_from_db()
+        self.assertEqual(site.failing_error_agents, 1)
+
+        result.status = CheckStatus.PASSING
+        result.save()
+        agent = Agent.objects.get(pk=agent.pk)
+        agent.update_check_summary()
+        site.refresh_from_db()
+        self.assertEqual(site.failing_error_agents, 0)
+        self.assertEqual(site.failing_checks, {"error": False, "warning": False})
+
+    def test_check_summary_rollup_hooks(self):
+        site = baker.make("clients.Site")
+        other_site = baker.make("clients.Site")
+        agent = baker.make_recipe("agents.online_agent", site=site)
+        check = baker.make(
+            "checks.Check",
+            agent=agent,
+            check_type=CheckType.PING,
+            alert_severity=AlertSeverity.ERROR,
+        )
+        baker.make(
+            "checks.CheckResult",
+            agent=agent,
+            assigned_check=check,
+            status=CheckStatus.FAILING,
+        )
+
+        def counts(site):
+            site.refresh_from_db()
+            site.client.refresh_from_db()
+            return site.failing_error_agents, site.client.failing_error_agents
+
+        # a second worker with the same stale instance doesn't count it again
+        stale = Agent.objects.get(pk=agent.pk)
+        agent.update_check_summary()
+        stale.update_check_summary()
+        self.assertEqual(counts(site), (1, 1))
+
+        agent = Agent.objects.get(pk=agent.pk)
+        agent.site = other_site
+        agent.save(update_fields=["site"])
+        self.assertEqual(counts(site), (0, 0))
+        self.assertEqual(counts(other_site), (1, 1))
+
+        agent.maintenance_mode = True
+        agent.save()
+        self.assertEqual(counts(other_site), (0, 0))
+
+        agent.maintenance_mode = False
+        agent.save(update_fields=["maintenance_mode"])
+        self.assertEqual(counts(other_site), (1, 1))
+
+        check.delete()
+        self.assertEqual(counts(other_site), (0, 0))
+
+        baker.make(
+            "checks.CheckResult",
+            agent=agent,
+            assigned_check=baker.make(
+                "checks.Check",
+                agent=agent,
+                check_type=CheckType.PING,
+                alert_severity=AlertSeverity.ERROR,
+            ),
+            status=CheckStatus.FAILING,
+        )
+        agent.update_check_summary()
+        self.assertEqual(counts(other_site), (1, 1))
+
+        agent.delete()
+        self.assertEqual(counts(other_site), (0, 0))
+
+    def test_cache_db_fields_task_repairs_drift(self):
+        site = baker.make("clients.Site", failing_error_agents=5)
+        agent = baker.make_recipe("agents.online_agent", site=site)
+        maint = baker.make_recipe(
+            "agents.online_agent", site=site, maintenance_mode=True
+        )
+        for a in (agent, maint):
+            check = baker.make(
+                "checks.Check",
+                agent=a,
+                check_type=CheckType.PING,
+                alert_severity=AlertSeverity.WARNING,
+            )
+            baker.make(
+                "checks.CheckResult",
+                agent=a,
+                assigned_check=check,
+                status=CheckStatus.FAILING,
+            )
+
+        cache_db_fields_task()
+
+        site.refresh_from_db()
+        agent.refresh_from_db()
+        maint.refresh_from_db()
+        self.assertEqual(site.failing_error_agents, 0)
+        self.assertEqual(site.failing_warning_agents, 1)
+        self.assertEqual(site.failing_checks, {"error": False, "warning": True})
+        self.assertEqual(agent.checks_warning, 1)
+        self.assertTrue(agent.failing_warning)
+        self.assertEqual(maint.checks_warning, 1)
+        self.assertFalse(maint.failing_warning)
+
 
 class TestCorePermissions(TacticalTestCase):
     def setUp(self):
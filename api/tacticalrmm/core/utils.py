@@ -1,16 +1,28 @@
 import json
 import tempfile
+import time
 from base64 import b64encode
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Any, List, cast
 
 import requests
 import websockets
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Count, F, Q
 from django.http import FileResponse
+from django.utils import timezone as djangotime
 from meshctrl.utils import get_auth_token
 
-from tacticalrmm.constants import CORESETTINGS_CACHE_KEY, ROLE_CACHE_PREFIX
+from automation.utils import bump_policy_graph_version
+from tacticalrmm.constants import (
+    CORESETTINGS_CACHE_KEY,
+    DASH_INFO_COUNTS_KEY,
+    DASH_INFO_GROUP,
+    DASH_INFO_PENDING_KEY,
+    ROLE_CACHE_PREFIX,
+)
 
 if TYPE_CHECKING:
     from core.models import CoreSettings
@@ -23,8 +35,7 @@ class CoreSettingsNotFound(Exception):
 def clear_entire_cache() -> None:
     cache.delete_many_pattern(f"{ROLE_CACHE_PREFIX}*")
     cache.delete(CORESETTINGS_CACHE_KEY)
-    cache.delete_many_pattern("site_*")
-    cache.delete_many_pattern("agent_*")
+    bump_policy_graph_version()
 
 
 def get_core_settings() -> "CoreSettings":
@@ -43,6 +54,56 @@ def get_core_settings() -> "CoreSettings":
         return cast(CoreSettings, coresettings)
 
 
+def get_site_agent_counts() -> List[List[Any]]:
+    # [site_id, client_id, monitoring_type, total, offline] for every site, in one query
+    from agents.models import Agent
+
+    offline = Q(
+        last_seen__lt=djangotime.now()
+        - (djangotime.timedelta(minutes=1) * F("offline_time"))
+    )
+    return [
+        [
+            row["site_id"],
+            row["site__client_id"],
+            row["monitoring_type"],
+            row["total"],
+            row["offline"],
+        ]
+        for row in Agent.objects.values("site_id", "site__client_id", "monitoring_type")
+        .annotate(total=Count("pk"), offline=Count("pk", filter=offline))
+        .order_by("site_id", "monitoring_type")
+    ]
+
+
+def publish_dash_counts() -> None:
+    # one producer for every open dashboard, consumers pick out the sites they can see.
+    # only sent when something changed, plus a heartbeat in case a message was missed
+    counts = get_site_agent_counts()
+    last = cache.get(DASH_INFO_COUNTS_KEY)
+    now = time.time()
+    if (
+        last
+        and last["counts"] == counts
+        and now - last["published"] < settings.DASH_INFO_HEARTBEAT
+    ):
+        return
+
+    cache.set(DASH_INFO_COUNTS_KEY, {"counts": counts, "published": now}, None)
+    async_to_sync(get_channel_layer().group_send)(
+        DASH_INFO_GROUP, {"type": "dash.counts", "counts": counts}
+    )
+
+
+def schedule_dash_counts() -> None:
+    # pushes the counts soon after they change instead of waiting for the next refresh,
+    # every change within the delay is picked up by the same publish
+    from core.tasks import publish_dash_counts_task
+
+    if cache.add(DASH_INFO_PENDING_KEY, 1, settings.DASH_INFO_DEBOUNCE + 60):
+        publish_dash_counts_task.apply_async(countdown=settings.DASH_INFO_DEBOUNCE)
+
+
 def get_mesh_ws_url() -> str:
     core = get_core_settings()
     token = get_auth_token(core.mesh_username, core.mesh_token)
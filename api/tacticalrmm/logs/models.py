@@ -1,6 +1,9 @@
+import copy
+import threading
 from abc import abstractmethod
-from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, Union, cast
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union, cast
 
+from django.conf import settings
 from django.db import models
 
 from core.utils import get_core_settings
@@ -21,6 +24,11 @@ if TYPE_CHECKING:
     from core.models import URLAction
 
 
+# audit entries waiting to be written, per thread. only buffered between
+# AuditLog.start_buffering() and AuditLog.flush_buffer()
+audit_buffer = threading.local()
+
+
 def get_debug_level() -> str:
     return get_core_settings().agent_debug_level
 
@@ -50,6 +58,36 @@ class AuditLog(models.Model):
 
         return super(AuditLog, self).save(*args, **kwargs)
 
+    @staticmethod
+    def start_buffering() -> None:
+        # write anything left over from a request that never finished
+        AuditLog.flush_buffer()
+        audit_buffer.entries = []
+
+    @staticmethod
+    def flush_buffer() -> None:
+        entries: "Optional[List[AuditLog]]" = getattr(audit_buffer, "entries", None)
+        audit_buffer.entries = None
+        if entries:
+            AuditLog.objects.bulk_create(entries)
+
+    @staticmethod
+    def queue(entry: "AuditLog") -> None:
+        # bulk_create skips save() so truncate the message here
+        if entry.message and len(entry.message) > 255:
+            entry.message = entry.message[:253] + ".."
+
+        entries: "Optional[List[AuditLog]]" = getattr(audit_buffer, "entries", None)
+        if entries is None:
+            # not inside a request, write it now
+            AuditLog.objects.bulk_create([entry])
+            return
+
+        entries.append(entry)
+        if len(entries) >= settings.AUDIT_LOG_BUFFER_SIZE:
+            AuditLog.objects.bulk_create(entries)
+            audit_buffer.entries = []
+
     @staticmethod
     def audit_mesh_session(
         username: str, agent: "Agent", debug_info: Dict[Any, Any] = {}
@@ -92,16 +130,20 @@ class AuditLog(models.Model):
         name: str = "",
         debug_info: Dict[Any, Any] = {},
     ) -> None:
-        AuditLog.objects.create(
-            username=username,
-            object_type=object_type,
-            agent=before["hostname"] if object_type == AuditObjType.AGENT else None,
-            agent_id=before["agent_id"] if object_type == AuditObjType.AGENT else None,
-            action=AuditActionType.MODIFY,
-            message=f"{username} modified {object_type} {name}",
-            before_value=before,
-            after_value=after,
-            debug_info=debug_info,
+        AuditLog.queue(
+            AuditLog(
+                username=username,
+                object_type=object_type,
+                agent=before["hostname"] if object_type == AuditObjType.AGENT else None,
+                agent_id=before["agent_id"]
+                if object_type == AuditObjType.AGENT
+                else None,
+                action=AuditActionType.MODIFY,
+                message=f"{username} modified {object_type} {name}",
+                before_value=before,
+                after_value=after,
+                debug_info=debug_info,
+            )
         )
 
     @staticmethod
@@ -112,15 +154,19 @@ class AuditLog(models.Model):
         name: str = "",
         debug_info: Dict[Any, Any] = {},
     ) -> None:
-        AuditLog.objects.create(
-            username=username,
-            object_type=object_type,
-            agent=after["hostname"] if object_type == AuditObjType.AGENT else None,
-            agent_id=after["agent_id"] if object_type == AuditObjType.AGENT else None,
-            action=AuditActionType.ADD,
-            message=f"{username} added {object_type} {name}",
-            after_value=after,
-            debug_info=debug_info,
+        AuditLog.queue(
+            AuditLog(
+                username=username,
+                object_type=object_type,
+                agent=after["hostname"] if object_type == AuditObjType.AGENT else None,
+                agent_id=after["agent_id"]
+                if object_type == AuditObjType.AGENT
+                else None,
+                action=AuditActionType.ADD,
+                message=f"{username} added {object_type} {name}",
+                after_value=after,
+                debug_info=debug_info,
+            )
         )
 
     @staticmethod
@@ -131,15 +177,19 @@ class AuditLog(models.Model):
         name: str = "",
         debug_info: Dict[Any, Any] = {},
     ) -> None:
-        AuditLog.objects.create(
-            username=username,
-            object_type=object_type,
-            agent=before["hostname"] if object_type == AuditObjType.AGENT else None,
-            agent_id=before["agent_id"] if object_type == AuditObjType.AGENT else None,
-            action=AuditActionType.DELETE,
-            message=f"{username} deleted {object_type} {name}",
-            before_value=before,
-            debug_info=debug_info,
+        AuditLog.queue(
+            AuditLog(
+                username=username,
+                object_type=object_type,
+                agent=before["hostname"] if object_type == AuditObjType.AGENT else None,
+                agent_id=before["agent_id"]
+                if object_type == AuditObjType.AGENT
+                else None,
+                action=AuditActionType.DELETE,
+                message=f"{username} deleted {object_type} {name}",
+                before_value=before,
+                debug_info=debug_info,
+            )
         )
 
     @staticmethod
@@ -412,10 +462,59 @@ class BaseAuditModel(models.Model):
     modified_by = models.CharField(max_length=255, null=True, blank=True)
     modified_time = models.DateTimeField(auto_now=True, null=True, blank=True)
 
+    # field values as loaded from the database, used to diff without fetching the row again
+    _audit_snapshot: Optional[Dict[str, Any]] = None
+
     @abstractmethod
     def serialize(class_name: models.Model) -> Dict[str, Any]:
         pass
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # only audited requests need it, skip the copying everywhere else
+        if get_username():
+            instance._audit_snapshot = instance._get_audit_values()
+        return instance
+
+    def _get_audit_values(self, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        # other values are replaced on assignment, only json and array values can be
+        # changed in place and need a copy
+        return {
+            f.attname: copy.deepcopy(self.__dict__[f.attname])
+            if isinstance(self.__dict__[f.attname], (dict, list))
+            else self.__dict__[f.attname]
+            for f in self._meta.concrete_fields
+            if f.attname in self.__dict__
+            and (fields is None or f.name in fields or f.attname in fields)
+        }
+
+    def _get_audit_before(self) -> "Optional[BaseAuditModel]":
+        # rebuilds the instance as it was loaded, or returns None when nothing changed
+        snapshot = self._audit_snapshot
+        if snapshot is None:
+            return type(self).objects.get(pk=self.pk)
+
+        loaded = [
+            f.attname for f in self._meta.concrete_fields if f.attname in self.__dict__
+        ]
+        if any(f not in snapshot for f in loaded):
+            # a deferred field was set so its old value isn't known
+            return type(self).objects.get(pk=self.pk)
+
+        changed = [f for f in loaded if self.__dict__[f] != snapshot[f]]
+        if not changed:
+            return None
+
+        before = copy.copy(self)
+        for f in changed:
+            before.__dict__[f] = snapshot[f]
+        for field in self._meta.concrete_fields:
+            if field.is_relation and field.attname in changed:
+                before._state.fields_cache.pop(field.name, None)
+
+        return before
+
     def save(self, old_model: Optional[models.Model] = None, *args, **kwargs) -> None:
 
         username = get_username()
@@ -423,7 +522,6 @@ class BaseAuditModel(models.Model):
 
             object_class = type(self)
             object_name = object_class.__name__.lower()
-            after_value = object_class.serialize(self)
 
             # populate created_by and modified_by fields on instance
             if not getattr(self, "created_by", None):
@@ -436,18 +534,15 @@ class BaseAuditModel(models.Model):
                 AuditLog.audit_object_add(
                     username,
                     object_name,
-                    after_value,
+                    object_class.serialize(self),
                     self.__str__(),
                     debug_info=get_debug_info(),
                 )
             else:
+                before = old_model or self._get_audit_before()
+                before_value = object_class.serialize(before) if before else None
+                after_value = object_class.serialize(self) if before else None
 
-                if old_model:
-                    before_value = object_class.serialize(old_model)
-                else:
-                    before_value = object_class.serialize(
-                        object_class.objects.get(pk=self.pk)
-                    )
                 # only create an audit entry if the values have changed
                 if before_value != after_value and username:
 
@@ -462,6 +557,10 @@ class BaseAuditModel(models.Model):
 
         super(BaseAuditModel, self).save(*args, **kwargs)
 
+        if self._audit_snapshot is not None or get_username():
+            saved = self._get_audit_values(kwargs.get("update_fields"))
+            self._audit_snapshot = {**(self._audit_snapshot or {}), **saved}
+
     def delete(self, *args, **kwargs) -> Tuple[int, Dict[str, int]]:
         super(BaseAuditModel, self).delete(*args, **kwargs)
 
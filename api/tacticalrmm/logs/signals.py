@@ -1,13 +1,16 @@
+import atexit
 import datetime as dt
 
 import pytz
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection
 from django.db.models.signals import post_init
 from django.dispatch import receiver
 from django.utils import timezone as djangotime
 
 from tacticalrmm.constants import PAAction, PAStatus
 
-from .models import PendingAction
+from .models import AuditLog, PendingAction
 
 
 @receiver(post_init, sender=PendingAction)
@@ -33,3 +36,20 @@ def handle_status(sender, instance: PendingAction, **kwargs):
             if now > reboot_time_utc:
                 instance.status = PAStatus.COMPLETED
                 instance.save(update_fields=["status"])
+
+
+@receiver(request_started)
+def start_audit_buffer(sender, **kwargs):
+    AuditLog.start_buffering()
+
+
+@receiver(request_finished)
+def flush_audit_buffer(sender, **kwargs):
+    # runs once the response has been sent. django has already closed the connection
+    # by now so close the one opened for the insert too, unless inside a test transaction
+    AuditLog.flush_buffer()
+    if not connection.in_atomic_block:
+        close_old_connections()
+
+
+atexit.register(AuditLog.flush_buffer)
@@ -520,3 +520,70 @@ class TestLogTasks(TacticalTestCase):
         prune_audit_log(30)
 
         self.assertEqual(AuditLog.objects.count(), 6)
+
+
+@patch("logs.models.get_username", return_value="john")
+class TestAuditBuffer(TacticalTestCase):
+    def test_buffered_audit_entries(self, get_username):
+        from core.models import GlobalKVStore
+
+        from .models import AuditLog
+
+        store = GlobalKVStore.objects.create(name="key", value="old")
+        AuditLog.objects.all().delete()
+        store = GlobalKVStore.objects.get(pk=store.pk)
+
+        AuditLog.start_buffering()
+
+        # unchanged saves don't fetch the old row or queue an entry
+        with self.assertNumQueries(1):
+            store.save()
+
+        store.value = "new"
+        with self.assertNumQueries(1):
+            store.save()
+        self.assertFalse(AuditLog.objects.exists())
+
+        AuditLog.flush_buffer()
+        log = AuditLog.objects.get()
+        self.assertEqual(log.before_value["value"], "old")
+        self.assertEqual(log.after_value["value"], "new")
+
+        # outside of a request entries are written straight away
+        store.value = "newer"
+        store.save()
+        self.assertEqual(AuditLog.objects.count(), 2)
+        self.assertEqual(AuditLog.objects.latest("pk").before_value["value"], "new")
+
+    def test_audit_entries_flushed_after_request(self, get_username):
+        from .models import AuditLog
+
+        self.authenticate()
+        self.setup_coresettings()
+        script = baker.make("scripts.Script", name="before")
+
+        r = self.client.put(f"/scripts/{script.pk}/", {"name": "after"}, format="json")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(AuditLog.objects.filter(before_value__name="before").exists())
+
+    def test_audit_snapshot_copies_mutable_values(self, get_username):
+        from alerts.models import AlertTemplate
+
+        from .models import AuditLog
+
+        template = baker.make(
+            "alerts.AlertTemplate", name="template", action_args=["one"]
+        )
+        template = AlertTemplate.objects.get(pk=template.pk)
+
+        # scalars are shared with the instance, lists are copied
+        self.assertIs(template._audit_snapshot["name"], template.name)
+        self.assertIsNot(template._audit_snapshot["action_args"], template.action_args)
+
+        # values changed in place are still picked up
+        AuditLog.objects.all().delete()
+        template.action_args.append("two")
+        template.save()
+        log = AuditLog.objects.get()
+        self.assertEqual(log.before_value["action_args"], ["one"])
+        self.assertEqual(log.after_value["action_args"], ["one", "two"])
@@ -1,15 +1,35 @@
 import hashlib
 import hmac
 import re
-from typing import List
+from typing import Any, Iterable, List, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.db import models
 from django.db.models.fields import CharField, TextField
 
 from logs.models import BaseAuditModel
-from tacticalrmm.constants import ScriptShell, ScriptType
-from tacticalrmm.utils import replace_db_values
+from tacticalrmm.constants import SNIPPET_VERSION_CACHE_PREFIX, ScriptShell, ScriptType
+from tacticalrmm.helpers import bump_cache_version, get_cache_versions
+from tacticalrmm.utils import DBValueResolver
+
+# pattern to match for injection
+SCRIPT_ARG_PATTERN = re.compile(".*\\{\\{(.*)\\}\\}.*")
+SNIPPET_PATTERN = re.compile(r"{{(.*)}}")
+
+# only bounds memory, compiled keys include the body and snippet versions
+COMPILED_SCRIPT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_snippet_versions(names: List[str]) -> Optional[List[int]]:
+    return get_cache_versions(
+        [f"{SNIPPET_VERSION_CACHE_PREFIX}{name}" for name in names]
+    )
+
+
+def bump_snippet_version(name: str) -> None:
+    bump_cache_version(f"{SNIPPET_VERSION_CACHE_PREFIX}{name}")
 
 
 class Script(BaseAuditModel):
@@ -41,6 +61,9 @@ class Script(BaseAuditModel):
         models.CharField(max_length=20), null=True, blank=True, default=list
     )
 
+    # body the compiled code and hmac were built from
+    _compiled: Optional[Tuple[str, str, str]] = None
+
     def __str__(self):
         return self.name
 
@@ -50,33 +73,62 @@ class Script(BaseAuditModel):
 
     @property
     def code(self):
-        return self.replace_with_snippets(self.code_no_snippets)
+        return self.get_compiled_code()[0]
+
+    def get_compiled_code(self) -> Tuple[str, str]:
+        body = self.code_no_snippets
+        if self._compiled is None or self._compiled[0] != body:
+            self._compiled = (body, *self.compile_code(body))
+
+        return self._compiled[1], self._compiled[2]
 
     @classmethod
-    def replace_with_snippets(cls, code):
-        # check if snippet has been added to script body
-        matches = re.finditer(r"{{(.*)}}", code)
-        if matches:
-            replaced_code = code
-            for snippet in matches:
-                snippet_name = snippet.group(1).strip()
-                if ScriptSnippet.objects.filter(name=snippet_name).exists():
-                    value = ScriptSnippet.objects.get(name=snippet_name).code
-                else:
-                    value = ""
+    def compile_code(cls, code: str) -> Tuple[str, str]:
+        # returns the code with snippets replaced and its hmac. cached on the body and the
+        # versions of the snippets it uses, so saving a snippet only affects its dependents
+        names = sorted(
+            {match.group(1).strip() for match in SNIPPET_PATTERN.finditer(code)}
+        )
+        if not names:
+            return code, cls.get_code_hmac(code)
+
+        versions = get_snippet_versions(names)
+        key = None
+        if versions is not None:
+            key = "compiled_script_{}".format(
+                hashlib.sha256(
+                    "\0".join([code, *map(str, versions)]).encode(errors="ignore")
+                ).hexdigest()
+            )
+            compiled = cache.get(key)
+            if compiled is not None:
+                return compiled
 
-                replaced_code = re.sub(snippet.group(), value, replaced_code)
+        snippets = dict(
+            ScriptSnippet.objects.filter(name__in=names).values_list("name", "code")
+        )
+        # function replacement so snippet code is inserted as is
+        replaced_code = SNIPPET_PATTERN.sub(
+            lambda match: snippets.get(match.group(1).strip(), ""), code
+        )
+        compiled = (replaced_code, cls.get_code_hmac(replaced_code))
+        if key:
+            cache.set(key, compiled, COMPILED_SCRIPT_CACHE_TIMEOUT)
 
-            return replaced_code
-        else:
-            return code
+        return compiled
 
-    def hash_script_body(self):
-        from django.conf import settings
+    @classmethod
+    def replace_with_snippets(cls, code):
+        return cls.compile_code(code)[0]
 
-        msg = self.code.encode(errors="ignore")
+    @staticmethod
+    def get_code_hmac(code: str) -> str:
+        msg = code.encode(errors="ignore")
         return hmac.new(settings.SECRET_KEY.encode(), msg, hashlib.sha256).hexdigest()
 
+    def hash_script_body(self):
+        return self.get_compiled_code()[1]
+
     @classmethod
     def load_community_scripts(cls):
         import json
@@ -186,22 +238,38 @@ class Script(BaseAuditModel):
         return ScriptSerializer(script).data
 
     @classmethod
-    def parse_script_args(cls, agent, shell: str, args: List[str] = list()) -> list:
+    def get_db_value_resolver(
+        cls, args: List[str], agents: Iterable[Any]
+    ) -> DBValueResolver:
+        # preloads the values args reference for a batch of agents, to pass to parse_script_args
+        return DBValueResolver(
+            [match.group(1) for match in map(SCRIPT_ARG_PATTERN.match, args) if match],
+            agents,
+        )
+
+    @classmethod
+    def parse_script_args(
+        cls,
+        agent,
+        shell: str,
+        args: List[str] = list(),
+        resolver: Optional[DBValueResolver] = None,
+    ) -> list:
 
         if not args:
             return []
 
-        temp_args = list()
+        if resolver is None:
+            resolver = cls.get_db_value_resolver(args, [agent])
 
-        # pattern to match for injection
-        pattern = re.compile(".*\\{\\{(.*)\\}\\}.*")
+        temp_args = list()
 
         for arg in args:
-            match = pattern.match(arg)
+            match = SCRIPT_ARG_PATTERN.match(arg)
             if match:
                 # only get the match between the () in regex
                 string = match.group(1)
-                value = replace_db_values(
+                value = resolver.resolve(
                     string=string,
                     instance=agent,
                     shell=shell,
@@ -230,3 +298,20 @@ class ScriptSnippet(models.Model):
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs) -> None:
+        old_name = (
+            type(self).objects.filter(pk=self.pk).values_list("name", flat=True).first()
+            if self.pk
+            else None
+        )
+        super().save(*args, **kwargs)
+
+        # scripts using either name compile differently now
+        bump_snippet_version(self.name)
+        if old_name and old_name != self.name:
+            bump_snippet_version(old_name)
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        bump_snippet_version(self.name)
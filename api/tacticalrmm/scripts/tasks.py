@@ -1,16 +1,16 @@
-import asyncio
-from typing import List
+from typing import Any, List
 
 from agents.models import Agent, AgentHistory
 from scripts.models import Script
 from tacticalrmm.celery import app
 from tacticalrmm.constants import AgentHistoryType
+from tacticalrmm.nats_utils import bulk_nats_command
 
 
 @app.task
 def handle_bulk_command_task(
     agentpks, cmd, shell, timeout, username, run_on_offline=False
-) -> None:
+) -> dict[str, Any]:
     nats_data = {
         "func": "rawcmd",
         "timeout": timeout,
@@ -19,30 +19,61 @@ def handle_bulk_command_task(
             "shell": shell,
         },
     }
-    for agent in Agent.objects.filter(pk__in=agentpks):
-        hist = AgentHistory.objects.create(
-            agent=agent,
-            type=AgentHistoryType.CMD_RUN,
-            command=cmd,
-            username=username,
-        )
-        nats_data["id"] = hist.pk
+    agents = Agent.objects.filter(pk__in=agentpks).only("pk", "agent_id")
+    history = AgentHistory.objects.bulk_create(
+        [
+            AgentHistory(
+                agent=agent,
+                type=AgentHistoryType.CMD_RUN,
+                command=cmd,
+                username=username,
+            )
+            for agent in agents
+        ]
+    )
 
-        asyncio.run(agent.nats_cmd(nats_data, wait=False))
+    return bulk_nats_command(
+        [(hist.agent.agent_id, {**nats_data, "id": hist.pk}) for hist in history]
+    )
 
 
 @app.task
 def handle_bulk_script_task(
     scriptpk: int, agentpks: List[int], args: List[str], timeout: int, username: str
-) -> None:
+) -> dict[str, Any]:
     script = Script.objects.get(pk=scriptpk)
-    for agent in Agent.objects.filter(pk__in=agentpks):
-        hist = AgentHistory.objects.create(
-            agent=agent,
-            type=AgentHistoryType.SCRIPT_RUN,
-            script=script,
-            username=username,
-        )
-        agent.run_script(
-            scriptpk=script.pk, args=args, timeout=timeout, history_pk=hist.pk
+    agents = Agent.objects.filter(pk__in=agentpks).select_related("site__client")
+    history = AgentHistory.objects.bulk_create(
+        [
+            AgentHistory(
+                agent=agent,
+                type=AgentHistoryType.SCRIPT_RUN,
+                script=script,
+                username=username,
+            )
+            for agent in agents
+        ]
+    )
+
+    payload = {
+        "code": script.code,
+        "shell": script.shell,
+    }
+    resolver = script.get_db_value_resolver(args, [hist.agent for hist in history])
+    messages = [
+        (
+            hist.agent.agent_id,
+            {
+                "func": "runscript",
+                "timeout": timeout,
+                "script_args": script.parse_script_args(
+                    hist.agent, script.shell, args, resolver
+                ),
+                "payload": payload,
+                "id": hist.pk,
+            },
         )
+        for hist in history
+    ]
+
+    return bulk_nats_command(messages)
@@ -434,6 +434,75 @@ class TestScriptViews(TacticalTestCase):
             ),
         )
 
+    def test_script_arg_replacement_batch(self):
+        from agents.models import Agent
+
+        baker.make_recipe("agents.agent", _quantity=3)
+        agents = list(Agent.objects.select_related("site__client").order_by("pk"))
+        baker.make("core.GlobalKVStore", name="key", value="global value")
+        agent_field = baker.make(
+            "core.CustomField",
+            name="Agent Field",
+            model=CustomFieldModel.AGENT,
+            type=CustomFieldType.TEXT,
+            default_value_string="DEFAULT",
+        )
+        client_field = baker.make(
+            "core.CustomField",
+            name="Client Field",
+            model=CustomFieldModel.CLIENT,
+            type=CustomFieldType.MULTIPLE,
+        )
+        baker.make(
+            "agents.AgentCustomField",
+            field=agent_field,
+            agent=agents[0],
+            string_value="agent value",
+        )
+        baker.make(
+            "clients.ClientCustomField",
+            field=client_field,
+            client=agents[1].client,
+            multiple_value=["one", "two"],
+        )
+
+        args = [
+            "-Global {{global.key}}",
+            "-Agent {{agent.Agent Field}}",
+            "-Client {{client.Client Field}}",
+            "-Hostname {{agent.hostname}}",
+        ]
+        with self.assertNumQueries(4):
+            resolver = Script.get_db_value_resolver(args, agents)
+
+        # every agent is substituted from the preloaded values
+        with self.assertNumQueries(0):
+            parsed = [
+                Script.parse_script_args(
+                    agent=agent, shell=ScriptShell.PYTHON, args=args, resolver=resolver
+                )
+                for agent in agents
+            ]
+
+        for agent, result in zip(agents, parsed):
+            self.assertEqual(
+                result,
+                Script.parse_script_args(
+                    agent=agent, shell=ScriptShell.PYTHON, args=args
+                ),
+            )
+
+        self.assertEqual(
+            parsed[0][:2], ["-Global 'global value'", "-Agent 'agent value'"]
+        )
+        self.assertEqual(parsed[1][1:3], ["-Agent 'DEFAULT'", "-Client 'one,two'"])
+        self.assertEqual(parsed[2][3], f"-Hostname '{agents[2].hostname}'")
+
+        # sites and clients aren't looked up when no site or client field is referenced
+        agents = list(Agent.objects.order_by("pk"))
+        with self.assertNumQueries(2):
+            Script.get_db_value_resolver(["-Agent {{agent.Agent Field}}"], agents)
+
 
 class TestScriptSnippetViews(TacticalTestCase):
     def setUp(self):
@@ -536,3 +605,101 @@ class TestScriptSnippetViews(TacticalTestCase):
         # test text with no snippets
         result = Script.replace_with_snippets(test_no_snippet)
         self.assertEqual(result, test_no_snippet)
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_compiled_script_cache(self):
+        snippet = baker.make(
+            "scripts.ScriptSnippet", name="snippet1", code="Write-Output C:\\Temp"
+        )
+        other = baker.make("scripts.ScriptSnippet", name="snippet2", code="other")
+        script = baker.make("scripts.Script", script_body="{{snippet1}}\nfoo")
+
+        # snippet code is inserted as is
+        code, code_hmac = script.get_compiled_code()
+        self.assertEqual(code, "Write-Output C:\\Temp\nfoo")
+        self.assertEqual(code_hmac, Script.get_code_hmac(code))
+
+        # other instances of the script reuse the compiled body and hmac
+        with self.assertNumQueries(0):
+            cached = Script(script_body=script.script_body)
+            self.assertEqual(cached.code, code)
+            self.assertEqual(cached.hash_script_body(), code_hmac)
+
+        # snippets the script doesn't use don't invalidate it
+        other.code = "changed"
+        other.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(Script(script_body=script.script_body).code, code)
+
+        snippet.code = "Write-Output changed"
+        snippet.save()
+        self.assertEqual(
+            Script(script_body=script.script_body).code, "Write-Output changed\nfoo"
+        )
+
+        snippet.delete()
+        self.assertEqual(Script(script_body=script.script_body).code, "\nfoo")
+
+
+class TestBulkScriptTasks(TacticalTestCase):
+    def setUp(self):
+        self.setup_coresettings()
+        self.agents = baker.make_recipe("agents.online_agent", _quantity=3)
+
+    @patch("scripts.tasks.bulk_nats_command")
+    def test_handle_bulk_command_task(self, bulk_nats_command):
+        from agents.models import AgentHistory
+
+        from .tasks import handle_bulk_command_task
+
+        bulk_nats_command.side_effect = lambda messages: {
+            agent_id: "ok" for agent_id, _ in messages
+        }
+
+        r = handle_bulk_command_task(
+            [agent.pk for agent in self.agents], "whoami", "cmd", 30, "john"
+        )
+
+        self.assertEqual(r, {agent.agent_id: "ok" for agent in self.agents})
+        bulk_nats_command.assert_called_once()
+
+        messages = bulk_nats_command.call_args.args[0]
+        history = AgentHistory.objects.filter(username="john", command="whoami")
+        self.assertEqual(history.count(), 3)
+        self.assertEqual(
+            {data["id"] for _, data in messages}, {hist.pk for hist in history}
+        )
+        for _, data in messages:
+            self.assertEqual(data["func"], "rawcmd")
+            self.assertEqual(data["payload"], {"command": "whoami", "shell": "cmd"})
+
+    @patch("scripts.tasks.bulk_nats_command")
+    def test_handle_bulk_script_task(self, bulk_nats_command):
+        from agents.models import AgentHistory
+
+        from .tasks import handle_bulk_script_task
+
+        script = baker.make(
+            "scripts.Script",
+            script_body="Write-Output hi",
+            shell=ScriptShell.POWERSHELL,
+        )
+
+        handle_bulk_script_task(
+            script.pk, [agent.pk for agent in self.agents], ["-Foo"], 90, "john"
+        )
+
+        messages = bulk_nats_command.call_args.args[0]
+        self.assertEqual(
+            {agent_id for agent_id, _ in messages},
+            {agent.agent_id for agent in self.agents},
+        )
+        self.assertEqual(
+            AgentHistory.objects.filter(script=script, username="john").count(), 3
+        )
+        for _, data in messages:
+            self.assertEqual(data["func"], "runscript")
+            self.assertEqual(data["script_args"], ["-Foo"])
+            self.assertEqual(data["payload"]["code"], "Write-Output hi")
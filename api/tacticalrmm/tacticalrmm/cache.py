@@ -5,17 +5,34 @@ from django.core.cache.backends.redis import RedisCache
 
 
 class TacticalRedisCache(RedisCache):
-    def delete_many_pattern(self, pattern: str, version: Optional[int] = None) -> None:
-        keys = self._cache.get_client().keys(f":{version if version else 1}:{pattern}")
+    def delete_many_pattern(
+        self, pattern: str, version: Optional[int] = None, batch_size: int = 1000
+    ) -> None:
+        # SCAN walks the keyspace a batch at a time, KEYS would block redis (and celery) until done
+        client = self._cache.get_client(write=True)
+        keys = []
+        for key in client.scan_iter(
+            match=self.make_key(pattern, version=version), count=batch_size
+        ):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                client.unlink(*keys)
+                keys = []
 
         if keys:
-            self._cache.delete_many(keys)
+            client.unlink(*keys)
 
     # just for debugging
     def show_everything(self, version: Optional[int] = None) -> list[bytes]:
-        return self._cache.get_client().keys(f":{version if version else 1}:*")
+        return list(
+            self._cache.get_client().scan_iter(
+                match=self.make_key("*", version=version)
+            )
+        )
 
 
 class TacticalDummyCache(DummyCache):
-    def delete_many_pattern(self, pattern: str, version: Optional[int] = None) -> None:
+    def delete_many_pattern(
+        self, pattern: str, version: Optional[int] = None, batch_size: int = 1000
+    ) -> None:
         return None
@@ -51,14 +51,22 @@ def setup_periodic_tasks(sender, **kwargs):
 
     from agents.tasks import agent_outages_task
     from alerts.tasks import unsnooze_alerts
+    from checks.tasks import rollup_check_history
     from core.tasks import (
         cache_db_fields_task,
         core_maintenance_tasks,
         handle_resolved_stuff,
+        publish_dash_counts_task,
+        sweep_failing_checks_on_policy_change,
     )
 
     sender.add_periodic_task(60.0, agent_outages_task.s())
     sender.add_periodic_task(60.0 * 30, core_maintenance_tasks.s())
     sender.add_periodic_task(60.0 * 60, unsnooze_alerts.s())
-    sender.add_periodic_task(95.0, cache_db_fields_task.s())
+    sender.add_periodic_task(60.0 * 10, cache_db_fields_task.s())
+    sender.add_periodic_task(60.0, sweep_failing_checks_on_policy_change.s())
     sender.add_periodic_task(70.0, handle_resolved_stuff.s())
+    sender.add_periodic_task(60.0 * 15, rollup_check_history.s())
+    sender.add_periodic_task(
+        float(settings.DASH_INFO_INTERVAL), publish_dash_counts_task.s()
+    )
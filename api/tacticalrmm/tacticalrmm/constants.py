@@ -16,7 +16,19 @@ class MeshAgentIdent(Enum):
 
 
 CORESETTINGS_CACHE_KEY = "core_settings"
+CODESIGN_VALID_CACHE_PREFIX = "codesign_valid_"
 ROLE_CACHE_PREFIX = "role_"
+SNIPPET_VERSION_CACHE_PREFIX = "snippet_version_"
+POLICY_GRAPH_VERSION_KEY = "policy_graph_version"
+LIVE_AGENTS_CACHE_KEY = "live_agents"
+NATS_RELOAD_PENDING_KEY = "nats_reload_pending"
+TASK_SYNC_POLICY_VERSION_KEY = "task_sync_policy_version"
+PATCH_WINDOW_POLICY_VERSION_KEY = "patch_window_policy_version"
+PATCH_POLICY_VERSION_KEY = "patch_policy_version"
+FAILING_CHECKS_POLICY_VERSION_KEY = "failing_checks_policy_version"
+DASH_INFO_COUNTS_KEY = "dash_info_counts"
+DASH_INFO_PENDING_KEY = "dash_info_pending"
+DASH_INFO_GROUP = "dashinfo"
 
 AGENT_STATUS_ONLINE = "online"
 AGENT_STATUS_OFFLINE = "offline"
@@ -172,6 +184,12 @@ class CheckType(models.TextChoices):
     EVENT_LOG = "eventlog", "Event Log Check"
 
 
+class CheckHistoryResolution(models.IntegerChoices):
+    MINUTE = 60, "1m"
+    HOUR = 3600, "1h"
+    DAY = 86400, "1d"
+
+
 class AuditActionType(models.TextChoices):
     LOGIN = "login", "User Login"
     FAILED_LOGIN = "failed_login", "Failed User Login"
@@ -240,6 +258,29 @@ ONLINE_AGENTS = (
     "overdue_time",
     "offline_time",
     "version",
+    "version_number",
+)
+
+# agent fields that decide which policy tasks apply to it
+TASK_SYNC_AGENT_FIELDS = (
+    "policy",
+    "site",
+    "monitoring_type",
+    "block_policy_inheritance",
+)
+
+# agent fields that decide when its next patch window is
+PATCH_WINDOW_AGENT_FIELDS = (*TASK_SYNC_AGENT_FIELDS, "time_zone")
+
+# stored check summary, failing_error/warning are what site and client counters are based on
+CHECK_SUMMARY_FIELDS = (
+    "checks_total",
+    "checks_passing",
+    "checks_failing",
+    "checks_warning",
+    "checks_info",
+    "failing_error",
+    "failing_warning",
 )
 
 FIELDS_TRIGGER_TASK_UPDATE_AGENT = [
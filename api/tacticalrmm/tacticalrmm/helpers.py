@@ -1,4 +1,9 @@
+import re
+import time
+from typing import List, Optional
+
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework import status
 from rest_framework.response import Response
 
@@ -17,3 +22,48 @@ def get_certs() -> tuple[str, str]:
 
 def notify_error(msg: str) -> Response:
     return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+
+VERSION_RE = re.compile(r"^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?")
+
+
+def version_to_int(version: str) -> int:
+    # sortable form of an agent version, must match the agents_agent_version_number trigger
+    m = VERSION_RE.match(version or "")
+    if not m:
+        return 0
+
+    major, minor, patch = (int(i) if i else 0 for i in m.groups())
+    return major * 1_000_000 + min(minor, 999) * 1_000 + min(patch, 999)
+
+
+def _seed_cache_version(key: str) -> None:
+    # seeded from the clock so a lost key never rewinds to a version that may still be cached
+    cache.add(key, time.time_ns() // 1_000_000, timeout=None)
+
+
+def get_cache_versions(keys: List[str]) -> Optional[List[int]]:
+    # counters that cache keys are built on, None means the cache isn't storing anything
+    # (dummy cache) so nothing gets reused
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            _seed_cache_version(key)
+        found.update(cache.get_many(missing))
+        if any(key not in found for key in missing):
+            return None
+
+    return [found[key] for key in keys]
+
+
+def get_cache_version(key: str) -> Optional[int]:
+    versions = get_cache_versions([key])
+    return versions[0] if versions is not None else None
+
+
+def bump_cache_version(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        _seed_cache_version(key)
@@ -0,0 +1,278 @@
+import asyncio
+import atexit
+import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Coroutine, Optional, TypeVar
+
+import msgpack
+import nats
+from django.conf import settings
+from nats.aio.client import Client as NATSClient
+from nats.errors import TimeoutError
+
+T = TypeVar("T")
+
+
+class NatsUnavailable(Exception):
+    pass
+
+
+def get_nats_options() -> dict[str, Any]:
+    return {
+        "servers": f"tls://{settings.ALLOWED_HOSTS[0]}:4222",
+        "user": "tacticalrmm",
+        "password": settings.SECRET_KEY,
+        "connect_timeout": 3,
+        "max_reconnect_attempts": 2,
+        "name": f"trmm-{os.getpid()}",
+    }
+
+
+class NatsConnectionManager:
+    """
+    One long lived NATS connection per process, owned by an event loop running
+    in a daemon thread so it outlives the short lived loops created by asyncio.run().
+    Coroutines from any loop (or plain sync code) are handed to the owning loop.
+    The connection is re-established lazily if it drops and state is reset after a fork.
+    """
+
+    def __init__(self, options: Optional[dict[str, Any]] = None) -> None:
+        self._options = options
+        self._reset()
+
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._nc: Optional[NATSClient] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        # threads and sockets don't survive a fork, start over in the child
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="trmm-nats", daemon=True
+                ).start()
+                self._loop = loop
+            return self._loop
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def _get_connection(self) -> NATSClient:
+        # must only be awaited on self.loop
+        if self._nc is not None and self._nc.is_connected:
+            return self._nc
+
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self._nc is not None and self._nc.is_connected:
+                return self._nc
+
+            # nats-py is still retrying in the background, don't stack a second connection on top
+            if self._nc is not None and self._nc.is_reconnecting:
+                raise NatsUnavailable
+
+            try:
+                self._nc = await nats.connect(**(self._options or get_nats_options()))
+            except Exception as e:
+                self._nc = None
+                raise NatsUnavailable from e
+
+            return self._nc
+
+    async def run_async(self, coro: Coroutine[Any, Any, T]) -> T:
+        # await a coroutine on the shared loop from whatever loop we're currently on
+        loop = self.loop
+        if self._in_loop():
+            return await coro
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        # sync replacement for asyncio.run(), reuses the shared loop and connection
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    async def _request(self, subject: str, payload: bytes, timeout: float) -> bytes:
+        nc = await self._get_connection()
+        msg = await nc.request(subject, payload, timeout=timeout)
+        return msg.data
+
+    async def _publish(self, subject: str, payload: bytes, flush: bool) -> None:
+        nc = await self._get_connection()
+        await nc.publish(subject, payload)
+        if flush:
+            await nc.flush()
+
+    async def _publish_many(self, messages: list[tuple[str, bytes]]) -> None:
+        nc = await self._get_connection()
+        for subject, payload in messages:
+            await nc.publish(subject, payload)
+        await nc.flush()
+
+    async def request(self, subject: str, payload: bytes, timeout: float) -> bytes:
+        return await self.run_async(self._request(subject, payload, timeout))
+
+    async def publish(self, subject: str, payload: bytes, flush: bool = True) -> None:
+        await self.run_async(self._publish(subject, payload, flush))
+
+    async def publish_many(self, messages: list[tuple[str, bytes]]) -> None:
+        # one flush for the whole batch instead of a round trip per message
+        await self.run_async(self._publish_many(messages))
+
+    async def _bulk_command(
+        self,
+        messages: list[tuple[str, dict[str, Any]]],
+        wait: bool,
+        timeout: float,
+        concurrency: int,
+        rate: Optional[float] = None,
+    ) -> dict[str, Any]:
+        try:
+            nc = await self._get_connection()
+        except NatsUnavailable:
+            return {subject: "natsdown" for subject, _ in messages}
+
+        sem = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def send(i: int, subject: str, data: dict[str, Any]) -> tuple[str, Any]:
+            if rate:
+                # spread the messages out evenly instead of sending them all at once
+                delay = start + i / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            async with sem:
+                try:
+                    if not wait:
+                        await nc.publish(subject, msgpack.dumps(data))
+                        return subject, "ok"
+
+                    msg = await nc.request(
+                        subject, msgpack.dumps(data), timeout=timeout
+                    )
+                    return subject, msgpack.loads(msg.data)
+                except TimeoutError:
+                    return subject, "timeout"
+                except Exception as e:
+                    return subject, str(e)
+
+        results = dict(
+            await asyncio.gather(*(send(i, s, d) for i, (s, d) in enumerate(messages)))
+        )
+
+        if not wait:
+            try:
+                await nc.flush()
+            except Exception as e:
+                return {subject: str(e) for subject in results}
+
+        return results
+
+    async def bulk_command(
+        self,
+        messages: list[tuple[str, dict[str, Any]]],
+        wait: bool = False,
+        timeout: float = 30,
+        concurrency: Optional[int] = None,
+        rate: Optional[float] = None,
+    ) -> dict[str, Any]:
+        # fan out to many agents on the shared connection, returns status keyed by agent_id
+        # rate optionally caps how many messages are sent per second
+        return await self.run_async(
+            self._bulk_command(
+                messages,
+                wait,
+                timeout,
+                concurrency or settings.NATS_BULK_CONCURRENCY,
+                rate,
+            )
+        )
+
+    async def _close(self) -> None:
+        if self._nc is not None and not self._nc.is_closed:
+            try:
+                await self._nc.drain()
+            except Exception:
+                await self._nc.close()
+        self._nc = None
+
+    def close(self) -> None:
+        if self._pid != os.getpid() or self._loop is None or self._loop.is_closed():
+            return
+
+        try:
+            self.run(self._close(), timeout=5)
+        except Exception:
+            pass
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+nats_manager = NatsConnectionManager()
+
+
+def bulk_nats_command(
+    messages: list[tuple[str, dict[str, Any]]],
+    wait: bool = False,
+    timeout: float = 30,
+    concurrency: Optional[int] = None,
+    rate: Optional[float] = None,
+) -> dict[str, Any]:
+    if not messages:
+        return {}
+
+    return nats_manager.run(
+        nats_manager.bulk_command(
+            messages, wait=wait, timeout=timeout, concurrency=concurrency, rate=rate
+        )
+    )
+
+
+def bulk_nats_rounds(
+    pending: dict[str, list[T]],
+    build: Callable[[str, T], dict[str, Any]],
+    handle: Callable[[str, T, Any], bool],
+    timeout: float = 30,
+) -> None:
+    # sends each agent its commands one at a time and in order, while the agents are
+    # handled concurrently. handle returning False drops the rest of that agent's items
+    pending = {agent_id: list(items) for agent_id, items in pending.items() if items}
+    while pending:
+        batch = {agent_id: items.pop(0) for agent_id, items in pending.items()}
+        replies = bulk_nats_command(
+            [(agent_id, build(agent_id, item)) for agent_id, item in batch.items()],
+            wait=True,
+            timeout=timeout,
+        )
+
+        for agent_id, item in batch.items():
+            if not handle(agent_id, item, replies.get(agent_id, "timeout")):
+                pending.pop(agent_id)
+
+        pending = {agent_id: items for agent_id, items in pending.items() if items}
+
+
+# make sure buffered publishes reach the server before the worker exits
+atexit.register(nats_manager.close)
+os.register_at_fork(after_in_child=nats_manager._reset)
@@ -68,6 +68,34 @@ ADMIN_ENABLED = False
 HOSTED = False
 REDIS_HOST = "127.0.0.1"
 
+# max in flight nats messages when fanning out bulk actions to agents
+NATS_BULK_CONCURRENCY = 200
+# agent update commands sent per second, keeps every agent from downloading the update at once
+AGENT_UPDATE_RATE = 35
+# seconds to wait before regenerating the nats config after agents are added or removed
+NATS_RELOAD_DELAY = 5
+# agents with queued scheduled task syncs handled per handle_resolved_stuff run
+TASK_SYNC_BATCH_SIZE = 1000
+# online agents asked for their scheduled tasks at once by the orphaned task sweep
+ORPHANED_TASK_BATCH_SIZE = 1000
+# seconds between dashboard agent count refreshes, counts are only pushed when they change
+# but are sent at least every DASH_INFO_HEARTBEAT seconds
+DASH_INFO_INTERVAL = 10
+DASH_INFO_HEARTBEAT = 30
+# seconds to wait before pushing counts after agents are added, removed or change state.
+# agents going offline is only noticed by the periodic refresh since nothing reports it
+DASH_INFO_DEBOUNCE = 2
+# audit log entries held per request before they're written in one insert
+AUDIT_LOG_BUFFER_SIZE = 500
+
+# alert failure/resolved script actions, point ALERT_ACTION_QUEUE at a queue served by
+# a dedicated worker to keep them apart from the other celery tasks
+ALERT_ACTION_QUEUE = "celery"
+# how many alert actions may run at the same time across all workers
+ALERT_ACTION_CONCURRENCY = 10
+# times an alert action waits 10 seconds for a free slot before it's dropped
+ALERT_ACTION_MAX_RETRIES = 360
+
 try:
     from .local_settings import *
 except ImportError:
@@ -1,7 +1,11 @@
-from unittest.mock import mock_open, patch
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, mock_open, patch
 
+import msgpack
 import requests
+from django.conf import settings
 from django.test import override_settings
+from model_bakery import baker
 
 from checks.constants import CHECK_DEFER, CHECK_RESULT_DEFER
 from tacticalrmm.constants import (
@@ -9,12 +13,28 @@ from tacticalrmm.constants import (
     CHECKS_NON_EDITABLE_FIELDS,
     FIELDS_TRIGGER_TASK_UPDATE_AGENT,
     ONLINE_AGENTS,
+    CHECK_SUMMARY_FIELDS,
+    PATCH_WINDOW_AGENT_FIELDS,
     POLICY_CHECK_FIELDS_TO_COPY,
     POLICY_TASK_FIELDS_TO_COPY,
+    TASK_SYNC_AGENT_FIELDS,
 )
+from tacticalrmm.helpers import (
+    bump_cache_version,
+    get_cache_version,
+    get_cache_versions,
+    version_to_int,
+)
+from tacticalrmm.nats_utils import NatsConnectionManager, NatsUnavailable
 from tacticalrmm.test import TacticalTestCase
 
-from .utils import bitdays_to_string, generate_winagent_exe, get_bit_days, reload_nats
+from .utils import (
+    bitdays_to_string,
+    generate_winagent_exe,
+    get_bit_days,
+    reload_nats,
+    schedule_nats_reload,
+)
 
 
 class TestUtils(TacticalTestCase):
@@ -78,6 +98,37 @@ class TestUtils(TacticalTestCase):
 
         mock_subprocess.assert_called_once()
 
+    @override_settings(DOCKER_BUILD=True)
+    @patch("json.dump")
+    def test_reload_nats_users(self, json_dump):
+        from rest_framework.authtoken.models import Token
+
+        from logs.models import DebugLog
+
+        agents = baker.make_recipe("agents.agent", _quantity=3)
+        for agent in agents[:2]:
+            user = baker.make("accounts.User", username=agent.agent_id, agent=agent)
+            Token.objects.create(user=user)
+
+        reload_nats()
+
+        users = json_dump.call_args[0][0]["authorization"]["users"]
+        self.assertEqual(
+            [i["user"] for i in users],
+            ["tacticalrmm", agents[0].agent_id, agents[1].agent_id],
+        )
+        self.assertEqual(users[1]["password"], agents[0].user.auth_token.key)
+        self.assertTrue(DebugLog.objects.filter(agent=agents[2]).exists())
+
+    @patch("core.tasks.reload_nats_task.apply_async")
+    def test_schedule_nats_reload(self, apply_async):
+        # only the first change within the delay schedules a reload
+        with patch("tacticalrmm.utils.cache.add", side_effect=[True, False]):
+            schedule_nats_reload()
+            schedule_nats_reload()
+
+        apply_async.assert_called_once_with(countdown=settings.NATS_RELOAD_DELAY)
+
     def test_bitdays_to_string(self):
         a = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
         all_days = [
@@ -98,6 +149,38 @@ class TestUtils(TacticalTestCase):
         r = bitdays_to_string(bit_weekdays)
         self.assertEqual(r, "Every day")
 
+    def test_version_to_int(self):
+        self.assertEqual(version_to_int("2.0.3"), 2_000_003)
+        self.assertEqual(version_to_int("1.10.0"), 1_010_000)
+        self.assertEqual(version_to_int("v2.1"), 2_001_000)
+        self.assertEqual(version_to_int("2.0.4-dev"), 2_000_004)
+        self.assertEqual(version_to_int("garbage"), 0)
+        self.assertLess(version_to_int("1.9.9"), version_to_int("1.10.0"))
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_cache_version(self):
+        from django.core.cache import cache
+
+        self.addCleanup(cache.clear)
+
+        version = get_cache_version("test_version")
+        self.assertIsNotNone(version)
+        self.assertEqual(get_cache_version("test_version"), version)
+
+        bump_cache_version("test_version")
+        self.assertEqual(get_cache_version("test_version"), version + 1)
+
+        # a lost key is reseeded from the clock, never rewound
+        cache.delete("test_version")
+        bump_cache_version("test_version")
+        self.assertGreaterEqual(get_cache_version("test_version"), version)
+
+        versions = get_cache_versions(["test_version", "other_version"])
+        self.assertEqual(versions[0], get_cache_version("test_version"))
+        self.assertEqual(versions[1], get_cache_version("other_version"))
+
     # for checking when removing db fields, make sure we update these tuples
     def test_constants_fields_exist(self) -> None:
         from agents.models import Agent
@@ -117,6 +200,15 @@ class TestUtils(TacticalTestCase):
         for i in ONLINE_AGENTS:
             self.assertIn(i, agent_fields)
 
+        for i in TASK_SYNC_AGENT_FIELDS:
+            self.assertIn(i, agent_fields)
+
+        for i in PATCH_WINDOW_AGENT_FIELDS:
+            self.assertIn(i, agent_fields)
+
+        for i in CHECK_SUMMARY_FIELDS:
+            self.assertIn(i, agent_fields)
+
         for i in FIELDS_TRIGGER_TASK_UPDATE_AGENT:
             self.assertIn(i, autotask_fields)
 
@@ -134,3 +226,81 @@ class TestUtils(TacticalTestCase):
 
         for i in CHECK_RESULT_DEFER:
             self.assertIn(i, check_result_fields)
+
+
+class TestNatsConnectionManager(TacticalTestCase):
+    def setUp(self):
+        self.setup_coresettings()
+        self.manager = NatsConnectionManager()
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_run_reuses_loop(self):
+        async def get_loop():
+            return asyncio.get_running_loop()
+
+        loop1 = self.manager.run(get_loop())
+        loop2 = self.manager.run(get_loop())
+        self.assertIs(loop1, loop2)
+        self.assertIs(loop1, self.manager.loop)
+
+    @patch("nats.connect")
+    def test_connection_is_shared(self, nats_connect):
+        nc = MagicMock()
+        nc.is_connected = True
+        nc.request = AsyncMock(return_value=MagicMock(data=b"pong"))
+        nc.publish = AsyncMock()
+        nc.flush = AsyncMock()
+        nats_connect.return_value = nc
+
+        for _ in range(3):
+            self.manager.run(self.manager.publish("agent1", b"data"))
+            r = self.manager.run(self.manager.request("agent1", b"data", timeout=1))
+            self.assertEqual(r, b"pong")
+
+        nats_connect.assert_called_once()
+        self.assertEqual(nc.publish.call_count, 3)
+
+    @patch("nats.connect")
+    def test_nats_down(self, nats_connect):
+        nats_connect.side_effect = ConnectionRefusedError()
+
+        with self.assertRaises(NatsUnavailable):
+            self.manager.run(self.manager.publish("agent1", b"data"))
+
+        agent = baker.make_recipe("agents.agent")
+        with patch("agents.models.nats_manager", self.manager):
+            r = self.manager.run(agent.nats_cmd({"func": "ping"}, timeout=1))
+        self.assertEqual(r, "natsdown")
+
+    def test_reset_after_fork(self):
+        loop = self.manager.loop
+        self.manager._pid = -1
+        self.assertIsNot(self.manager.loop, loop)
+        loop.call_soon_threadsafe(loop.stop)
+
+    @override_settings(NATS_BULK_CONCURRENCY=2)
+    @patch("nats.connect")
+    def test_bulk_command(self, nats_connect):
+        nc = MagicMock()
+        nc.is_connected = True
+        nc.publish = AsyncMock()
+        nc.flush = AsyncMock()
+        nc.request = AsyncMock(return_value=MagicMock(data=msgpack.dumps("pong")))
+        nats_connect.return_value = nc
+
+        messages = [(f"agent{i}", {"func": "ping"}) for i in range(5)]
+
+        r = self.manager.run(self.manager.bulk_command(messages))
+        self.assertEqual(r, {f"agent{i}": "ok" for i in range(5)})
+        self.assertEqual(nc.publish.call_count, 5)
+        nc.flush.assert_called_once()
+
+        r = self.manager.run(self.manager.bulk_command(messages, wait=True, timeout=1))
+        self.assertEqual(r, {f"agent{i}": "pong" for i in range(5)})
+
+        nats_connect.side_effect = ConnectionRefusedError()
+        nc.is_connected = False
+        r = self.manager.run(self.manager.bulk_command(messages))
+        self.assertEqual(r, {f"agent{i}": "natsdown" for i in range(5)})
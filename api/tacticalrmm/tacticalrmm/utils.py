@@ -3,7 +3,8 @@ import os
 import subprocess
 import tempfile
 import time
-from typing import List, Optional, Union
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import pytz
 import requests
@@ -11,17 +12,22 @@ from channels.auth import AuthMiddlewareStack
 from channels.db import database_sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.http import FileResponse
+from django.core.cache import cache
+from django.db.models import Q, QuerySet
+from django.http import FileResponse, StreamingHttpResponse
 from knox.auth import TokenAuthentication
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from agents.models import Agent
-from core.models import CodeSignToken
+from agents.models import Agent, AgentCustomField
+from core.models import CodeSignToken, CustomField, GlobalKVStore
 from core.utils import get_core_settings
 from logs.models import DebugLog
 from tacticalrmm.constants import (
+    AGENT_DEFER,
     MONTH_DAYS,
     MONTHS,
+    NATS_RELOAD_PENDING_KEY,
     WEEK_DAYS,
     WEEKS,
     AgentPlat,
@@ -174,28 +180,34 @@ def reload_nats() -> None:
             "permissions": {"publish": ">", "subscribe": ">"},
         }
     ]
-    agents = Agent.objects.prefetch_related("user").only(
-        "pk", "agent_id"
-    )  # type:ignore
-    for agent in agents:
-        try:
-            users.append(
-                {
-                    "user": agent.agent_id,
-                    "password": agent.user.auth_token.key,
-                    "permissions": {
-                        "publish": {"allow": agent.agent_id},
-                        "subscribe": {"allow": agent.agent_id},
-                        "allow_responses": True,
-                    },
-                }
-            )
-        except:
-            DebugLog.critical(
-                agent=agent,
-                log_type=DebugLogType.AGENT_ISSUES,
-                message=f"{agent.hostname} does not have a user account, NATS will not work",
-            )
+    # one joined query instead of a user and token lookup per agent
+    agents = Agent.objects.values_list(
+        "pk", "agent_id", "user__auth_token__key"
+    ).order_by("pk")
+    missing = []
+    for pk, agent_id, key in agents:
+        if not key:
+            missing.append(pk)
+            continue
+
+        users.append(
+            {
+                "user": agent_id,
+                "password": key,
+                "permissions": {
+                    "publish": {"allow": agent_id},
+                    "subscribe": {"allow": agent_id},
+                    "allow_responses": True,
+                },
+            }
+        )
+
+    for agent in Agent.objects.defer(*AGENT_DEFER).filter(pk__in=missing):
+        DebugLog.critical(
+            agent=agent,
+            log_type=DebugLogType.AGENT_ISSUES,
+            message=f"{agent.hostname} does not have a user account, NATS will not work",
+        )
 
     cert_file, key_file = get_certs()
     config = {
@@ -218,6 +230,15 @@ def reload_nats() -> None:
         )
 
 
+def schedule_nats_reload() -> None:
+    # agents get added and removed in bursts during deployments, every change within
+    # the delay is picked up by the same reload
+    from core.tasks import reload_nats_task
+
+    if cache.add(NATS_RELOAD_PENDING_KEY, 1, settings.NATS_RELOAD_DELAY + 60):
+        reload_nats_task.apply_async(countdown=settings.NATS_RELOAD_DELAY)
+
+
 @database_sync_to_async
 def get_user(access_token):
     try:
@@ -262,121 +283,189 @@ def get_latest_trmm_ver() -> str:
     return "error"
 
 
-def replace_db_values(
-    string: str, instance=None, shell: str = None, quotes=True  # type:ignore
-) -> Union[str, None]:
+def _get_db_value_object(model: str, instance: Any) -> Any:
     from clients.models import Client, Site
-    from core.models import CustomField, GlobalKVStore
-
-    # split by period if exists. First should be model and second should be property i.e {{client.name}}
-    temp = string.split(".")
-
-    # check for model and property
-    if len(temp) < 2:
-        # ignore arg since it is invalid
-        return ""
-
-    # value is in the global keystore and replace value
-    if temp[0] == "global":
-        if GlobalKVStore.objects.filter(name=temp[1]).exists():
-            value = GlobalKVStore.objects.get(name=temp[1]).value
-
-            return f"'{value}'" if quotes else value
-        else:
-            DebugLog.error(
-                log_type=DebugLogType.SCRIPTING,
-                message=f"{agent.hostname} Couldn't lookup value for: {string}. Make sure it exists in CoreSettings > Key Store",  # type:ignore
-            )
-            return ""
-
-    if not instance:
-        # instance must be set if not global property
-        return ""
 
-    if temp[0] == "client":
-        model = "client"
+    if model == "client":
         if isinstance(instance, Client):
-            obj = instance
+            return instance
         elif hasattr(instance, "client"):
-            obj = instance.client
-        else:
-            obj = None
-    elif temp[0] == "site":
-        model = "site"
+            return instance.client
+    elif model == "site":
         if isinstance(instance, Site):
-            obj = instance
+            return instance
         elif hasattr(instance, "site"):
-            obj = instance.site
-        else:
-            obj = None
-    elif temp[0] == "agent":
-        model = "agent"
+            return instance.site
+    elif model == "agent":
         if isinstance(instance, Agent):
-            obj = instance
-        else:
-            obj = None
-    else:
-        # ignore arg since it is invalid
-        DebugLog.error(
-            log_type=DebugLogType.SCRIPTING,
-            message=f"{instance} Not enough information to find value for: {string}. Only agent, site, client, and global are supported.",
-        )
-        return ""
+            return instance
+
+    return None
 
-    if not obj:
-        return ""
 
-    # check if attr exists and isn't a function
-    if hasattr(obj, temp[1]) and not callable(getattr(obj, temp[1])):
-        value = f"'{getattr(obj, temp[1])}'" if quotes else getattr(obj, temp[1])
+class DBValueResolver:
+    # looks up everything a set of {{model.property}} variables can reference for a batch of
+    # agents, sites or clients in a few queries, so values are filled in from memory
+    def __init__(self, strings: Iterable[str], instances: Iterable[Any] = ()) -> None:
+        from clients.models import ClientCustomField, SiteCustomField
+
+        names: Dict[str, Set[str]] = {
+            "global": set(),
+            "agent": set(),
+            "site": set(),
+            "client": set(),
+        }
+        for string in strings:
+            temp = string.split(".")
+            if len(temp) >= 2 and temp[0] in names:
+                names[temp[0]].add(temp[1])
+
+        self.globals: Dict[str, str] = (
+            dict(
+                GlobalKVStore.objects.filter(name__in=names["global"]).values_list(
+                    "name", "value"
+                )
+            )
+            if names["global"]
+            else {}
+        )
 
-    elif CustomField.objects.filter(model=model, name=temp[1]).exists():
+        fields_filter = Q()
+        for model in ("agent", "site", "client"):
+            if names[model]:
+                fields_filter |= Q(model=model, name__in=names[model])
+
+        self.fields: Dict[Tuple[str, str], CustomField] = (
+            {
+                (field.model, field.name): field
+                for field in CustomField.objects.filter(fields_filter)
+            }
+            if fields_filter
+            else {}
+        )
 
-        field = CustomField.objects.get(model=model, name=temp[1])
-        model_fields = getattr(field, f"{model}_fields")
-        value = None
-        if model_fields.filter(**{model: obj}).exists():
-            if (
-                field.type != CustomFieldType.CHECKBOX
-                and model_fields.get(**{model: obj}).value
+        self.values: Dict[Tuple[str, int, int], Any] = {}
+        instances = list(instances)
+        for model, value_model in (
+            ("agent", AgentCustomField),
+            ("site", SiteCustomField),
+            ("client", ClientCustomField),
+        ):
+            fields = {
+                field.pk: field
+                for (field_model, _), field in self.fields.items()
+                if field_model == model
+            }
+            if not fields:
+                continue
+
+            objs = {_get_db_value_object(model, i) for i in instances} - {None}
+            if not objs:
+                continue
+
+            for row in value_model.objects.filter(
+                field_id__in=fields, **{f"{model}_id__in": [obj.pk for obj in objs]}
             ):
-                value = model_fields.get(**{model: obj}).value
-            elif field.type == CustomFieldType.CHECKBOX:
-                value = model_fields.get(**{model: obj}).value
-
-        # need explicit None check since a false boolean value will pass default value
-        if value == None and field.default_value != None:
-            value = field.default_value
-
-        # check if value exists and if not use default
-        if value and field.type == CustomFieldType.MULTIPLE:
-            value = (
-                f"'{format_shell_array(value)}'"
-                if quotes
-                else format_shell_array(value)
+                row.field = fields[row.field_id]
+                self.values[(model, row.field_id, getattr(row, f"{model}_id"))] = row
+
+    def resolve(
+        self, string: str, instance=None, shell: str = None, quotes=True  # type:ignore
+    ) -> Union[str, None]:
+        # split by period if exists. First should be model and second should be property i.e {{client.name}}
+        temp = string.split(".")
+
+        # check for model and property
+        if len(temp) < 2:
+            # ignore arg since it is invalid
+            return ""
+
+        # value is in the global keystore and replace value
+        if temp[0] == "global":
+            if temp[1] in self.globals:
+                value = self.globals[temp[1]]
+
+                return f"'{value}'" if quotes else value
+            else:
+                DebugLog.error(
+                    log_type=DebugLogType.SCRIPTING,
+                    message=f"{instance} Couldn't lookup value for: {string}. Make sure it exists in CoreSettings > Key Store",
+                )
+                return ""
+
+        if not instance:
+            # instance must be set if not global property
+            return ""
+
+        if temp[0] not in ("client", "site", "agent"):
+            # ignore arg since it is invalid
+            DebugLog.error(
+                log_type=DebugLogType.SCRIPTING,
+                message=f"{instance} Not enough information to find value for: {string}. Only agent, site, client, and global are supported.",
+            )
+            return ""
+
+        model = temp[0]
+        obj = _get_db_value_object(model, instance)
+        if not obj:
+            return ""
+
+        # check if attr exists and isn't a function
+        if hasattr(obj, temp[1]) and not callable(getattr(obj, temp[1])):
+            value = f"'{getattr(obj, temp[1])}'" if quotes else getattr(obj, temp[1])
+
+        elif (model, temp[1]) in self.fields:
+
+            field = self.fields[(model, temp[1])]
+            model_field = self.values.get((model, field.pk, obj.pk))
+            value = None
+            if model_field:
+                if field.type != CustomFieldType.CHECKBOX and model_field.value:
+                    value = model_field.value
+                elif field.type == CustomFieldType.CHECKBOX:
+                    value = model_field.value
+
+            # need explicit None check since a false boolean value will pass default value
+            if value == None and field.default_value != None:
+                value = field.default_value
+
+            # check if value exists and if not use default
+            if value and field.type == CustomFieldType.MULTIPLE:
+                value = (
+                    f"'{format_shell_array(value)}'"
+                    if quotes
+                    else format_shell_array(value)
+                )
+            elif value != None and field.type == CustomFieldType.CHECKBOX:
+                value = format_shell_bool(value, shell)
+            else:
+                value = f"'{value}'" if quotes else value
+
+        else:
+            # ignore arg since property is invalid
+            DebugLog.error(
+                log_type=DebugLogType.SCRIPTING,
+                message=f"{instance} Couldn't find property on supplied variable: {string}. Make sure it exists as a custom field or a valid agent property",
             )
-        elif value != None and field.type == CustomFieldType.CHECKBOX:
-            value = format_shell_bool(value, shell)
+            return ""
+
+        # log any unhashable type errors
+        if value != None:
+            return value
         else:
-            value = f"'{value}'" if quotes else value
+            DebugLog.error(
+                log_type=DebugLogType.SCRIPTING,
+                message=f" {instance}({instance.pk}) Couldn't lookup value for: {string}. Make sure it exists as a custom field or a valid agent property",
+            )
+            return ""
 
-    else:
-        # ignore arg since property is invalid
-        DebugLog.error(
-            log_type=DebugLogType.SCRIPTING,
-            message=f"{instance} Couldn't find property on supplied variable: {string}. Make sure it exists as a custom field or a valid agent property",
-        )
-        return ""
 
-    # log any unhashable type errors
-    if value != None:
-        return value
-    else:
-        DebugLog.error(
-            log_type=DebugLogType.SCRIPTING,
-            message=f" {instance}({instance.pk}) Couldn't lookup value for: {string}. Make sure it exists as a custom field or a valid agent property",
-        )
-        return ""
+def replace_db_values(
+    string: str, instance=None, shell: str = None, quotes=True  # type:ignore
+) -> Union[str, None]:
+    return DBValueResolver([string], [instance] if instance else []).resolve(
+        string=string, instance=instance, shell=shell, quotes=quotes
+    )
 
 
 def format_shell_array(value: list[str]) -> str:
@@ -391,3 +480,25 @@ def format_shell_bool(value: bool, shell: Optional[str]) -> str:
         return "$True" if value else "$False"
     else:
         return "1" if value else "0"
+
+
+def stream_json_list(
+    serializer_class: Any,
+    queryset: QuerySet,
+    chunk_size: int = 500,
+    context: Optional[dict[str, Any]] = None,
+) -> StreamingHttpResponse:
+    # serializes and sends the rows a chunk at a time so the whole list is never held in memory
+    renderer = JSONRenderer()
+
+    def generate():
+        yield b"["
+        rows = queryset.iterator(chunk_size=chunk_size)
+        sep = b""
+        while chunk := list(islice(rows, chunk_size)):
+            data = serializer_class(chunk, many=True, context=context or {}).data
+            yield sep + renderer.render(data)[1:-1]
+            sep = b","
+        yield b"]"
+
+    return StreamingHttpResponse(generate(), content_type="application/json")
@@ -5,6 +5,8 @@ from django.db import models
 
 from agents.models import Agent
 from logs.models import BaseAuditModel
+from tacticalrmm.constants import PATCH_POLICY_VERSION_KEY
+from tacticalrmm.helpers import bump_cache_version
 
 PATCH_ACTION_CHOICES = [
     ("inherit", "Inherit"),
@@ -146,6 +148,25 @@ class WinUpdatePolicy(BaseAuditModel):
         else:
             return self.policy.name
 
+    def save(self, *args, **kwargs) -> None:
+        super().save(*args, **kwargs)
+        # an agent or policy level patch policy changed
+        bump_cache_version(PATCH_POLICY_VERSION_KEY)
+        self.mark_patch_windows_stale()
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        bump_cache_version(PATCH_POLICY_VERSION_KEY)
+        self.mark_patch_windows_stale()
+
+    def mark_patch_windows_stale(self) -> None:
+        # a policy level patch policy can apply to any agent
+        agents = Agent.objects.all()
+        if self.agent_id:
+            agents = agents.filter(pk=self.agent_id)
+
+        agents.filter(patch_window_stale=False).update(patch_window_stale=True)
+
     @staticmethod
     def serialize(policy):
         # serializes the policy and returns json
@@ -1,147 +1,190 @@
-import asyncio
 import datetime as dt
 import time
+from typing import Any
 
-import pytz
+from django.core.cache import cache
+from django.db.models import QuerySet
 from django.utils import timezone as djangotime
-from packaging import version as pyver
 
 from agents.models import Agent
+from automation.utils import get_policy_graph_version
 from logs.models import DebugLog
 from tacticalrmm.celery import app
-from tacticalrmm.constants import AGENT_STATUS_ONLINE, DebugLogType
+from tacticalrmm.constants import (
+    AGENT_STATUS_ONLINE,
+    PATCH_WINDOW_POLICY_VERSION_KEY,
+    DebugLogType,
+)
+from tacticalrmm.helpers import version_to_int
+from tacticalrmm.nats_utils import bulk_nats_command, nats_manager
+
+from .models import WinUpdate
+from .utils import get_patch_policies, update_patch_windows
+
+PATCH_WINDOW_FIELDS = (
+    "pk",
+    "agent_id",
+    "hostname",
+    "site_id",
+    "policy_id",
+    "monitoring_type",
+    "block_policy_inheritance",
+    "time_zone",
+    "patches_last_installed",
+    "next_patch_window",
+    "patch_window_stale",
+    "last_seen",
+    "overdue_time",
+    "offline_time",
+)
 
 
 @app.task
 def auto_approve_updates_task() -> None:
     # scheduled task that checks and approves updates daily
 
-    agents = Agent.objects.only(
-        "pk", "agent_id", "version", "last_seen", "overdue_time", "offline_time"
+    agents = list(
+        Agent.objects.only(
+            "pk",
+            "agent_id",
+            "version",
+            "version_number",
+            "last_seen",
+            "overdue_time",
+            "offline_time",
+            "site_id",
+            "policy_id",
+            "monitoring_type",
+            "block_policy_inheritance",
+        )
     )
-    for agent in agents:
-        agent.delete_superseded_updates()
-        try:
-            agent.approve_updates()
-        except:
-            continue
+    for i in range(0, len(agents), 1000):
+        patch_policies = get_patch_policies(agents[i : i + 1000])
+        for agent in agents[i : i + 1000]:
+            agent.delete_superseded_updates()
+            try:
+                agent.approve_updates(patch_policies[agent.pk])
+            except:
+                continue
 
     online = [
         i
         for i in agents
         if i.status == AGENT_STATUS_ONLINE
-        and pyver.parse(i.version) >= pyver.parse("1.3.0")
+        and i.version_number >= version_to_int("1.3.0")
     ]
 
     chunks = (online[i : i + 40] for i in range(0, len(online), 40))
     for chunk in chunks:
         for agent in chunk:
-            asyncio.run(agent.nats_cmd({"func": "getwinupdates"}, wait=False))
+            nats_manager.run(agent.nats_cmd({"func": "getwinupdates"}, wait=False))
         time.sleep(1)
 
 
+def recompute_patch_windows(agents: "QuerySet[Agent]", now: dt.datetime) -> None:
+    pks = list(agents.values_list("pk", flat=True))
+    for i in range(0, len(pks), 1000):
+        update_patch_windows(
+            list(
+                Agent.objects.only(*PATCH_WINDOW_FIELDS).filter(
+                    pk__in=pks[i : i + 1000]
+                )
+            ),
+            now,
+        )
+
+
 @app.task
 def check_agent_update_schedule_task() -> None:
-    # scheduled task that installs updates on agents if enabled
-    for agent in Agent.online_agents(min_version="1.3.0"):
+    # scheduled task that installs updates on agents whose patch window has started.
+    # it runs a few minutes into the hour so windows from the start of this hour are due
+    now = djangotime.now()
+
+    # any policy change may move the windows, so they're all recomputed once per policy graph version
+    version = get_policy_graph_version()
+    if version is None or cache.get(PATCH_WINDOW_POLICY_VERSION_KEY) != version:
+        Agent.objects.filter(patch_window_stale=False).update(patch_window_stale=True)
+
+    recompute_patch_windows(Agent.objects.filter(patch_window_stale=True), now)
+    if version is not None:
+        cache.set(PATCH_WINDOW_POLICY_VERSION_KEY, version, None)
+
+    agents = [
+        agent
+        for agent in Agent.objects.only(*PATCH_WINDOW_FIELDS).filter(
+            next_patch_window__lte=now,
+            next_patch_window__gt=now - dt.timedelta(hours=1),
+            version_number__gte=version_to_int("1.3.0"),
+        )
+        if agent.status == AGENT_STATUS_ONLINE
+    ]
+
+    guids: dict[int, list[str]] = {}
+    for agent in agents:
         agent.delete_superseded_updates()
-        install = False
-        patch_policy = agent.get_patch_policy()
-
-        # check if auto approval is enabled
-        if (
-            patch_policy.critical == "approve"
-            or patch_policy.important == "approve"
-            or patch_policy.moderate == "approve"
-            or patch_policy.low == "approve"
-            or patch_policy.other == "approve"
-        ):
-
-            # get current time in agent local time
-            timezone = pytz.timezone(agent.timezone)
-            agent_localtime_now = dt.datetime.now(timezone)
-            weekday = agent_localtime_now.weekday()
-            hour = agent_localtime_now.hour
-            day = agent_localtime_now.day
-
-            if agent.patches_last_installed:
-                # get agent last installed time in local time zone
-                last_installed = agent.patches_last_installed.astimezone(timezone)
-
-                # check if patches were already run for this cycle and exit if so
-                if last_installed.strftime("%d/%m/%Y") == agent_localtime_now.strftime(
-                    "%d/%m/%Y"
-                ):
-                    return
-
-            # check if schedule is set to daily/weekly and if now is the time to run
-            if (
-                patch_policy.run_time_frequency == "daily"
-                and weekday in patch_policy.run_time_days
-                and patch_policy.run_time_hour == hour
-            ):
-                install = True
-
-            elif patch_policy.run_time_frequency == "monthly":
-
-                if patch_policy.run_time_day > 28:
-                    months_with_30_days = [3, 6, 9, 11]
-                    current_month = agent_localtime_now.month
-                    if current_month == 2:
-                        patch_policy.run_time_day = 28
-                    elif current_month in months_with_30_days:
-                        patch_policy.run_time_day = 30
-
-                # check if patches were scheduled to run today and now
-                if (
-                    day == patch_policy.run_time_day
-                    and patch_policy.run_time_hour == hour
-                ):
-                    install = True
-
-            if install:
-                # initiate update on agent asynchronously and don't worry about ret code
-                DebugLog.info(
-                    agent=agent,
-                    log_type=DebugLogType.WIN_UPDATES,
-                    message=f"Installing windows updates on {agent.hostname}",
-                )
-                nats_data = {
-                    "func": "installwinupdates",
-                    "guids": agent.get_approved_update_guids(),
-                }
-                asyncio.run(agent.nats_cmd(nats_data, wait=False))
-                agent.patches_last_installed = djangotime.now()
-                agent.save(update_fields=["patches_last_installed"])
+    for agent_id, guid in WinUpdate.objects.filter(
+        agent__in=agents, action="approve", installed=False
+    ).values_list("agent_id", "guid"):
+        guids.setdefault(agent_id, []).append(guid)
+
+    for agent in agents:
+        DebugLog.info(
+            agent=agent,
+            log_type=DebugLogType.WIN_UPDATES,
+            message=f"Installing windows updates on {agent.hostname}",
+        )
+
+    # initiate update on agents asynchronously and don't worry about ret code
+    bulk_nats_command(
+        [
+            (
+                agent.agent_id,
+                {"func": "installwinupdates", "guids": guids.get(agent.pk, [])},
+            )
+            for agent in agents
+        ]
+    )
+    Agent.objects.filter(pk__in=[agent.pk for agent in agents]).update(
+        patches_last_installed=now
+    )
+
+    # windows that have started, whether they were used or missed, move on to the next one
+    recompute_patch_windows(
+        Agent.objects.filter(next_patch_window__lte=now),
+        now + dt.timedelta(hours=1),
+    )
 
 
 @app.task
-def bulk_install_updates_task(pks: list[int]) -> None:
-    q = Agent.objects.filter(pk__in=pks)
-    agents = [i for i in q if pyver.parse(i.version) >= pyver.parse("1.3.0")]
-    chunks = (agents[i : i + 40] for i in range(0, len(agents), 40))
-    for chunk in chunks:
-        for agent in chunk:
-            agent.delete_superseded_updates()
-            try:
-                agent.approve_updates()
-            except:
-                pass
-            nats_data = {
-                "func": "installwinupdates",
-                "guids": agent.get_approved_update_guids(),
-            }
-            asyncio.run(agent.nats_cmd(nats_data, wait=False))
-        time.sleep(1)
+def bulk_install_updates_task(pks: list[int]) -> dict[str, Any]:
+    agents = list(
+        Agent.objects.filter(pk__in=pks, version_number__gte=version_to_int("1.3.0"))
+    )
+    patch_policies = get_patch_policies(agents)
+    messages = []
+    for agent in agents:
+        agent.delete_superseded_updates()
+        try:
+            agent.approve_updates(patch_policies[agent.pk])
+        except:
+            pass
+        nats_data = {
+            "func": "installwinupdates",
+            "guids": agent.get_approved_update_guids(),
+        }
+        messages.append((agent.agent_id, nats_data))
+
+    return bulk_nats_command(messages)
 
 
 @app.task
-def bulk_check_for_updates_task(pks: list[int]) -> None:
-    q = Agent.objects.filter(pk__in=pks)
-    agents = [i for i in q if pyver.parse(i.version) >= pyver.parse("1.3.0")]
-    chunks = (agents[i : i + 40] for i in range(0, len(agents), 40))
-    for chunk in chunks:
-        for agent in chunk:
-            agent.delete_superseded_updates()
-            asyncio.run(agent.nats_cmd({"func": "getwinupdates"}, wait=False))
-        time.sleep(1)
+def bulk_check_for_updates_task(pks: list[int]) -> dict[str, Any]:
+    agents = list(
+        Agent.objects.filter(pk__in=pks, version_number__gte=version_to_int("1.3.0"))
+    )
+    for agent in agents:
+        agent.delete_superseded_updates()
+
+    return bulk_nats_command(
+        [(agent.agent_id, {"func": "getwinupdates"}) for agent in agents]
+    )
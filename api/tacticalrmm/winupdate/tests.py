@@ -1,6 +1,9 @@
+import datetime as dt
 from itertools import cycle
 from unittest.mock import patch
 
+from django.test import override_settings
+from django.utils import timezone as djangotime
 from model_bakery import baker
 
 from tacticalrmm.test import TacticalTestCase
@@ -193,3 +196,123 @@ class WinupdateTasks(TacticalTestCase):
         winupdates = WinUpdate.objects.all()
         for update in winupdates:
             self.assertEqual(update.action, "approve")
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_get_patch_policies(self):
+        from .utils import get_patch_policies
+
+        agent = self.online_agents[0]
+        policy = baker.make("automation.Policy", active=True)
+        agent.policy = policy
+        agent.save(update_fields=["policy"])
+        baker.make("winupdate.WinUpdatePolicy", agent=agent, critical="ignore")
+        policy_patch = baker.make(
+            "winupdate.WinUpdatePolicy",
+            policy=policy,
+            critical="approve",
+            important="approve",
+        )
+
+        # agent settings are applied on top of the policy
+        patch_policy = agent.get_patch_policy()
+        self.assertEqual(patch_policy.critical, "ignore")
+        self.assertEqual(patch_policy.important, "approve")
+
+        # the merged policy is read back with a single cache lookup
+        with self.assertNumQueries(0):
+            self.assertEqual(get_patch_policies([agent])[agent.pk].important, "approve")
+
+        # changing an input patch policy recomputes it
+        policy_patch.important = "ignore"
+        policy_patch.save()
+        self.assertEqual(agent.get_patch_policy().important, "ignore")
+
+        # as does unassigning the policy
+        agent.policy = None
+        agent.save(update_fields=["policy"])
+        self.assertEqual(agent.get_patch_policy().important, "inherit")
+
+    def test_get_next_patch_window(self):
+        from .models import WinUpdatePolicy
+        from .utils import get_next_patch_window
+
+        # wednesday
+        now = dt.datetime(2022, 6, 15, 10, 5, tzinfo=dt.timezone.utc)
+        policy = WinUpdatePolicy(
+            critical="approve",
+            run_time_frequency="daily",
+            run_time_days=[0, 2],
+            run_time_hour=10,
+        )
+        self.assertEqual(
+            get_next_patch_window(policy, "UTC", now),
+            dt.datetime(2022, 6, 15, 10, tzinfo=dt.timezone.utc),
+        )
+
+        # already installed today so it moves to monday, in the agent's timezone
+        self.assertEqual(
+            get_next_patch_window(policy, "America/New_York", now, now),
+            dt.datetime(2022, 6, 20, 14, tzinfo=dt.timezone.utc),
+        )
+
+        # monthly on a day past the end of the month runs on the last day
+        policy.run_time_frequency = "monthly"
+        policy.run_time_day = 31
+        self.assertEqual(
+            get_next_patch_window(policy, "UTC", now),
+            dt.datetime(2022, 6, 30, 10, tzinfo=dt.timezone.utc),
+        )
+
+        # nothing is approved automatically
+        policy.critical = "manual"
+        self.assertIsNone(get_next_patch_window(policy, "UTC", now))
+
+    @patch("winupdate.tasks.bulk_nats_command")
+    def test_check_agent_update_schedule_task(self, bulk_nats_command):
+        from .tasks import check_agent_update_schedule_task
+
+        now = djangotime.now()
+        agent = self.online_agents[0]
+        agent.time_zone = "UTC"
+        agent.save(update_fields=["time_zone"])
+        baker.make(
+            "winupdate.WinUpdatePolicy",
+            agent=agent,
+            critical="approve",
+            run_time_frequency="daily",
+            run_time_days=list(range(7)),
+            run_time_hour=now.hour,
+        )
+        approved = baker.make_recipe(
+            "winupdate.winupdate", agent=agent, action="approve", installed=False
+        )
+
+        check_agent_update_schedule_task()
+        bulk_nats_command.assert_called_once_with(
+            [
+                (
+                    agent.agent_id,
+                    {"func": "installwinupdates", "guids": [approved.guid]},
+                )
+            ]
+        )
+        agent.refresh_from_db()
+        self.assertIsNotNone(agent.patches_last_installed)
+        self.assertEqual(
+            agent.next_patch_window,
+            now.replace(minute=0, second=0, microsecond=0) + dt.timedelta(days=1),
+        )
+        self.assertFalse(agent.patch_window_stale)
+
+        # the window for today has been used
+        bulk_nats_command.reset_mock()
+        check_agent_update_schedule_task()
+        bulk_nats_command.assert_called_once_with([])
+
+        # changing the timezone recomputes the window
+        agent.time_zone = "Asia/Tokyo"
+        agent.save(update_fields=["time_zone"])
+        agent.refresh_from_db()
+        self.assertTrue(agent.patch_window_stale)
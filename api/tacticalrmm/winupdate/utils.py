@@ -0,0 +1,187 @@
+import calendar
+import datetime as dt
+from typing import TYPE_CHECKING, Dict, Optional, Sequence
+
+import pytz
+from django.core.cache import cache
+from django.utils import timezone as djangotime
+
+from automation.utils import get_policy_graph, resolve_policy_ids
+from core.utils import get_core_settings
+from tacticalrmm.constants import PATCH_POLICY_VERSION_KEY
+from tacticalrmm.helpers import get_cache_version
+
+from .models import WinUpdatePolicy
+
+if TYPE_CHECKING:
+    from agents.models import Agent
+
+APPROVAL_FIELDS = ("critical", "important", "moderate", "low", "other")
+
+# monthly windows are at most two months apart
+PATCH_WINDOW_SEARCH_DAYS = 62
+
+# keys are versioned so they never go stale, this only bounds memory
+PATCH_POLICY_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_patch_policies(agents: "Sequence[Agent]") -> "Dict[int, WinUpdatePolicy]":
+    # merged patch policy for each agent, read from the cache in one round trip.
+    # keyed on both versions and the agent's resolved policies so any change to
+    # patch policies, policy assignments or the agent itself misses
+    graph_version, graph = get_policy_graph()
+    patch_version = get_cache_version(PATCH_POLICY_VERSION_KEY)
+    cacheable = graph_version is not None and patch_version is not None
+
+    keys = {
+        agent.pk: "patch_policy_{}_{}_{}_{}".format(
+            graph_version,
+            patch_version,
+            agent.pk,
+            "_".join(str(pk or 0) for pk in resolve_policy_ids(agent, graph).values()),
+        )
+        for agent in agents
+    }
+    found = cache.get_many(list(keys.values())) if cacheable else {}
+
+    missing = [agent for agent in agents if keys[agent.pk] not in found]
+    if missing:
+        built = {
+            keys[pk]: {
+                f.attname: getattr(policy, f.attname)
+                for f in WinUpdatePolicy._meta.concrete_fields
+            }
+            for pk, policy in _build_patch_policies(missing).items()
+        }
+        if cacheable:
+            cache.set_many(built, PATCH_POLICY_CACHE_TIMEOUT)
+        found.update(built)
+
+    return {agent.pk: WinUpdatePolicy(**found[keys[agent.pk]]) for agent in agents}
+
+
+def _build_patch_policies(
+    agents: "Sequence[Agent]",
+) -> "Dict[int, WinUpdatePolicy]":
+    from automation.models import Policy
+
+    _, graph = get_policy_graph()
+    policy_ids = {agent.pk: resolve_policy_ids(agent, graph) for agent in agents}
+
+    agent_policies = {
+        i.agent_id: i
+        for i in WinUpdatePolicy.objects.filter(
+            agent_id__in=[agent.pk for agent in agents]
+        ).order_by("-pk")
+    }
+    active = set(Policy.objects.filter(active=True).values_list("pk", flat=True))
+    policy_policies = {
+        i.policy_id: i
+        for i in WinUpdatePolicy.objects.filter(policy_id__in=active).order_by("-pk")
+    }
+
+    ret = {}
+    for agent in agents:
+        agent_policy = agent_policies.get(agent.pk) or WinUpdatePolicy(agent=agent)
+
+        patch_policy = None
+        for pk in policy_ids[agent.pk].values():
+            if pk in policy_policies:
+                patch_policy = policy_policies[pk]
+
+        if not patch_policy:
+            ret[agent.pk] = agent_policy
+            continue
+
+        # a copy per agent since the agent settings get applied on top of it
+        patch_policy = WinUpdatePolicy(
+            **{
+                f.attname: getattr(patch_policy, f.attname)
+                for f in WinUpdatePolicy._meta.concrete_fields
+            }
+        )
+        for field in APPROVAL_FIELDS:
+            if getattr(agent_policy, field) != "inherit":
+                setattr(patch_policy, field, getattr(agent_policy, field))
+
+        if agent_policy.run_time_frequency != "inherit":
+            patch_policy.run_time_frequency = agent_policy.run_time_frequency
+            patch_policy.run_time_hour = agent_policy.run_time_hour
+            patch_policy.run_time_days = agent_policy.run_time_days
+
+        if agent_policy.reboot_after_install != "inherit":
+            patch_policy.reboot_after_install = agent_policy.reboot_after_install
+
+        if not agent_policy.reprocess_failed_inherit:
+            patch_policy.reprocess_failed = agent_policy.reprocess_failed
+            patch_policy.reprocess_failed_times = agent_policy.reprocess_failed_times
+            patch_policy.email_if_fail = agent_policy.email_if_fail
+
+        ret[agent.pk] = patch_policy
+
+    return ret
+
+
+def get_next_patch_window(
+    patch_policy: WinUpdatePolicy,
+    timezone: str,
+    now: dt.datetime,
+    last_installed: Optional[dt.datetime] = None,
+) -> Optional[dt.datetime]:
+    # start of the next hour in which updates should be installed, in UTC.
+    # None if nothing is auto approved or the schedule never runs
+    if not any(getattr(patch_policy, field) == "approve" for field in APPROVAL_FIELDS):
+        return None
+
+    tz = pytz.timezone(timezone)
+    local_now = now.astimezone(tz)
+    installed_on = last_installed.astimezone(tz).date() if last_installed else None
+    hour_start = now.replace(minute=0, second=0, microsecond=0)
+
+    for i in range(PATCH_WINDOW_SEARCH_DAYS):
+        day = local_now.date() + dt.timedelta(days=i)
+
+        # only one install per day
+        if day == installed_on:
+            continue
+
+        if patch_policy.run_time_frequency == "daily":
+            if day.weekday() not in (patch_policy.run_time_days or []):
+                continue
+        elif patch_policy.run_time_frequency == "monthly":
+            # days past the end of the month run on its last day
+            last_day = calendar.monthrange(day.year, day.month)[1]
+            if day.day != min(patch_policy.run_time_day, last_day):
+                continue
+        else:
+            return None
+
+        window = tz.localize(
+            dt.datetime.combine(day, dt.time(hour=patch_policy.run_time_hour))
+        ).astimezone(dt.timezone.utc)
+        if window >= hour_start:
+            return window
+
+    return None
+
+
+def update_patch_windows(
+    agents: "Sequence[Agent]", now: Optional[dt.datetime] = None
+) -> None:
+    from agents.models import Agent
+
+    now = now or djangotime.now()
+    default_time_zone = get_core_settings().default_time_zone
+    patch_policies = get_patch_policies(agents)
+    for agent in agents:
+        agent.next_patch_window = get_next_patch_window(
+            patch_policies[agent.pk],
+            agent.time_zone or default_time_zone,
+            now,
+            agent.patches_last_installed,
+        )
+        agent.patch_window_stale = False
+
+    Agent.objects.bulk_update(
+        agents, ["next_patch_window", "patch_window_stale"], batch_size=1000
+    )